@@ -0,0 +1,280 @@
+"""
+Offline ingestion of knowledge base sources into the {kb}_{model}_{md5} OpenSearch indices searched by PaletteUsecase.
+
+This is an admin entry point: it is not reachable from chat requests. Sources are read only when they are within
+the allow-list of the deployment (env INGESTION_ALLOWED_SOURCES of the process, see get_allowed_sources()), never
+from request input. Typical use, from an admin script or job with the usecase configured for the deployment:
+
+	usecase.ingest_knowledge_base("CEI", ["s3://kb-bucket/cei/"])
+
+or, with the OpenSearch client, index name and embeddings at hand, ingest_knowledge_base() of this module.
+"""
+import os
+import hashlib
+import threading
+import time
+import uuid
+import boto3
+
+from aws_lambda_powertools import Logger
+from concurrent.futures import ThreadPoolExecutor
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from opensearchpy.helpers import bulk
+
+logger = Logger()
+
+#************************************************************************************************************
+# Allowed sources
+
+def get_allowed_sources():
+	"""
+	The sources ingestion may read, from env INGESTION_ALLOWED_SOURCES of the process: a comma separated list of local
+	directories and s3://bucket/prefix URIs. Nothing is allowed when it is not set.
+	"""
+	return [source.strip() for source in os.environ.get("INGESTION_ALLOWED_SOURCES", "").split(",") if source.strip()]
+
+
+def within_prefix(key, prefix):
+	"""Whether the S3 key is prefix itself or under it, treating prefix as a directory ('docs' doesn't allow 'docs-old/a')."""
+	if not prefix or prefix.endswith("/"):
+		return key.startswith(prefix)
+	return key == prefix or key.startswith(prefix + "/")
+
+
+def is_allowed_source(source, allowed_sources):
+	"""
+	Whether source (a local path or an s3:// URI) is within one of allowed_sources. Local paths are compared after
+	resolving symlinks and '..', so '/kb/../proc/self/environ' is not within '/kb'.
+	"""
+	if source.startswith("s3://"):
+		bucket, _, key = source[len("s3://"):].partition("/")
+		for allowed in allowed_sources:
+			if allowed.startswith("s3://"):
+				allowed_bucket, _, allowed_prefix = allowed[len("s3://"):].partition("/")
+				if bucket == allowed_bucket and within_prefix(key, allowed_prefix):
+					return True
+		return False
+
+	path = os.path.realpath(source)
+	for allowed in allowed_sources:
+		if not allowed.startswith("s3://"):
+			root = os.path.realpath(allowed)
+			if os.path.commonpath([path, root]) == root:
+				return True
+	return False
+
+
+def check_sources(sources, allowed_sources):
+	"""
+	Raises:
+		PermissionError: If any of sources is not within allowed_sources. Nothing is read in that case.
+	"""
+	denied = [source for source in sources if not is_allowed_source(source, allowed_sources)]
+	if denied:
+		raise PermissionError(f"Sources not allowed for ingestion (see INGESTION_ALLOWED_SOURCES): {denied}")
+
+#************************************************************************************************************
+# Knowledge base ingestion
+
+def iter_source_documents(sources, allowed_sources):
+	"""
+	Yield (source, text) for every file of sources: local files or directories, and s3://bucket/prefix URIs, all of
+	them within allowed_sources (see check_sources). Files are read one at a time; files which are not UTF-8 text,
+	and files of a directory which resolve outside allowed_sources (symlinks), are skipped.
+	"""
+	check_sources(sources, allowed_sources)
+	for source in sources:
+		if source.startswith("s3://"):
+			bucket, _, prefix = source[len("s3://"):].partition("/")
+			s3 = boto3.client("s3")
+			for page in s3.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=prefix):
+				for obj in page.get("Contents", []):
+					if obj["Key"].endswith("/"):
+						continue
+					uri = f"s3://{bucket}/{obj['Key']}"
+					try:
+						yield uri, s3.get_object(Bucket=bucket, Key=obj["Key"])["Body"].read().decode("utf-8")
+					except UnicodeDecodeError:
+						logger.warning(f"Skipping {uri}, not UTF-8 text")
+		else:
+			paths = [source] if os.path.isfile(source) else sorted(os.path.join(root, name) for root, _, names in os.walk(source) for name in names)
+			for path in paths:
+				if not is_allowed_source(path, allowed_sources):
+					logger.warning(f"Skipping {path}, it resolves outside the allowed sources")
+					continue
+				try:
+					with open(path, encoding="utf-8") as f:
+						yield path, f.read()
+				except UnicodeDecodeError:
+					logger.warning(f"Skipping {path}, not UTF-8 text")
+
+
+def iter_chunks(knowledge_base, documents, text_splitter):
+	"""Split (source, text) documents into chunks whose id is the md5 of the knowledge base, source and content."""
+	for source, text in documents:
+		for number, chunk in enumerate(text_splitter.split_text(text)):
+			yield {
+				"id": hashlib.md5(f"{knowledge_base}\x00{source}\x00{chunk}".encode("utf-8")).hexdigest(),
+				"text": chunk,
+				"metadata": {"source": source, "chunk": number},
+			}
+
+
+class KnowledgeBaseIngestion:
+	"""
+	Streaming ingestion of chunks into an OpenSearch vector index, in the document layout of OpenSearchVectorSearch
+	(vector_field, text, metadata).
+
+	Chunks are processed in batches of batch_size by at most max_concurrency workers, and at most 2 * max_concurrency
+	batches are in flight: reading the sources waits for the workers, so memory doesn't depend on the corpus size.
+	Each batch looks up which chunk ids are already indexed and only embeds and writes the new ones; ids are content
+	hashes, so an unchanged chunk is never embedded twice. Bulk writes retry rejected (429) documents with exponential
+	backoff. With prune, the chunks of the ingested sources which were not seen in this run are deleted afterwards.
+	"""
+	def __init__(self, client, index_name, embeddings, batch_size=64, max_concurrency=4, max_retries=5, prune=False):
+		self.client = client
+		self.index_name = index_name
+		self.embeddings = embeddings
+		self.batch_size = batch_size
+		self.max_concurrency = max_concurrency
+		self.max_retries = max_retries
+		self.prune = prune
+		self.run_id = uuid.uuid4().hex
+		self.stats = {"chunks": 0, "indexed": 0, "unchanged": 0, "failed": 0}
+		self.lock = threading.Lock()
+		self.index_exists = None
+
+	def has_index(self):
+		if not self.index_exists:
+			self.index_exists = self.client.indices.exists(index=self.index_name)
+		return self.index_exists
+
+	def ensure_index(self, dimension):
+		"""Create the index with the k-NN mapping of OpenSearchVectorSearch unless it exists."""
+		with self.lock:
+			if self.has_index():
+				return
+			self.client.indices.create(index=self.index_name, body={
+				"settings": {"index": {"knn": True, "knn.algo_param.ef_search": 512}},
+				"mappings": {"properties": {
+					"vector_field": {
+						"type": "knn_vector",
+						"dimension": dimension,
+						"method": {"name": "hnsw", "space_type": "l2", "engine": "nmslib", "parameters": {"ef_construction": 512, "m": 16}},
+					},
+					"metadata": {"properties": {"source": {"type": "keyword"}, "ingestion_run": {"type": "keyword"}}},
+				}},
+			})
+			self.index_exists = True
+
+	def embed(self, texts):
+		for attempt in range(self.max_retries + 1):
+			try:
+				return self.embeddings.embed_documents(texts)
+			except Exception:
+				if attempt == self.max_retries:
+					raise
+				time.sleep(min(2 ** attempt, 30))
+
+	def write(self, actions):
+		_, errors = bulk(self.client, actions, max_retries=self.max_retries, initial_backoff=1, max_backoff=30, raise_on_error=False)
+		return len(errors) if isinstance(errors, list) else errors
+
+	def process(self, chunks):
+		found = self.client.mget(index=self.index_name, body={"ids": [chunk["id"] for chunk in chunks]}, _source=False) if self.has_index() else {"docs": []}
+		existing = {doc["_id"] for doc in found["docs"] if doc.get("found")}
+		new_chunks = list({chunk["id"]: chunk for chunk in chunks if chunk["id"] not in existing}.values())
+
+		actions = []
+		if new_chunks:
+			vectors = self.embed([chunk["text"] for chunk in new_chunks])
+			self.ensure_index(len(vectors[0]))
+			for chunk, vector in zip(new_chunks, vectors):
+				actions.append({
+					"_op_type": "index",
+					"_index": self.index_name,
+					"_id": chunk["id"],
+					"vector_field": vector,
+					"text": chunk["text"],
+					"metadata": {**chunk["metadata"], "ingestion_run": self.run_id},
+				})
+		if self.prune:
+			# Unchanged chunks are only tagged with this run, so pruning keeps them
+			actions.extend(
+				{"_op_type": "update", "_index": self.index_name, "_id": chunk["id"], "doc": {"metadata": {**chunk["metadata"], "ingestion_run": self.run_id}}}
+				for chunk in chunks if chunk["id"] in existing
+			)
+		failed = self.write(actions) if actions else 0
+
+		with self.lock:
+			self.stats["chunks"] += len(chunks)
+			self.stats["indexed"] += len(new_chunks)
+			self.stats["unchanged"] += len(chunks) - len(new_chunks)
+			self.stats["failed"] += failed
+
+	def run(self, chunks):
+		"""Ingest the chunks (an iterable of dicts with id, text and metadata) and return the counts of this run."""
+		in_flight = threading.BoundedSemaphore(2 * self.max_concurrency)
+		sources = set()
+		errors = []
+
+		def done(future):
+			in_flight.release()
+			if future.exception() is not None:
+				errors.append(future.exception())
+
+		with ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix="palette-ingestion") as executor:
+			batch = []
+			for chunk in chunks:
+				if errors:
+					break
+				if self.prune:
+					sources.add(chunk["metadata"]["source"])
+				batch.append(chunk)
+				if len(batch) == self.batch_size:
+					in_flight.acquire()
+					executor.submit(self.process, batch).add_done_callback(done)
+					batch = []
+			if batch and not errors:
+				in_flight.acquire()
+				executor.submit(self.process, batch).add_done_callback(done)
+
+		if errors:
+			raise errors[0]
+		if self.prune and sources:
+			sources = sorted(sources)
+			for i in range(0, len(sources), 1000):
+				self.client.delete_by_query(index=self.index_name, body={"query": {"bool": {
+					"filter": [{"terms": {"metadata.source": sources[i:i + 1000]}}],
+					"must_not": [{"term": {"metadata.ingestion_run": self.run_id}}],
+				}}})
+		return self.stats
+
+
+def ingest_knowledge_base(client, index_name, embeddings, knowledge_base, sources, allowed_sources=None, chunk_size=1000, chunk_overlap=100, batch_size=64, max_concurrency=4, prune=False):
+	"""
+	Load, chunk, embed and index the sources (local paths or s3:// URIs) into index_name, creating it when needed
+	(see KnowledgeBaseIngestion). Unchanged chunks are skipped.
+
+	Args:
+		client: The OpenSearch client.
+		embeddings: Embeddings instance used for the chunks. Batches are large, so it should not have a per-query
+			deadline (e.g. the instance wrapped by DeadlineEmbeddings).
+		allowed_sources: Local directories and s3:// prefixes the sources must be within. Defaults to
+			get_allowed_sources().
+		prune: Delete the chunks of the sources which were not seen in this run.
+
+	Returns:
+		The counts of chunks, indexed, unchanged and failed chunks.
+
+	Raises:
+		PermissionError: If a source is not allowed.
+	"""
+	allowed_sources = get_allowed_sources() if allowed_sources is None else allowed_sources
+	check_sources(sources, allowed_sources)
+
+	text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+	ingestion = KnowledgeBaseIngestion(client, index_name, embeddings, batch_size=batch_size, max_concurrency=max_concurrency, prune=prune)
+	stats = ingestion.run(iter_chunks(knowledge_base, iter_source_documents(sources, allowed_sources), text_splitter))
+	logger.info(f"Ingestion of {knowledge_base} into {index_name}: {stats}")
+	return stats
@@ -1,11 +1,32 @@
 import os
+import atexit
+import re
 import json
+import logging
+import uuid
+import time
+import gzip
+import base64
+import copy
 import hashlib
+import sqlite3
+import tempfile
+import threading
+import queue
+import unicodedata
 import boto3
+import numpy as np
 
 from aws_lambda_powertools import Logger
+from botocore.config import Config
+from collections import OrderedDict, deque
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from fractions import Fraction
+from functools import lru_cache
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError, as_completed, wait
 from pydantic import BaseModel
-from typing import Any, Dict, List
+from typing import Any, Callable, ClassVar, Dict, List, Optional
 
 from genai_core.csdc.usecase import BaseUsecase
 from genai_core.csdc.websocket import CustomFinalOutputCallbackHandler
@@ -14,15 +35,25 @@ from genai_core.csdc.tools import AwsListEc2Instances, AwsShutdownAnEc2Instance,
 from genai_core.csdc.models import create_sagemaker_embeddings_from_js_model
 from genai_core.langchain.agents.structured_chat.prompt import FORMAT_INSTRUCTIONS, PREFIX, SUFFIX
 
-from langchain.agents import AgentType, initialize_agent, load_tools, Tool, StructuredChatAgent
+import langchain
+from langchain.agents import AgentType, load_tools, Tool, StructuredChatAgent
+from langchain.agents.agent import AgentExecutor, AgentOutputParser, ExceptionTool
+from langchain.agents.structured_chat.output_parser import StructuredChatOutputParser, StructuredChatOutputParserWithRetries
+from langchain.agents.tools import InvalidTool
 from langchain.agents.agent_toolkits import create_retriever_tool
+from langchain.cache import BaseCache
+from langchain.callbacks.base import BaseCallbackHandler
+from langchain.callbacks.manager import CallbackManagerForRetrieverRun
 from langchain.chains import LLMChain
 from langchain.chains.router import MultiPromptChain
 from langchain.chains.router.embedding_router import EmbeddingRouterChain
 from langchain.chains.router.llm_router import LLMRouterChain, RouterOutputParser
 from langchain.chains.router.multi_prompt_prompt import MULTI_PROMPT_ROUTER_TEMPLATE
 from langchain.embeddings import BedrockEmbeddings, OpenAIEmbeddings
+from langchain.load.dump import dumps
+from langchain.load.load import loads
 from langchain.memory import ConversationBufferWindowMemory
+from langchain.memory.prompt import SUMMARY_PROMPT
 from langchain.prompts import (
 	PromptTemplate,
 	ChatPromptTemplate,
@@ -30,20 +61,2169 @@ from langchain.prompts import (
 	SystemMessagePromptTemplate,
 	HumanMessagePromptTemplate,
 )
-from langchain.schema import AgentAction, Document
+from langchain.schema.embeddings import Embeddings
+from langchain.schema import AgentAction, AgentFinish, BaseChatMessageHistory, BaseRetriever, Document, OutputParserException, get_buffer_string
 from langchain.schema.messages import (
     BaseMessage,
+    SystemMessage,
     _message_to_dict,
     messages_from_dict,
     messages_to_dict,
 )
 from langchain.tools import YouTubeSearchTool
 from langchain.vectorstores import OpenSearchVectorSearch
+from langchain.vectorstores.utils import maximal_marginal_relevance
 
 from opensearchpy import RequestsHttpConnection
+from opensearchpy.helpers import scan
 
 logger = Logger()
 
+def debug_enabled():
+	"""True when DEBUG logging is enabled, e.g. with POWERTOOLS_LOG_LEVEL=DEBUG. Also drives verbose chains/agents."""
+	return logger.isEnabledFor(logging.DEBUG)
+
+def log_debug(render):
+	"""
+	Log render() at DEBUG level. render is a callable, so expensive renderings (full responses, .dict()/.json() dumps)
+	are only computed when DEBUG is enabled.
+	"""
+	if debug_enabled():
+		logger.debug(render())
+
+#************************************************************************************************************
+# Caches shared by the requests served in the same (warm) process
+
+class LRUCache:
+	"""
+	Thread-safe bounded LRU cache with optional JSON persistence.
+
+	When persist_path is set, the entries are loaded from that file at construction and written back (atomically)
+	by a timer persist_interval seconds after the first put() since the last write, and at interpreter exit. Writes
+	are thus batched and kept off the request path, and the cache survives cold starts as long as the path does
+	(e.g. a mounted EFS directory). Values must then be JSON serializable.
+	"""
+	def __init__(self, maxsize=1024, persist_path=None, persist_interval=30):
+		self.maxsize = maxsize
+		self.persist_path = persist_path
+		self.persist_interval = persist_interval
+		self.hits = 0
+		self.misses = 0
+		self._data = OrderedDict()
+		self._lock = threading.Lock()
+		self._save_timer = None
+		if persist_path:
+			self.load()
+			atexit.register(self.flush)
+
+	def get(self, key, default=None):
+		with self._lock:
+			if key in self._data:
+				self._data.move_to_end(key)
+				self.hits += 1
+				return self._data[key]
+			self.misses += 1
+			return default
+
+	def put(self, key, value):
+		with self._lock:
+			self._data[key] = value
+			self._data.move_to_end(key)
+			while len(self._data) > self.maxsize:
+				self._data.popitem(last=False)
+			if self.persist_path and self._save_timer is None:
+				self._save_timer = threading.Timer(self.persist_interval, self.flush)
+				self._save_timer.daemon = True
+				self._save_timer.start()
+
+	def __contains__(self, key):
+		with self._lock:
+			return key in self._data
+
+	def __len__(self):
+		return len(self._data)
+
+	def clear(self):
+		with self._lock:
+			self._data.clear()
+
+	def load(self):
+		try:
+			with open(self.persist_path, "r", encoding="utf-8") as f:
+				items = json.load(f)
+			with self._lock:
+				for key, value in items[-self.maxsize:]:
+					self._data[key] = value
+		except FileNotFoundError:
+			pass
+		except Exception as e:
+			logger.warning(f"Failed to load cache from {self.persist_path}. [Detailed Error Message]: {str(e)}")
+
+	def flush(self):
+		"""Write the pending changes now (no-op when nothing changed since the last write)."""
+		with self._lock:
+			timer, self._save_timer = self._save_timer, None
+		if timer is not None:
+			timer.cancel()
+			self.save()
+
+	def save(self):
+		try:
+			with self._lock:
+				items = list(self._data.items())
+			tmp_path = f"{self.persist_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+			with open(tmp_path, "w", encoding="utf-8") as f:
+				json.dump(items, f, ensure_ascii=False)
+			os.replace(tmp_path, self.persist_path)
+		except Exception as e:
+			logger.warning(f"Failed to save cache to {self.persist_path}. [Detailed Error Message]: {str(e)}")
+
+
+def normalize_question(question):
+	"""Normalize a question for cache keys: NFKC (full-width -> half-width), lower case, collapsed whitespace."""
+	question = unicodedata.normalize("NFKC", question).lower()
+	return " ".join(question.split()).strip(" .。!！?？")
+
+
+_route_caches = {}
+_route_caches_lock = threading.Lock()
+
+def get_route_cache(maxsize=1024, persist_path=None):
+	"""Return the process-wide route-decision cache for the given settings."""
+	key = (maxsize, persist_path)
+	with _route_caches_lock:
+		if key not in _route_caches:
+			_route_caches[key] = LRUCache(maxsize=maxsize, persist_path=persist_path)
+		return _route_caches[key]
+
+#**********************************************************************************************************************
+# Thread pools, shared by the warm invocations of this process. A task may wait on tasks of the pools below its own,
+# never on its own pool or one above it, so a busy pool can't starve (or deadlock) itself:
+#   background_executor       streamed agent runs, speculative preparation, write-behind history, autogen jobs
+#   tool_executor             concurrent tools of one agent step (ParallelToolAgentExecutor)
+#   embedding_batch_executor  micro-batches of the EmbeddingBatchers, which embed through call_with_deadline()
+#   endpoint_executor         endpoint calls with a deadline or hedge (call_with_deadline)
+#   local_embedding_executor  batches of LocalBGEEmbeddings, whose calls run on endpoint_executor
+# Image generation runs on a pool of its own per request (max_parallel_images), which waits on none of these.
+
+def make_executor(name, default_workers, thread_name_prefix):
+	"""Pool sized by the PALETTE_<name>_WORKERS environment variable."""
+	return ThreadPoolExecutor(max_workers=int(os.environ.get(f"PALETTE_{name}_WORKERS", str(default_workers))), thread_name_prefix=thread_name_prefix)
+
+background_executor = make_executor("BACKGROUND", 8, "palette")
+tool_executor = make_executor("TOOL", 8, "palette-tool")
+embedding_batch_executor = make_executor("EMBEDDING_BATCH", 8, "palette-embedding-batch")
+endpoint_executor = make_executor("ENDPOINT", 16, "palette-endpoint")
+local_embedding_executor = make_executor("LOCAL_EMBEDDING", os.cpu_count() or 2, "palette-local-embedding")
+
+
+class SpeculationCancelled(Exception):
+	"""Raised inside speculative work when its result is no longer needed."""
+
+#************************************************************************************************************
+# Chat history memory
+
+CJK_PATTERN = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af]")
+
+def estimate_tokens(text):
+	"""Cheap token estimate: one token per CJK character and about four characters per token otherwise."""
+	cjk = len(CJK_PATTERN.findall(text))
+	return cjk + (len(text) - cjk + 3) // 4
+
+
+# md5(type + content) -> token count, shared by all sessions of this process
+message_token_cache = LRUCache(maxsize=8192)
+
+# session id -> {"summary": str, "summarized": number of messages of the session covered by the summary}
+running_summaries = LRUCache(maxsize=1024)
+
+
+# (session id, user id) -> number of messages in the session, as last seen by this process
+session_history_lengths = LRUCache(maxsize=4096)
+
+
+class WindowedChatMessageHistory(BaseChatMessageHistory):
+	"""
+	Wrapper of the session store (the DynamoDB history of genai_core) with windowed reads and batched writes.
+
+	Reads: only the last `window` messages of a session are loaded (all of them if window is None). The history is
+	one item per session with a "History" list, so reads use a ProjectionExpression over the list indices of the
+	tail instead of fetching the whole list. The session length seen last by this process is used to compute those
+	indices; a few extra indices are requested so messages appended by other processes are detected, in which case
+	the whole list is read once. Only the messages of the window are decoded, once per request.
+
+	Writes: with batch_writes, add_message() and add_metadata() are buffered, and flush() appends the messages of the
+	turn, with the metadata attached to the last one, in a single UpdateItem (list_append) instead of one
+	read-modify-write per message and another one for the metadata.
+
+	All other attributes are delegated to the wrapped history.
+	"""
+	PREFETCH_SLACK = 4
+
+	def __init__(self, history, window=None, batch_writes=False, compress_threshold=None):
+		"""
+		Args:
+			history: The chat history of the session (self.chat_history of the usecase).
+			window: Number of most recent messages to read, or None for all of them.
+			batch_writes: Buffer writes until flush().
+			compress_threshold: If set, 'reasoning_acting_steps' metadata larger than this many bytes (as JSON) is
+				stored gzip+base64 encoded under 'reasoning_acting_steps_gzip' (see decompress_reasoning_steps).
+		"""
+		self.history = history
+		self.window = window
+		self.batch_writes = batch_writes
+		self.compress_threshold = compress_threshold
+		self._messages = None
+		self._offset = 0
+		self._pending = []
+
+	def __getattr__(self, name):
+		if name == "history":
+			raise AttributeError(name)
+		return getattr(self.history, name)
+
+	@property
+	def length_cache_key(self):
+		return f"{getattr(self.history, 'session_id', None)}\x00{getattr(self.history, 'user_id', None)}"
+
+	@property
+	def messages(self) -> List[BaseMessage]:
+		if self._messages is None:
+			self._offset = 0
+			if self.window is None:
+				self._messages = self.history.messages
+			elif self.window <= 0:
+				self._messages = []
+			elif getattr(self.history, "table", None) is None:
+				messages = self.history.messages
+				self._offset = max(0, len(messages) - self.window)
+				self._messages = messages[self._offset:]
+			else:
+				self._messages = messages_from_dict(self.read_tail())
+		return self._messages + self._pending
+
+	@property
+	def offset(self) -> int:
+		"""Position in the session of the first message of self.messages."""
+		self.messages
+		return self._offset
+
+	def read_tail(self):
+		"""Return the raw (undecoded) dicts of the last `window` messages."""
+		key = {"SessionId": self.history.session_id, "UserId": self.history.user_id}
+		cache_key = self.length_cache_key
+		length = session_history_lengths.get(cache_key)
+
+		if length is not None:
+			start = max(0, length - self.window)
+			end = length + self.PREFETCH_SLACK
+			response = self.history.table.get_item(
+				Key = key,
+				ProjectionExpression = ", ".join(f"#history[{i}]" for i in range(start, end)),
+				ExpressionAttributeNames = {"#history": "History"},
+			)
+			items = response.get("Item", {}).get("History", [])
+			# Fewer items than requested means we reached the end of the list. No items at all is ambiguous
+			# (e.g. the session was cleared), so read the whole list in that case.
+			if items and len(items) < end - start:
+				session_history_lengths.put(cache_key, start + len(items))
+				self._offset = max(start, start + len(items) - self.window)
+				return items[-self.window:]
+
+		response = self.history.table.get_item(
+			Key = key,
+			ProjectionExpression = "#history",
+			ExpressionAttributeNames = {"#history": "History"},
+		)
+		items = response.get("Item", {}).get("History", [])
+		session_history_lengths.put(cache_key, len(items))
+		self._offset = max(0, len(items) - self.window)
+		return items[-self.window:]
+
+	def add_message(self, message: BaseMessage) -> None:
+		if self.batch_writes:
+			self._pending.append(message)
+			return
+		self.history.add_message(message)
+		self._messages = None
+		self.bump_length(1)
+
+	def add_metadata(self, metadata: dict) -> None:
+		if self.batch_writes and self._pending:
+			# Same as the store does for the last stored message
+			self._pending[-1].additional_kwargs = metadata
+			return
+		self.history.add_metadata(metadata)
+		self._messages = None
+
+	def bump_length(self, count):
+		length = session_history_lengths.get(self.length_cache_key)
+		if length is not None:
+			session_history_lengths.put(self.length_cache_key, length + count)
+
+	def flush(self, write_behind=False):
+		"""
+		Write the buffered messages of this turn in one request.
+
+		Args:
+			write_behind: Write on background_executor instead of blocking the response. Note that a Lambda
+				environment may be frozen right after the response, which delays such writes until the next invocation.
+
+		Returns:
+			A Future if write_behind is set, otherwise None.
+		"""
+		if not self._pending:
+			return None
+		pending, self._pending = self._pending, []
+		items = [self.compress_message_dict(item) for item in messages_to_dict(pending)]
+
+		if write_behind:
+			future = background_executor.submit(self.write_messages, items)
+			future.add_done_callback(
+				lambda f: f.exception() and logger.error(f"Write-behind of the chat history failed. [Detailed Error Message]: {str(f.exception())}")
+			)
+			return future
+		self.write_messages(items)
+		return None
+
+	def write_messages(self, items):
+		table = getattr(self.history, "table", None)
+		if table is None:
+			for message in messages_from_dict(items):
+				self.history.add_message(message)
+		else:
+			table.update_item(
+				Key = {"SessionId": self.history.session_id, "UserId": self.history.user_id},
+				UpdateExpression = "SET #history = list_append(if_not_exists(#history, :empty), :messages), #start_time = :now",
+				ExpressionAttributeNames = {"#history": "History", "#start_time": "StartTime"},
+				ExpressionAttributeValues = {
+					":empty": [],
+					# DynamoDB doesn't accept float, e.g. the temperature in the metadata
+					":messages": json.loads(json.dumps(items, default=str), parse_float=Decimal),
+					":now": datetime.now().isoformat(),
+				},
+			)
+		self._messages = None
+		self.bump_length(len(items))
+
+	def compress_message_dict(self, item):
+		additional_kwargs = item.get("data", {}).get("additional_kwargs") or {}
+		if self.compress_threshold is None or "reasoning_acting_steps" not in additional_kwargs:
+			return item
+		raw = json.dumps(additional_kwargs["reasoning_acting_steps"], ensure_ascii=False).encode("utf-8")
+		if len(raw) <= self.compress_threshold:
+			return item
+		additional_kwargs = {key: value for key, value in additional_kwargs.items() if key != "reasoning_acting_steps"}
+		additional_kwargs["reasoning_acting_steps_gzip"] = base64.b64encode(gzip.compress(raw)).decode("ascii")
+		return dict(item, data=dict(item["data"], additional_kwargs=additional_kwargs))
+
+	def clear(self) -> None:
+		self.history.clear()
+		self._messages = None
+		self._pending = []
+		session_history_lengths.put(self.length_cache_key, 0)
+
+
+def decompress_reasoning_steps(metadata):
+	"""Return the reasoning_acting_steps of message metadata, decoding the compressed form if needed."""
+	if "reasoning_acting_steps_gzip" in metadata:
+		return json.loads(gzip.decompress(base64.b64decode(metadata["reasoning_acting_steps_gzip"])).decode("utf-8"))
+	return metadata.get("reasoning_acting_steps")
+
+
+class TokenBudgetWindowMemory(ConversationBufferWindowMemory):
+	"""
+	ConversationBufferWindowMemory which keeps only the most recent messages (of the last k turns) that fit into
+	max_token_limit tokens, so one long pasted message can't blow up the prompt.
+
+	Token counts are cached per message. If summary_llm is set, every message which is not kept, whether it doesn't
+	fit into the budget or has aged out of the window, is rolled up into a running summary per session. The summary
+	records how many messages of the session it covers, so it is extended incrementally with the messages after
+	those only. The messages which aged out since the last turn are read as extra messages before the window (see
+	PaletteUsecase.get_memory).
+	"""
+	max_token_limit: int = 2000
+	token_counter: Optional[Callable[[str], int]] = None
+	summary_llm: Optional[Any] = None
+	session_id: Optional[str] = None
+	last_history_tokens: int = 0
+
+	def count_message_tokens(self, message):
+		key = hashlib.md5(f"{message.type}\x00{message.content}".encode()).hexdigest()
+		tokens = message_token_cache.get(key)
+		if tokens is None:
+			tokens = (self.token_counter or estimate_tokens)(message.content)
+			message_token_cache.put(key, tokens)
+		return tokens
+
+	def select_messages(self):
+		"""Return (summary, messages) where messages are the most recent messages that fit into the budget."""
+		messages = self.chat_memory.messages
+		window_start = max(0, len(messages) - self.k * 2) if self.k > 0 else len(messages)
+		window = messages[window_start:]
+		budget = self.max_token_limit
+		kept, total = [], 0
+		for message in reversed(window):
+			tokens = self.count_message_tokens(message)
+			if total + tokens > budget:
+				break
+			kept.append(message)
+			total += tokens
+		kept.reverse()
+
+		summary = ""
+		if self.summary_llm is not None:
+			# Position in the session of the messages read, and of the first kept one
+			offset = getattr(self.chat_memory, "offset", 0)
+			summary = self.update_summary(messages, offset, offset + len(messages) - len(kept))
+		self.last_history_tokens = total + (estimate_tokens(summary) if summary else 0)
+		logger.info(f"TokenBudgetWindowMemory: {len(kept)}/{len(window)} messages kept, {self.last_history_tokens} history tokens (budget {budget})")
+		return summary, kept
+
+	def update_summary(self, messages, offset, summarize_until):
+		"""
+		Extend the running summary of the session with the messages before position summarize_until which it
+		doesn't cover yet. messages are the messages read, the first of them at position offset of the session.
+		"""
+		state = running_summaries.get(self.session_id) or {"summary": "", "summarized": 0}
+		if summarize_until <= state["summarized"]:
+			return state["summary"]
+
+		if state["summarized"] < offset:
+			logger.warning(f"TokenBudgetWindowMemory: messages {state['summarized']}-{offset} of session {self.session_id} were not read, so they are missing from its summary")
+		new_messages = messages[max(0, state["summarized"] - offset):summarize_until - offset]
+		if new_messages:
+			new_lines = get_buffer_string(new_messages, human_prefix=self.human_prefix, ai_prefix=self.ai_prefix)
+			summary = LLMChain(llm=self.summary_llm, prompt=SUMMARY_PROMPT).predict(summary=state["summary"], new_lines=new_lines)
+			state = {"summary": summary.strip(), "summarized": summarize_until}
+			running_summaries.put(self.session_id, state)
+		return state["summary"]
+
+	def load_memory_variables(self, inputs: Dict[str, Any]) -> Dict[str, Any]:
+		summary, messages = self.select_messages()
+		if self.return_messages:
+			buffer = ([SystemMessage(content=summary)] if summary else []) + messages
+		else:
+			buffer = get_buffer_string(messages, human_prefix=self.human_prefix, ai_prefix=self.ai_prefix)
+			if summary:
+				buffer = f"{summary}\n{buffer}"
+		return {self.memory_key: buffer}
+
+#************************************************************************************************************
+# LLM response cache
+
+class TieredLLMCache(BaseCache):
+	"""
+	Exact-match LLM response cache for langchain.llm_cache, with an in-memory LRU tier and an optional SQLite tier.
+
+	Entries are keyed by md5(llm_string + prompt), where llm_string holds the model and its parameters. Calls with a
+	temperature above 0, or whose temperature can't be found in llm_string, bypass the cache, because their answers
+	are not meant to repeat. SQLite connections are per thread, so the cache can be used concurrently. The SQLite
+	file must be on a local disk (see configure_llm_cache): its locking isn't reliable on network filesystems.
+	"""
+	TEMPERATURE_PATTERN = re.compile(r"""['"]temperature['"]\s*[:,]\s*([0-9.]+)""")
+
+	def __init__(self, maxsize=1024, path=None):
+		self.memory = LRUCache(maxsize=maxsize)
+		self.path = path
+		self.local = threading.local()
+		if path:
+			with self.connection() as connection:
+				connection.execute("CREATE TABLE IF NOT EXISTS llm_cache (key TEXT PRIMARY KEY, value TEXT)")
+
+	def connection(self):
+		connection = getattr(self.local, "connection", None)
+		if connection is None:
+			connection = sqlite3.connect(self.path, timeout=30)
+			connection.execute("PRAGMA journal_mode=WAL")
+			self.local.connection = connection
+		return connection
+
+	@classmethod
+	def is_deterministic(cls, llm_string):
+		match = cls.TEMPERATURE_PATTERN.search(llm_string)
+		return match is not None and float(match.group(1)) == 0
+
+	@staticmethod
+	def make_key(prompt, llm_string):
+		return hashlib.md5(f"{llm_string}\x00{prompt}".encode("utf-8")).hexdigest()
+
+	def lookup(self, prompt: str, llm_string: str) -> Optional[Any]:
+		if not self.is_deterministic(llm_string):
+			return None
+		key = self.make_key(prompt, llm_string)
+		generations = self.memory.get(key)
+		if generations is None and self.path:
+			row = self.connection().execute("SELECT value FROM llm_cache WHERE key = ?", (key,)).fetchone()
+			if row is not None:
+				generations = [loads(item) for item in json.loads(row[0])]
+				self.memory.put(key, generations)
+		return generations
+
+	def update(self, prompt: str, llm_string: str, return_val: Any) -> None:
+		if not self.is_deterministic(llm_string):
+			return
+		key = self.make_key(prompt, llm_string)
+		self.memory.put(key, return_val)
+		if self.path:
+			value = json.dumps([dumps(generation) for generation in return_val])
+			with self.connection() as connection:
+				connection.execute("INSERT OR REPLACE INTO llm_cache (key, value) VALUES (?, ?)", (key, value))
+
+	def clear(self, **kwargs: Any) -> None:
+		self.memory.clear()
+		if self.path:
+			with self.connection() as connection:
+				connection.execute("DELETE FROM llm_cache")
+
+
+def configure_llm_cache(enabled=True, maxsize=1024, path=None):
+	"""
+	Install (or remove) the process-wide TieredLLMCache as langchain.llm_cache. Reconfigured only on change.
+
+	The SQLite tier is only used for a path under the local temp directory (/tmp on Lambda). Other paths, e.g. a
+	mounted EFS directory shared by several containers, could corrupt the file, so they keep the in-memory tier only.
+	"""
+	temp_dir = os.path.realpath(tempfile.gettempdir())
+	if path and os.path.commonpath([os.path.realpath(path), temp_dir]) != temp_dir:
+		logger.warning(f"LLM cache path {path} is not under {temp_dir}, using the in-memory cache only")
+		path = None
+	current = langchain.llm_cache
+	if not enabled:
+		if isinstance(current, TieredLLMCache):
+			langchain.llm_cache = None
+		return None
+	if isinstance(current, TieredLLMCache) and current.memory.maxsize == maxsize and current.path == path:
+		return current
+	langchain.llm_cache = TieredLLMCache(maxsize=maxsize, path=path)
+	return langchain.llm_cache
+
+#************************************************************************************************************
+# Deadlines, request hedging and failover of the model endpoints
+
+class LatencyTracker:
+	"""Rolling window of the latencies (seconds) of one endpoint, used to derive the hedging delay."""
+	def __init__(self, window=200):
+		self.samples = deque(maxlen=window)
+		self.lock = threading.Lock()
+
+	def record(self, seconds):
+		with self.lock:
+			self.samples.append(seconds)
+
+	def percentile(self, q, min_samples=20):
+		"""The q-th percentile, or None until min_samples latencies have been recorded."""
+		with self.lock:
+			if len(self.samples) < min_samples:
+				return None
+			samples = sorted(self.samples)
+		return samples[min(len(samples) - 1, int(len(samples) * q / 100))]
+
+
+class CircuitBreaker:
+	"""
+	Open after max_failures consecutive failures, for cooldown seconds after the last one. Once the cooldown is over,
+	requests are let through again (half-open); the first success closes the breaker, a failure opens it again. The
+	thresholds are given by each is_open() check, so requests with different settings share the failure count of
+	the endpoint without changing each other's settings.
+	"""
+	def __init__(self):
+		self.failures = 0
+		self.failed_at = None
+		self.lock = threading.Lock()
+
+	def is_open(self, max_failures=3, cooldown=30):
+		with self.lock:
+			return self.failures >= max_failures and time.monotonic() - self.failed_at < cooldown
+
+	def record_success(self):
+		with self.lock:
+			self.failures = 0
+			self.failed_at = None
+
+	def record_failure(self):
+		with self.lock:
+			self.failures += 1
+			self.failed_at = time.monotonic()
+
+
+# endpoint name -> LatencyTracker / CircuitBreaker, shared by the requests of this process
+endpoint_latencies = {}
+endpoint_breakers = {}
+_endpoint_lock = threading.Lock()
+
+def get_endpoint_state(name):
+	with _endpoint_lock:
+		if name not in endpoint_latencies:
+			endpoint_latencies[name] = LatencyTracker()
+			endpoint_breakers[name] = CircuitBreaker()
+		return endpoint_latencies[name], endpoint_breakers[name]
+
+
+def call_with_deadline(name, fn, deadline=None, hedge=False, hedge_percentile=95):
+	"""
+	Call fn() on endpoint_executor and return its result, raising TimeoutError once deadline (seconds) has passed.
+	With hedge, a duplicate call is issued when the first one has not returned after the hedge_percentile latency
+	of the endpoint, and whichever finishes first wins. A call past its deadline can't be interrupted: it finishes
+	in the background and its result is dropped.
+	"""
+	latencies, breaker = get_endpoint_state(name)
+	hedge_after = latencies.percentile(hedge_percentile) if hedge else None
+	started = time.monotonic()
+
+	def timed():
+		result = fn()
+		latencies.record(time.monotonic() - started)
+		return result
+
+	futures = [endpoint_executor.submit(timed)]
+	if hedge_after is not None and (deadline is None or hedge_after < deadline):
+		done, _ = wait(futures, timeout=hedge_after)
+		if not done:
+			log_debug(lambda: f"Hedging the {name} call after {hedge_after:.3f}s")
+			futures.append(endpoint_executor.submit(fn))
+
+	remaining = None if deadline is None else max(0, deadline - (time.monotonic() - started))
+	errors = []
+	while futures:
+		done, pending = wait(futures, timeout=remaining, return_when=FIRST_COMPLETED)
+		if not done:
+			breaker.record_failure()
+			raise TimeoutError(f"The {name} call didn't finish within its {deadline}s deadline")
+		for future in done:
+			if future.exception() is None:
+				breaker.record_success()
+				return future.result()
+			errors.append(future.exception())
+		futures = list(pending)
+		remaining = None if deadline is None else max(0, deadline - (time.monotonic() - started))
+	breaker.record_failure()
+	raise errors[0]
+
+
+class EmbeddingBatcher:
+	"""
+	Collects the query texts submitted concurrently (e.g. by parallel tools or speculative retrieval) for up to
+	max_wait seconds or max_batch_size texts, and embeds them with one embed_batch(texts) call. submit() returns a
+	Future resolved with the vector of its own text. Identical texts of a batch are embedded once.
+
+	Batches are dispatched on embedding_batch_executor (at most max_in_flight at a time per batcher), so the next
+	batch is collected while one is in flight. Every future of a batch is resolved, with an exception if the batch
+	failed.
+	"""
+	def __init__(self, embed_batch, max_batch_size=32, max_wait=0.005, max_in_flight=4):
+		self.embed_batch = embed_batch
+		self.max_batch_size = max_batch_size
+		self.max_wait = max_wait
+		self.queue = queue.Queue()
+		self.in_flight = threading.BoundedSemaphore(max_in_flight)
+		self.worker = None
+		self.lock = threading.Lock()
+
+	def submit(self, text):
+		future = Future()
+		self.queue.put((text, future))
+		if self.worker is None:
+			with self.lock:
+				if self.worker is None:
+					self.worker = threading.Thread(target=self.collect, name="palette-embedding-batcher", daemon=True)
+					self.worker.start()
+		return future
+
+	def collect(self):
+		while True:
+			batch = [self.queue.get()]
+			collect_until = time.monotonic() + self.max_wait
+			while len(batch) < self.max_batch_size:
+				remaining = collect_until - time.monotonic()
+				if remaining <= 0:
+					break
+				try:
+					batch.append(self.queue.get(timeout=remaining))
+				except queue.Empty:
+					break
+			self.in_flight.acquire()
+			try:
+				embedding_batch_executor.submit(self.dispatch, batch)
+			except RuntimeError as e:
+				# The pool is shut down at interpreter exit
+				self.in_flight.release()
+				self.fail(batch, e)
+
+	def dispatch(self, batch):
+		texts = list(dict.fromkeys(text for text, _ in batch))
+		log_debug(lambda: f"Embedding batch of {len(texts)} texts for {len(batch)} requests")
+		error = None
+		try:
+			vectors = list(self.embed_batch(texts))
+			if len(vectors) != len(texts):
+				raise ValueError(f"Got {len(vectors)} embeddings for a batch of {len(texts)} texts")
+			vectors = dict(zip(texts, vectors))
+			for text, future in batch:
+				future.set_result(vectors[text])
+		except Exception as e:
+			error = e
+		finally:
+			self.in_flight.release()
+			self.fail(batch, error or RuntimeError("The embedding batch was interrupted"))
+
+	@staticmethod
+	def fail(batch, error):
+		"""Resolve the futures of the batch which are still pending with error."""
+		for _, future in batch:
+			if not future.done():
+				future.set_exception(error)
+
+
+class DeadlineEmbeddings(Embeddings):
+	"""
+	Embeddings wrapper applying call_with_deadline() to every call of the wrapped instance. Failures and timeouts
+	count against the circuit breaker of the embedding model, which get_embeddings_and_index_name_multi() checks to
+	fail over to another model (and its indices). With a batcher, queries are micro-batched into embed_documents().
+	"""
+	def __init__(self, embeddings, name, deadline=None, hedge=False, batcher=None):
+		self.embeddings = embeddings
+		self.name = name
+		self.deadline = deadline
+		self.hedge = hedge
+		self.batcher = batcher
+
+	def embed_documents(self, texts: List[str]) -> List[List[float]]:
+		return call_with_deadline(self.name, lambda: self.embeddings.embed_documents(texts), deadline=self.deadline, hedge=self.hedge)
+
+	def embed_queries(self, texts: List[str]) -> List[List[float]]:
+		"""
+		Embed several queries in one call: embed_queries() of the wrapped instance if it has one (e.g. to add a query
+		instruction), otherwise embed_documents().
+		"""
+		embed = getattr(self.embeddings, "embed_queries", self.embeddings.embed_documents)
+		return call_with_deadline(self.name, lambda: embed(texts), deadline=self.deadline, hedge=self.hedge)
+
+	def embed_query(self, text: str) -> List[float]:
+		if self.batcher is not None:
+			# The batch call is bounded by the deadline once dispatched; the wait also covers its collection
+			timeout = None if self.deadline is None else self.deadline + self.batcher.max_wait
+			try:
+				return self.batcher.submit(text).result(timeout=timeout)
+			except FutureTimeoutError:
+				raise TimeoutError(f"The {self.name} call didn't finish within its {self.deadline}s deadline")
+		return call_with_deadline(self.name, lambda: self.embeddings.embed_query(text), deadline=self.deadline, hedge=self.hedge)
+
+
+@lru_cache(maxsize=8)
+def get_bedrock_runtime_client(region_name, read_timeout):
+	return boto3.client(
+		'bedrock-runtime',
+		region_name = region_name,
+		config = Config(connect_timeout=10, read_timeout=read_timeout, retries={"max_attempts": 2, "mode": "standard"}),
+	)
+
+#************************************************************************************************************
+# Local CPU embeddings (ONNX Runtime)
+
+@lru_cache(maxsize=2)
+def load_local_embedding_model(model_dir, intra_op_threads, max_length):
+	"""
+	Load the ONNX export of a BGE model (model.onnx and tokenizer.json in model_dir) once per process. onnxruntime and
+	tokenizers are only needed when the local backend is used (see requirements-local-embeddings.txt), so they are
+	imported here.
+	"""
+	import onnxruntime
+	from tokenizers import Tokenizer
+
+	options = onnxruntime.SessionOptions()
+	options.intra_op_num_threads = intra_op_threads
+	session = onnxruntime.InferenceSession(os.path.join(model_dir, "model.onnx"), sess_options=options, providers=["CPUExecutionProvider"])
+	tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+	tokenizer.enable_truncation(max_length=max_length)
+	tokenizer.enable_padding()
+	return session, tokenizer
+
+
+class LocalBGEEmbeddings(Embeddings):
+	"""
+	BGE embeddings computed in process on CPU with ONNX Runtime: CLS pooling followed by L2 normalization, as done by
+	the BGE models. Texts are embedded in batches of batch_size, and the batches run in parallel on
+	local_embedding_executor (InferenceSession.run releases the GIL and is thread-safe). Queries are prefixed with
+	query_instruction, also when they are embedded in batches (embed_queries).
+	"""
+	def __init__(self, model_dir, batch_size=16, intra_op_threads=1, max_length=512, query_instruction=""):
+		self.session, self.tokenizer = load_local_embedding_model(model_dir, intra_op_threads, max_length)
+		self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+		self.batch_size = batch_size
+		self.query_instruction = query_instruction
+
+	def embed_batch(self, texts):
+		encodings = self.tokenizer.encode_batch(texts)
+		inputs = {
+			"input_ids": np.array([encoding.ids for encoding in encodings], dtype=np.int64),
+			"attention_mask": np.array([encoding.attention_mask for encoding in encodings], dtype=np.int64),
+			"token_type_ids": np.array([encoding.type_ids for encoding in encodings], dtype=np.int64),
+		}
+		last_hidden_state = self.session.run(None, {name: value for name, value in inputs.items() if name in self.input_names})[0]
+		vectors = last_hidden_state[:, 0]
+		vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+		return vectors.tolist()
+
+	def embed_documents(self, texts: List[str]) -> List[List[float]]:
+		batches = [texts[i:i + self.batch_size] for i in range(0, len(texts), self.batch_size)]
+		if len(batches) == 1:
+			return self.embed_batch(batches[0])
+		return [vector for vectors in local_embedding_executor.map(self.embed_batch, batches) for vector in vectors]
+
+	def embed_queries(self, texts: List[str]) -> List[List[float]]:
+		return self.embed_documents([self.query_instruction + text for text in texts])
+
+	def embed_query(self, text: str) -> List[float]:
+		return self.embed_queries([text])[0]
+
+#************************************************************************************************************
+# In-process snapshots of small vector indices
+
+class VectorIndexSnapshot:
+	"""
+	Local copy of an OpenSearch vector index: a float32 matrix (vectors.npy, memory-mapped), the squared norms of its
+	rows (norms.npy) and the ids and documents of the rows (documents.json), under directory/index_name.
+
+	refresh() updates the copy incrementally: only the documents whose _id is new are fetched, and the rows of the
+	deleted ones are dropped. A document updated in place under the same _id is not picked up, which is fine for the
+	ingestion pipeline since its ids are content hashes. Searches rank by L2 distance like the OpenSearch k-NN
+	queries of OpenSearchVectorSearch.
+	"""
+	def __init__(self, index_name, directory):
+		self.index_name = index_name
+		self.directory = os.path.join(directory, index_name)
+		self.state = None 	# (ids, documents, vectors, norms), swapped as a whole so searches see a consistent state
+		self.refreshed_at = 0
+		self.refreshing = False
+		self.lock = threading.Lock()
+
+	def load(self):
+		"""Load the snapshot saved on disk (e.g. by a previous invocation of this container). Returns True if found."""
+		try:
+			with open(os.path.join(self.directory, "documents.json"), encoding="utf-8") as f:
+				saved = json.load(f)
+			vectors = np.load(os.path.join(self.directory, "vectors.npy"), mmap_mode="r")
+			norms = np.load(os.path.join(self.directory, "norms.npy"))
+		except (OSError, ValueError):
+			return False
+		if not (len(saved["ids"]) == len(saved["documents"]) == vectors.shape[0] == norms.shape[0]):
+			return False
+		self.state = (saved["ids"], saved["documents"], vectors, norms)
+		self.refreshed_at = saved["refreshed_at"]
+		return True
+
+	def save(self, ids, documents, vectors):
+		os.makedirs(self.directory, exist_ok=True)
+		refreshed_at = time.time()
+		# Each file is replaced atomically; load() discards a mix of old and new files by checking the row counts
+		for name, value in (("vectors.npy", vectors), ("norms.npy", np.einsum("ij,ij->i", vectors, vectors))):
+			with open(os.path.join(self.directory, name + ".tmp"), "wb") as f:
+				np.save(f, value)
+			os.replace(os.path.join(self.directory, name + ".tmp"), os.path.join(self.directory, name))
+		with open(os.path.join(self.directory, "documents.json.tmp"), "w", encoding="utf-8") as f:
+			json.dump({"ids": ids, "documents": documents, "refreshed_at": refreshed_at}, f, ensure_ascii=False)
+		os.replace(os.path.join(self.directory, "documents.json.tmp"), os.path.join(self.directory, "documents.json"))
+		self.load()
+
+	def refresh(self, client, max_docs, vector_field="vector_field", text_field="text", batch_size=500):
+		"""
+		Bring the snapshot up to date with the index. Returns False, leaving the snapshot untouched, when the index
+		holds more than max_docs documents.
+		"""
+		if client.count(index=self.index_name)["count"] > max_docs:
+			return False
+		remote_ids = [hit["_id"] for hit in scan(client, index=self.index_name, query={"_source": False}, size=batch_size)]
+		ids, documents, vectors, _ = self.state or ([], [], np.zeros((0, 0), dtype=np.float32), None)
+		rows = {doc_id: row for row, doc_id in enumerate(ids)}
+		kept = [doc_id for doc_id in remote_ids if doc_id in rows]
+		added = [doc_id for doc_id in remote_ids if doc_id not in rows]
+
+		new_documents, new_vectors = [], []
+		for i in range(0, len(added), batch_size):
+			response = client.mget(index=self.index_name, body={"ids": added[i:i + batch_size]}, _source_includes=[vector_field, text_field, "metadata"])
+			for doc in response["docs"]:
+				source = doc["_source"]
+				new_documents.append({"page_content": source.get(text_field, ""), "metadata": source.get("metadata", {})})
+				new_vectors.append(source[vector_field])
+
+		if not added and len(kept) == len(ids):
+			self.refreshed_at = time.time()
+			return True
+
+		kept_rows = [rows[doc_id] for doc_id in kept]
+		parts = [np.asarray(vectors[kept_rows], dtype=np.float32)] if kept_rows else []
+		if new_vectors:
+			parts.append(np.asarray(new_vectors, dtype=np.float32))
+		self.save(
+			kept + added,
+			[documents[row] for row in kept_rows] + new_documents,
+			np.vstack(parts) if parts else np.zeros((0, 0), dtype=np.float32),
+		)
+		log_debug(lambda: f"Snapshot of {self.index_name} refreshed: {len(added)} added, {len(ids) - len(kept)} removed")
+		return True
+
+	def search(self, query_vector, k):
+		"""
+		Return the k nearest documents of query_vector as (Document, L2 distance) pairs, nearest first, or None when
+		the snapshot has no state (e.g. a refresh found the index too large), in which case OpenSearch must be used.
+		"""
+		state = self.state
+		if state is None:
+			return None
+		ids, documents, vectors, norms = state
+		if not ids:
+			return []
+		query = np.asarray(query_vector, dtype=np.float32)
+		distances = norms - 2 * (vectors @ query) + float(query @ query)
+		k = min(k, len(ids))
+		top = np.argpartition(distances, k - 1)[:k]
+		top = top[np.argsort(distances[top])]
+		return [(Document(**documents[row]), float(distances[row])) for row in top]
+
+
+class SnapshotRetriever(BaseRetriever):
+	"""
+	Retriever answering from a VectorIndexSnapshot, a drop-in replacement of the OpenSearch similarity retriever. The
+	snapshot may be dropped by a background refresh while the retriever is in use; the queries are then answered by
+	fallback, the OpenSearch retriever.
+	"""
+	snapshot: Any
+	embeddings: Any
+	fallback: Any
+	k: int = 3
+
+	def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+		results = None
+		if self.snapshot.state is not None:
+			results = self.snapshot.search(self.embeddings.embed_query(query), self.k)
+		if results is None:
+			return self.fallback.get_relevant_documents(query, callbacks=run_manager.get_child())
+		return [document for document, _ in results]
+
+
+class HybridRetriever(BaseRetriever):
+	"""
+	Lexical (BM25 on the text field) and k-NN search of one index in a single _msearch request. The two rankings are
+	merged with weighted reciprocal rank fusion, since BM25 and k-NN scores are not on the same scale. With mmr, the
+	fetch_k fused candidates are diversified with maximal marginal relevance down to k.
+	"""
+	client: Any
+	index_name: str
+	embeddings: Any
+	k: int = 3
+	fetch_k: int = 20
+	lexical_weight: float = 1.0
+	vector_weight: float = 1.0
+	mmr: bool = False
+	lambda_mult: float = 0.5
+	text_field: str = "text"
+	vector_field: str = "vector_field"
+
+	RRF_K: ClassVar[int] = 60
+
+	def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+		query_vector = self.embeddings.embed_query(query)
+		source = [self.text_field, "metadata"] + ([self.vector_field] if self.mmr else [])
+		header = {"index": self.index_name}
+		response = self.client.msearch(body=[
+			header, {"size": self.fetch_k, "_source": source, "query": {"match": {self.text_field: query}}},
+			header, {"size": self.fetch_k, "_source": source, "query": {"knn": {self.vector_field: {"vector": query_vector, "k": self.fetch_k}}}},
+		])
+
+		scores, hits = {}, {}
+		for weight, result in zip((self.lexical_weight, self.vector_weight), response["responses"]):
+			if "error" in result:
+				logger.warning(f"Hybrid search of {self.index_name} failed partly. [Detailed Error Message]: {result['error']}")
+				continue
+			for rank, hit in enumerate(result["hits"]["hits"]):
+				scores[hit["_id"]] = scores.get(hit["_id"], 0) + weight / (self.RRF_K + rank + 1)
+				hits[hit["_id"]] = hit
+		ranked = sorted(scores, key=scores.get, reverse=True)[:self.fetch_k]
+
+		if self.mmr and len(ranked) > self.k:
+			selected = maximal_marginal_relevance(
+				np.array(query_vector, dtype=np.float32),
+				[hits[doc_id]["_source"][self.vector_field] for doc_id in ranked],
+				lambda_mult = self.lambda_mult,
+				k = self.k,
+			)
+			ranked = [ranked[i] for i in selected]
+		return [Document(page_content=hits[doc_id]["_source"].get(self.text_field, ""), metadata=hits[doc_id]["_source"].get("metadata", {})) for doc_id in ranked[:self.k]]
+
+
+class CachedRetriever(BaseRetriever):
+	"""
+	Deduplicates identical lookups of one index: results are kept in cache (a dict, e.g. one per agent run) under the
+	md5 of the index name and the whitespace-normalized query.
+	"""
+	retriever: Any
+	index_name: str
+	cache: Any
+
+	def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+		key = hashlib.md5(f"{self.index_name}\x00{' '.join(query.split())}".encode("utf-8")).hexdigest()
+		documents = self.cache.get(key)
+		if documents is None:
+			documents = self.retriever.get_relevant_documents(query, callbacks=run_manager.get_child())
+			self.cache[key] = documents
+		else:
+			log_debug(lambda: f"Retrieval cache hit for {self.index_name}: {query}")
+		return documents
+
+
+# index name -> VectorIndexSnapshot, shared by the requests of this process
+vector_snapshots = {}
+_vector_snapshots_lock = threading.Lock()
+
+def get_vector_snapshot(index_name, client, directory, max_docs, max_age):
+	"""
+	Return the up-to-date (or being refreshed) snapshot of index_name, or None when the index is too large for a
+	snapshot (or none could be built), in which case the caller keeps using OpenSearch. The first snapshot of an
+	index is built synchronously; afterwards, snapshots older than max_age seconds are refreshed in the background.
+	"""
+	with _vector_snapshots_lock:
+		snapshot = vector_snapshots.get(index_name)
+		if snapshot is None:
+			snapshot = vector_snapshots[index_name] = VectorIndexSnapshot(index_name, directory)
+			snapshot.load()
+
+	if snapshot.state is None:
+		with snapshot.lock:
+			if snapshot.state is None and time.time() - snapshot.refreshed_at > max_age:
+				try:
+					if not snapshot.refresh(client, max_docs):
+						snapshot.refreshed_at = time.time()		# Too large; checked again after max_age
+				except Exception as e:
+					snapshot.refreshed_at = time.time()
+					logger.warning(f"Snapshot of {index_name} failed, using OpenSearch. [Detailed Error Message]: {str(e)}")
+		return snapshot if snapshot.state is not None else None
+
+	if time.time() - snapshot.refreshed_at > max_age:
+		with snapshot.lock:
+			if snapshot.refreshing:
+				return snapshot
+			snapshot.refreshing = True
+
+		def refresh():
+			try:
+				if not snapshot.refresh(client, max_docs):
+					snapshot.state = None 	# Grew too large; back to OpenSearch (see SnapshotRetriever)
+					snapshot.refreshed_at = time.time()
+			except Exception as e:
+				logger.warning(f"Refresh of the snapshot of {index_name} failed. [Detailed Error Message]: {str(e)}")
+			finally:
+				snapshot.refreshing = False
+		background_executor.submit(refresh)
+	return snapshot
+
+#************************************************************************************************************
+# Streaming
+
+class QueueCallbackHandler(BaseCallbackHandler):
+	"""
+	Callback handler which puts streamed events into a queue.Queue, to be consumed by another thread.
+
+	Events are (type, content) tuples: ("token", str) for LLM tokens, and for agents ("agent_action", dict) as soon as
+	the agent decides on a tool and ("agent_observation", dict) as soon as the tool returns. LangChain passes tool
+	results to callbacks as strings, so these events are for display only: the 'reasoning_acting_steps' metadata is
+	serialized from the raw intermediate steps of the agent response (see finish_agent_with_tools).
+	"""
+	def __init__(self, event_queue, stream_tokens=True):
+		self.event_queue = event_queue
+		self.stream_tokens = stream_tokens
+		self.step = 0
+		self.pending_steps = []		# (step, tool) of the actions whose tool hasn't started yet, in order
+		self.tool_runs = {}
+		self.lock = threading.Lock()
+
+	def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+		if token and self.stream_tokens:
+			self.event_queue.put(("token", token))
+
+	def on_agent_action(self, action: AgentAction, **kwargs: Any) -> Any:
+		with self.lock:
+			self.step += 1
+			content = {
+				"step": self.step,
+				"tool": action.tool,
+				"tool_input": action.tool_input,
+				"log": action.log,
+				"type": action.type,
+			}
+			self.pending_steps.append((self.step, action.tool))
+		self.event_queue.put(("agent_action", content))
+
+	def on_tool_start(self, serialized: Dict[str, Any], input_str: str, **kwargs: Any) -> Any:
+		# The actions of one step are all announced before their tools start, and the tools may run concurrently
+		# (ParallelToolAgentExecutor), so a tool run is matched to the first pending action of the same tool and
+		# told apart from the others by run_id.
+		name = serialized.get("name")
+		with self.lock:
+			if not self.pending_steps:
+				self.tool_runs[kwargs.get("run_id")] = (self.step, name)
+				return
+			index = next((i for i, (_, tool) in enumerate(self.pending_steps) if tool == name), 0)
+			self.tool_runs[kwargs.get("run_id")] = self.pending_steps.pop(index)
+
+	def on_tool_end(self, output: str, **kwargs: Any) -> Any:
+		with self.lock:
+			step, tool = self.tool_runs.pop(kwargs.get("run_id"), (self.step, None))
+		self.event_queue.put(("agent_observation", {"step": step, "tool": tool, "result": output}))
+
+	def on_tool_error(self, error: BaseException, **kwargs: Any) -> Any:
+		with self.lock:
+			step, tool = self.tool_runs.pop(kwargs.get("run_id"), (self.step, None))
+		self.event_queue.put(("agent_observation", {"step": step, "tool": tool, "error": str(error)}))
+
+
+_STREAM_END = object()
+
+def iterate_in_background(run, event_queue):
+	"""
+	Call run() on background_executor and yield the events it puts into event_queue as they arrive.
+
+	Returns (as the generator return value) the result of run(). Exceptions raised by run() are re-raised in the
+	consuming thread.
+	"""
+	def target():
+		try:
+			return run()
+		finally:
+			event_queue.put(_STREAM_END)
+
+	future = background_executor.submit(target)
+	while True:
+		event = event_queue.get()
+		if event is _STREAM_END:
+			break
+		yield event
+	return future.result()
+
+
+def measure_time_to_first_token(events):
+	"""
+	Consume a stream of events (e.g. PaletteUsecase.chatbot_stream()) and return its latency profile.
+
+	Returns:
+		A dict with 'ttft_ms' (time to the first token event), 'total_ms', 'tokens' and the final 'response'.
+	"""
+	start = time.perf_counter()
+	ttft_ms, tokens, response = None, 0, None
+	for event in events:
+		if event["type"] == "token":
+			tokens += 1
+			if ttft_ms is None:
+				ttft_ms = (time.perf_counter() - start) * 1000
+		else:
+			response = event
+	return {"ttft_ms": ttft_ms, "total_ms": (time.perf_counter() - start) * 1000, "tokens": tokens, "response": response}
+
+#************************************************************************************************************
+# Agent execution budget and tracing
+
+class AgentTraceCallbackHandler(BaseCallbackHandler):
+	"""
+	Records the LLM latency, tool latency and prompt size of every agent step, and enforces a token budget.
+
+	One structured record per step is logged (and kept in self.records) as soon as the step ends. When the tokens
+	used by the run exceed max_tokens, the executor's max_iterations is lowered so that AgentExecutor stops before
+	the next step and returns its early-stopping answer. The tools of a step may run concurrently (see
+	ParallelToolAgentExecutor), so the state of the step is only changed under self.lock.
+	"""
+	def __init__(self, executor=None, max_tokens=None, run_name="agent"):
+		self.executor = executor
+		self.max_tokens = max_tokens
+		self.run_name = run_name
+		self.run_id = uuid.uuid4().hex
+		self.records = []
+		self.total_tokens = 0
+		self.budget_exhausted = False
+		self.start = time.perf_counter()
+		self.lock = threading.RLock()
+		self.reset_step()
+
+	def reset_step(self):
+		self.step = {"llm_latency_ms": 0.0, "llm_calls": 0, "prompt_tokens": 0, "completion_tokens": 0}
+		self.llm_starts = {}
+		self.tool_starts = {}
+		self.pending_tools = 0
+
+	def on_llm_start(self, serialized: Dict[str, Any], prompts: List[str], **kwargs: Any) -> Any:
+		with self.lock:
+			self.llm_starts[kwargs.get("run_id")] = time.perf_counter()
+			self.step["prompt_tokens"] += sum(estimate_tokens(prompt) for prompt in prompts)
+
+	def on_llm_end(self, response: Any, **kwargs: Any) -> Any:
+		with self.lock:
+			start = self.llm_starts.pop(kwargs.get("run_id"), None)
+			if start is not None:
+				self.step["llm_latency_ms"] += (time.perf_counter() - start) * 1000
+			self.step["llm_calls"] += 1
+			token_usage = (getattr(response, "llm_output", None) or {}).get("token_usage") or {}
+			if token_usage.get("prompt_tokens"):
+				self.step["prompt_tokens"] = token_usage["prompt_tokens"]
+			self.step["completion_tokens"] += token_usage.get("completion_tokens") or sum(
+				estimate_tokens(generation.text) for generations in response.generations for generation in generations
+			)
+
+	def on_agent_action(self, action: AgentAction, **kwargs: Any) -> Any:
+		# A step may contain several actions (ParallelToolAgentExecutor); the step ends when all of its tools did
+		with self.lock:
+			self.step.setdefault("tools", []).append(action.tool)
+			self.step["tool_latency_ms"] = 0.0
+			self.pending_tools += 1
+
+	def on_tool_start(self, serialized: Dict[str, Any], input_str: str, **kwargs: Any) -> Any:
+		with self.lock:
+			self.tool_starts[kwargs.get("run_id")] = time.perf_counter()
+
+	def on_tool_end(self, output: str, **kwargs: Any) -> Any:
+		with self.lock:
+			start = self.tool_starts.pop(kwargs.get("run_id"), None)
+			if start is not None:
+				# Wall-clock time of the slowest tool of the step
+				self.step["tool_latency_ms"] = max(self.step["tool_latency_ms"], (time.perf_counter() - start) * 1000)
+			self.pending_tools -= 1
+			if self.pending_tools <= 0:
+				self.emit()
+
+	def on_tool_error(self, error: BaseException, **kwargs: Any) -> Any:
+		with self.lock:
+			self.step.setdefault("tool_errors", []).append(str(error))
+			self.on_tool_end("", **kwargs)
+
+	def on_agent_finish(self, finish: Any, **kwargs: Any) -> Any:
+		with self.lock:
+			self.emit()
+
+	def emit(self):
+		record = dict(
+			self.step,
+			run_id = self.run_id,
+			run_name = self.run_name,
+			step = len(self.records) + 1,
+			elapsed_ms = (time.perf_counter() - self.start) * 1000,
+		)
+		for key in ("llm_latency_ms", "tool_latency_ms", "elapsed_ms"):
+			if key in record:
+				record[key] = round(record[key], 2)
+		self.records.append(record)
+		self.total_tokens += record["prompt_tokens"] + record["completion_tokens"]
+		logger.info("agent_step", extra={"agent_step": record})
+
+		if self.max_tokens is not None and not self.budget_exhausted and self.total_tokens >= self.max_tokens:
+			self.budget_exhausted = True
+			logger.warning(f"Agent run {self.run_id} used {self.total_tokens} tokens (budget {self.max_tokens}), stopping early")
+			if self.executor is not None:
+				self.executor.max_iterations = 0
+		self.reset_step()
+
+	def summary(self):
+		return {
+			"run_id": self.run_id,
+			"steps": len(self.records),
+			"total_tokens": self.total_tokens,
+			"llm_latency_ms": round(sum(record["llm_latency_ms"] for record in self.records), 2),
+			"tool_latency_ms": round(sum(record.get("tool_latency_ms", 0.0) for record in self.records), 2),
+			"elapsed_ms": round((time.perf_counter() - self.start) * 1000, 2),
+			"budget_exhausted": self.budget_exhausted,
+		}
+
+#************************************************************************************************************
+# Parallel tool execution
+
+MULTI_ACTION_INSTRUCTIONS = """
+
+When you need several tools whose inputs do not depend on each other's results (for example today's date and a knowledge base lookup), you may put a JSON list of action objects in the code block instead of a single object. All of them are executed at the same time and you get all observations back together. Only use a list for independent actions, and never put "Final Answer" in a list."""
+
+
+class MultiActionStructuredChatOutputParser(AgentOutputParser):
+	"""
+	Output parser of the structured chat agent which also accepts a JSON list of actions in the $JSON_BLOB.
+
+	Single actions and final answers are parsed by the standard StructuredChatOutputParser. Like that one, it is
+	wrapped in StructuredChatOutputParserWithRetries, so unparsable output is sent to the LLM to be fixed.
+	"""
+	def get_format_instructions(self) -> str:
+		return FORMAT_INSTRUCTIONS + MULTI_ACTION_INSTRUCTIONS
+
+	def parse(self, text: str) -> Any:
+		match = re.search(r"```(?:json)?(.*?)```", text, re.DOTALL)
+		if match:
+			try:
+				parsed = json.loads(match.group(1).strip(), strict=False)
+			except json.JSONDecodeError:
+				parsed = None
+			if isinstance(parsed, list) and parsed and all(isinstance(item, dict) and "action" in item for item in parsed):
+				actions = [item for item in parsed if item["action"] != "Final Answer"] or parsed[:1]
+				if len(actions) > 1:
+					# Only the first action carries the LLM output, so the scratchpad doesn't repeat it for each action
+					return [
+						AgentAction(item["action"], item.get("action_input", {}), text if i == 0 else "")
+						for i, item in enumerate(actions)
+					]
+				text = text[:match.start()] + f"```json\n{json.dumps(actions[0], ensure_ascii=False)}\n```" + text[match.end():]
+		return StructuredChatOutputParser().parse(text)
+
+	@property
+	def _type(self) -> str:
+		return "multi_action_structured_chat"
+
+
+class ParallelToolAgentExecutor(AgentExecutor):
+	"""
+	AgentExecutor which runs the actions of one step concurrently on tool_executor when the agent returns several
+	independent actions (see MultiActionStructuredChatOutputParser), so all observations come back after one LLM
+	round trip. Everything else behaves like AgentExecutor._take_next_step.
+	"""
+	def _take_next_step(self, name_to_tool_map, color_mapping, inputs, intermediate_steps, run_manager=None):
+		try:
+			intermediate_steps = self._prepare_intermediate_steps(intermediate_steps)
+			output = self.agent.plan(
+				intermediate_steps,
+				callbacks = run_manager.get_child() if run_manager else None,
+				**inputs,
+			)
+		except OutputParserException as e:
+			if self.handle_parsing_errors is False:
+				raise ValueError(f"An output parsing error occurred. This is the error: {str(e)}")
+			text = str(e)
+			if self.handle_parsing_errors is True:
+				if e.send_to_llm:
+					observation = str(e.observation)
+					text = str(e.llm_output)
+				else:
+					observation = "Invalid or incomplete response"
+			elif isinstance(self.handle_parsing_errors, str):
+				observation = self.handle_parsing_errors
+			else:
+				observation = self.handle_parsing_errors(e)
+			output = AgentAction("_Exception", observation, text)
+			if run_manager:
+				run_manager.on_agent_action(output, color="green")
+			observation = ExceptionTool().run(
+				output.tool_input,
+				verbose = self.verbose,
+				color = None,
+				callbacks = run_manager.get_child() if run_manager else None,
+				**self.agent.tool_run_logging_kwargs(),
+			)
+			return [(output, observation)]
+
+		if isinstance(output, AgentFinish):
+			return output
+		actions = [output] if isinstance(output, AgentAction) else output
+
+		for agent_action in actions:
+			if run_manager:
+				run_manager.on_agent_action(agent_action, color="green")
+
+		if len(actions) == 1:
+			return [(actions[0], self.run_tool(actions[0], name_to_tool_map, color_mapping, run_manager))]
+		futures = [
+			tool_executor.submit(self.run_tool, agent_action, name_to_tool_map, color_mapping, run_manager)
+			for agent_action in actions
+		]
+		return [(agent_action, future.result()) for agent_action, future in zip(actions, futures)]
+
+	def run_tool(self, agent_action, name_to_tool_map, color_mapping, run_manager=None):
+		tool_run_kwargs = self.agent.tool_run_logging_kwargs()
+		if agent_action.tool in name_to_tool_map:
+			tool = name_to_tool_map[agent_action.tool]
+			if tool.return_direct:
+				tool_run_kwargs["llm_prefix"] = ""
+			return tool.run(
+				agent_action.tool_input,
+				verbose = self.verbose,
+				color = color_mapping[agent_action.tool],
+				callbacks = run_manager.get_child() if run_manager else None,
+				**tool_run_kwargs,
+			)
+		return InvalidTool().run(
+			{"requested_tool_name": agent_action.tool, "available_tool_names": list(name_to_tool_map.keys())},
+			verbose = self.verbose,
+			color = None,
+			callbacks = run_manager.get_child() if run_manager else None,
+			**tool_run_kwargs,
+		)
+
+#************************************************************************************************************
+# Serialization of agent intermediate steps
+
+# (md5 of page_content, max_content_chars) -> (truncated page_content, length, truncated), shared by all requests
+# of this process
+serialized_document_cache = LRUCache(maxsize=2048)
+
+
+class StepSerializer:
+	"""
+	Compact serializer for agent intermediate steps, i.e. [(AgentAction, observation), ...].
+
+	Objects are converted in one pass with a type-dispatch table (resolved once per concrete type through its MRO)
+	instead of chains of isinstance checks. Documents are referenced by id and md5 hash, with page_content truncated
+	to max_content_chars. The truncated content is cached per content hash for the documents retrieved again in later
+	steps or requests; the metadata (and so the id) is always taken from the document itself.
+	"""
+	SCALAR_TYPES = (str, int, float, bool, type(None))
+
+	def __init__(self, max_content_chars=1000):
+		"""
+		Args:
+			max_content_chars: Maximum number of characters of page_content kept per document. None keeps everything.
+		"""
+		self.max_content_chars = max_content_chars
+		self.dispatch = {scalar_type: self.serialize_scalar for scalar_type in self.SCALAR_TYPES}
+		self.dispatch.update({
+			tuple: self.serialize_tuple,
+			list: self.serialize_list,
+			dict: self.serialize_dict,
+			AgentAction: self.serialize_action,
+			Document: self.serialize_document,
+			BaseModel: self.serialize_model,
+		})
+
+	def serialize(self, obj):
+		handler = self.dispatch.get(type(obj))
+		if handler is None:
+			handler = self.resolve(type(obj))
+		return handler(obj)
+
+	def resolve(self, obj_type):
+		for base in obj_type.__mro__:
+			if base in self.dispatch:
+				handler = self.dispatch[base]
+				break
+		else:
+			# langchain objects are pydantic v1 models, which are not instances of pydantic.BaseModel (v2)
+			handler = self.serialize_model if callable(getattr(obj_type, "dict", None)) else self.serialize_scalar
+		self.dispatch[obj_type] = handler
+		return handler
+
+	def serialize_scalar(self, obj):
+		return obj
+
+	def serialize_list(self, obj):
+		return [self.serialize(element) for element in obj]
+
+	def serialize_tuple(self, obj):
+		# An intermediate step is an (AgentAction, observation) tuple
+		if len(obj) == 2 and isinstance(obj[0], AgentAction):
+			return {"action": self.serialize(obj[0]), "result": self.serialize(obj[1])}
+		return [self.serialize(element) for element in obj]
+
+	def serialize_dict(self, obj):
+		return {key: self.serialize(value) for key, value in obj.items()}
+
+	def serialize_model(self, obj):
+		return self.serialize(obj.dict(exclude_none=True))
+
+	def serialize_action(self, action):
+		return {
+			"tool": action.tool,
+			"tool_input": action.tool_input,
+			"log": action.log,
+			"type": action.type,
+		}
+
+	def serialize_document(self, document):
+		# Only the content part is cached: documents with the same text may come from different sources
+		content = document.page_content
+		content_hash = hashlib.md5(content.encode("utf-8")).hexdigest()
+		cache_key = f"{content_hash}:{self.max_content_chars}"
+		body = serialized_document_cache.get(cache_key)
+		if body is None:
+			truncated = self.max_content_chars is not None and len(content) > self.max_content_chars
+			body = (content[:self.max_content_chars] if truncated else content, len(content), truncated)
+			serialized_document_cache.put(cache_key, body)
+		page_content, length, truncated = body
+
+		metadata = self.serialize(document.metadata)
+		return {
+			"id": metadata.get("id") or metadata.get("source") or content_hash,
+			"hash": content_hash,
+			"page_content": page_content,
+			"length": length,
+			"truncated": truncated,
+			"metadata": metadata,
+			"type": "Document",
+		}
+
+
+@lru_cache(maxsize=8)
+def get_step_serializer(max_content_chars=1000):
+	"""Return the process-wide StepSerializer for the given truncation, so its dispatch table is built once."""
+	return StepSerializer(max_content_chars=max_content_chars)
+
+#************************************************************************************************************
+# Lambda invocation (e.g. the sagemind-autogen-code function used for the 24 game)
+
+@lru_cache(maxsize=4)
+def get_lambda_client(read_timeout=None):
+	"""
+	Return the Lambda client of this process for the given read timeout (seconds). boto3 clients are thread-safe, so
+	one client per timeout is reused by all requests. Without read_timeout, env LAMBDA_INVOKE_READ_TIMEOUT (default
+	900s) applies. A client with an explicit read_timeout doesn't retry, so the timeout is the deadline of the whole
+	invocation and a slow function is not invoked twice.
+	"""
+	config = Config(
+		connect_timeout = 10,
+		read_timeout = read_timeout or int(os.environ.get("LAMBDA_INVOKE_READ_TIMEOUT", "900")),	# The default of 60s is shorter than a long autogen conversation
+	)
+	if read_timeout:
+		config = config.merge(Config(retries={"total_max_attempts": 1}))
+	return boto3.client('lambda', config=config)
+
+
+def invoke_lambda_json(function_name, payload, client=None):
+	"""
+	Invoke a Lambda function synchronously with a JSON payload and return its decoded JSON response.
+
+	Args:
+		function_name: Name or ARN of the function.
+		payload: JSON serializable payload.
+		client: Object with the boto3 Lambda 'invoke' signature. Defaults to get_lambda_client(); pass a local
+			stand-in to run without AWS.
+
+	Raises:
+		Exception: If the function reports a FunctionError.
+	"""
+	client = client or get_lambda_client()
+	res = client.invoke(
+		FunctionName = function_name,
+		InvocationType = 'RequestResponse',
+		Payload = json.dumps(payload)
+	)
+
+	# 确保安全地读取和关闭Payload
+	with res['Payload'] as payload_stream:
+		res_json = json.loads(payload_stream.read().decode("utf-8"))
+
+	if res.get("FunctionError"):
+		raise Exception(f"{function_name} failed with {res['FunctionError']}: {res_json}")
+	return res_json
+
+
+# job id -> Future of the final response, for the autogen jobs started with env 'autogen_async'
+autogen_jobs = LRUCache(maxsize=256)
+
+def get_autogen_job_result(job_id, timeout=None):
+	"""
+	Wait for an autogen job started by PaletteUsecase.make_24_agent() and return its final response.
+
+	Raises:
+		KeyError: If the job id is unknown (or already evicted).
+		concurrent.futures.TimeoutError: If the job does not finish within timeout seconds.
+	"""
+	future = autogen_jobs.get(job_id)
+	if future is None:
+		raise KeyError(f"Unknown autogen job: {job_id}")
+	return future.result(timeout=timeout)
+
+#************************************************************************************************************
+# Temperature on a date, resolved locally in one tool call instead of the date -> weekday -> temperature tool chain
+
+WEEKDAYS = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+CHINESE_WEEKDAYS = {"一": 0, "二": 1, "三": 2, "四": 3, "五": 4, "六": 5, "日": 6, "天": 6}
+CHINESE_DIGITS = {"一": 1, "两": 2, "二": 2, "三": 3, "四": 4, "五": 5, "六": 6, "七": 7, "八": 8, "九": 9, "十": 10}
+RELATIVE_DAYS = {
+	"today": 0, "今天": 0, "yesterday": -1, "昨天": -1, "tomorrow": 1, "明天": 1,
+	"day before yesterday": -2, "前天": -2, "大前天": -3, "day after tomorrow": 2, "后天": 2, "大后天": 3,
+}
+
+# A count of days: digits, a Chinese numeral up to 99 (e.g. 十一, 二十三) or an English number word. It must not be
+# the tail of a longer word, e.g. the 'a' of 'data'.
+COUNT_PATTERN = r"(?<![a-z0-9])(\d+|[一两二三四五六七八九十]+|(?:one|two|three|four|five|six|seven|eight|nine|ten|an?)\b)"
+DAYS_AGO_PATTERN = re.compile(COUNT_PATTERN + r"\s*(?:days?\s+(?:ago|before\s+(?:today|now))|天前|天以前)")
+DAYS_LATER_PATTERN = re.compile(
+	COUNT_PATTERN + r"\s*(?:days?\s+(?:later|after\s+today|from\s+(?:now|today))|天后|天以后)|\bin\s+" + COUNT_PATTERN + r"\s+days?\b"
+)
+DAYS_PATTERN = re.compile(COUNT_PATTERN + r"\s+days?\b")
+
+def parse_chinese_number(text):
+	"""Value of a Chinese numeral from 一 to 九十九 (e.g. 十一, 二十, 三十五), or None."""
+	tens, separator, units = text.partition("十")
+	if not separator:
+		return CHINESE_DIGITS.get(text) if len(text) == 1 else None
+	tens_value = CHINESE_DIGITS.get(tens) if tens else 1
+	units_value = CHINESE_DIGITS.get(units) if units else 0
+	if tens_value is None or units_value is None or tens_value >= 10 or units_value >= 10:
+		return None
+	return tens_value * 10 + units_value
+
+
+def parse_count(word):
+	word = word.lower()
+	if word.isdigit():
+		return int(word)
+	if word in NUMBER_WORDS and word.isascii():
+		return NUMBER_WORDS[word]
+	return parse_chinese_number(word)
+
+
+def resolve_relative_date(expression, today):
+	"""
+	Resolve a date expression such as 'yesterday', '3 days ago', 'next Monday', '上周五', '前天', '十一天前' or
+	'2024-05-01'.
+
+	Weeks start on Monday: 'next Monday' / 'Monday next week' / '下周一' is the Monday of next week, 'last Friday' /
+	'上周五' the Friday of last week, '下下周一' the Monday of the week after next, and a bare weekday ('Wednesday',
+	'周三') is the one of the current week. Offsets of days count
+	from today ('2 days before today', 'in 3 days'); an offset from another day, such as '2 days after tomorrow',
+	is not understood.
+
+	Returns:
+		A datetime.date, or None if the expression is not understood or is not a valid date.
+	"""
+	text = " ".join(expression.strip().lower().split()).strip(" .。?？")
+	match = re.search(r"(\d{4})[-/年](\d{1,2})[-/月](\d{1,2})", text)
+	if match:
+		try:
+			return date(int(match.group(1)), int(match.group(2)), int(match.group(3)))
+		except ValueError:
+			return None
+
+	# Offsets first, since they may contain the phrases of RELATIVE_DAYS ('2 days before today')
+	match = DAYS_AGO_PATTERN.search(text)
+	if match:
+		count = parse_count(match.group(1))
+		return today - timedelta(days=count) if count is not None else None
+	match = DAYS_LATER_PATTERN.search(text)
+	if match:
+		count = parse_count(match.group(1) or match.group(2))
+		return today + timedelta(days=count) if count is not None else None
+	if DAYS_PATTERN.search(text):
+		return None
+
+	for phrase in sorted(RELATIVE_DAYS, key=len, reverse=True):
+		if phrase in text:
+			return today + timedelta(days=RELATIVE_DAYS[phrase])
+
+	weekday, week_offset = None, 0
+	weekdays = [day.lower() for day in WEEKDAYS]
+	match = re.search(r"(上+|下+|这|本)?\s*(?:周|星期|礼拜)([一二三四五六日天])", text)
+	if match:
+		weekday = CHINESE_WEEKDAYS[match.group(2)]
+		prefix = match.group(1) or ""
+		week_offset = -len(prefix) if prefix.startswith("上") else (len(prefix) if prefix.startswith("下") else 0)
+	else:
+		# 'Wednesday next week', 'next week's Wednesday', then 'next Wednesday'
+		match = re.search(
+			r"\b(?:(last|next|this)\s+week(?:'s)?\s+(" + "|".join(weekdays) + r")|(" + "|".join(weekdays) + r")\s+(?:of\s+)?(last|next|this)\s+week)\b",
+			text,
+		) or re.search(r"(last|next|this)?\s*(" + "|".join(weekdays) + r")", text)
+		if match:
+			groups = [group for group in match.groups() if group is not None]
+			modifier = next((group for group in groups if group in ("last", "next", "this")), None)
+			weekday = weekdays.index(next(group for group in groups if group in weekdays))
+			week_offset = {"last": -1, "next": 1}.get(modifier, 0)
+	if weekday is not None:
+		monday = today - timedelta(days=today.weekday())
+		return monday + timedelta(weeks=week_offset, days=weekday)
+	return None
+
+
+@lru_cache(maxsize=1024)
+def get_weekday_of_date_cached(date_str):
+	return get_weekday_of_date(date_str)
+
+
+@lru_cache(maxsize=64)
+def get_temperature_cached(weekday):
+	return get_temperature_from_string(weekday)
+
+
+def get_today():
+	"""Today's date as the date tools see it (get_today_date), falling back to the system date."""
+	match = re.search(r"\d{4}-\d{1,2}-\d{1,2}", str(get_today_date("")))
+	return datetime.strptime(match.group(0), "%Y-%m-%d").date() if match else date.today()
+
+
+def get_temperature_on_date(expression):
+	"""Tool function: resolve a (relative) date locally and return its date, weekday and temperature."""
+	today = get_today()
+	resolved = resolve_relative_date(str(expression), today)
+	if resolved is None:
+		return (
+			f"Could not understand the date '{expression}'. Use a date in the YYYY-MM-DD format, or an expression "
+			f"like 'today', 'yesterday', '3 days ago', 'next Monday', 'last Friday'. Today is {today.isoformat()}."
+		)
+	date_str = resolved.isoformat()
+	weekday = str(get_weekday_of_date_cached(date_str)).strip()
+	temperature = str(get_temperature_cached(weekday)).strip()
+	return f"Date: {date_str}, weekday: {weekday}, temperature: {temperature} Celsius"
+
+# Per-process caches of the agent building blocks which don't depend on the request (see PaletteUsecase)
+agent_prompt_cache = LRUCache(maxsize=64)
+embeddings_cache = LRUCache(maxsize=8)
+vector_store_cache = LRUCache(maxsize=32)
+
+# (embedding model and its config, batch size, wait, deadline) -> EmbeddingBatcher. Not an LRUCache: an evicted
+# batcher would keep its collecting thread.
+embedding_batchers = {}
+_embedding_batchers_lock = threading.Lock()
+
+
+@lru_cache(maxsize=8)
+def get_langchain_tools(*tool_names):
+	"""The tools of langchain's load_tools() which need no LLM, loaded once per process. Returns a tuple."""
+	return tuple(load_tools(list(tool_names)))
+
+#************************************************************************************************************
+# Retrieval-based tool selection
+
+# md5(embedding model + tool name + description) -> unit vector of the tool description
+tool_embedding_cache = LRUCache(maxsize=512)
+
+def tool_prompt_tokens(tool):
+	"""Estimated prompt tokens of a tool in the structured chat prompt (name, description and args schema)."""
+	return estimate_tokens(f"{tool.name}: {tool.description}, args: {json.dumps(tool.args, ensure_ascii=False)}")
+
+
+def select_tools(question, tools, embeddings, embedding_model, top_k, always_include=()):
+	"""
+	Keep the top_k tools whose descriptions are most similar to the question, plus always_include.
+
+	The tool description embeddings are computed once per process and embedding model (in one batch for the tools
+	not cached yet), so each request only embeds the question.
+
+	Returns:
+		(selected tools in their original order, report dict with tool counts, estimated prompt tokens and latency)
+	"""
+	start = time.perf_counter()
+	keys = [hashlib.md5(f"{embedding_model}\x00{tool.name}\x00{tool.description}".encode()).hexdigest() for tool in tools]
+	missing = [(key, tool) for key, tool in zip(keys, tools) if tool_embedding_cache.get(key) is None]
+	if missing:
+		vectors = np.array(embeddings.embed_documents([f"{tool.name}: {tool.description}" for _, tool in missing]), dtype=np.float32)
+		vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+		for (key, _), vector in zip(missing, vectors):
+			tool_embedding_cache.put(key, vector)
+
+	question_vector = np.array(embeddings.embed_query(question), dtype=np.float32)
+	question_vector /= np.linalg.norm(question_vector)
+	scores = np.stack([tool_embedding_cache.get(key) for key in keys]) @ question_vector
+	selected_indices = set(np.argsort(-scores)[:top_k].tolist())
+	always_include_ids = {id(tool) for tool in always_include}
+	selected_indices.update(i for i, tool in enumerate(tools) if id(tool) in always_include_ids)
+	selected = [tool for i, tool in enumerate(tools) if i in selected_indices]
+
+	report = {
+		"tools_total": len(tools),
+		"tools_selected": [tool.name for tool in selected],
+		"tool_tokens_before": sum(tool_prompt_tokens(tool) for tool in tools),
+		"tool_tokens_after": sum(tool_prompt_tokens(tool) for tool in selected),
+		"selection_latency_ms": round((time.perf_counter() - start) * 1000, 2),
+	}
+	logger.info("tool_selection", extra={"tool_selection": report})
+	return selected, report
+
+#************************************************************************************************************
+# Image generation for the (A) route of default_agent
+
+class ImageUsecaseBackend:
+	"""
+	Generates one image per call with genai_core's ImageUsecase, and returns its response. ImageUsecase picks its own
+	seed, so its images are never cached (supports_seed is False).
+	"""
+	name = "ImageUsecase"
+	supports_seed = False
+
+	def __init__(self, message):
+		self.message = message
+
+	def generate(self, prompt, seed):
+		from genai_core.csdc.usecase import ImageUsecase
+		return ImageUsecase(self.message).run(prompt, 1)
+
+
+# md5(backend + prompt + seed) -> generated image, shared by the requests of this process
+image_cache = LRUCache(maxsize=256)
+
+def generate_images(backend, prompt, seeds, max_parallel=4):
+	"""
+	Generate one image per seed with at most max_parallel concurrent backend calls, and yield (index, seed, image,
+	error) as each image is ready (not in seed order). A failed image has image None and the exception as error, and
+	doesn't stop the others. Images of a seed already generated for the same prompt come from image_cache. A seed of
+	None means a fresh random image, which is never cached.
+
+	backend has a name, supports_seed (whether generate() honours the seed) and generate(prompt, seed), which returns
+	the response of one image, e.g. ImageUsecaseBackend.
+	"""
+	keys = [hashlib.md5(f"{backend.name}\x00{prompt}\x00{seed}".encode("utf-8")).hexdigest() if seed is not None else None for seed in seeds]
+	pending = []
+	for index, (seed, key) in enumerate(zip(seeds, keys)):
+		image = image_cache.get(key) if key is not None else None
+		if image is not None:
+			yield index, seed, image, None
+		else:
+			pending.append(index)
+	if not pending:
+		return
+
+	with ThreadPoolExecutor(max_workers=min(max_parallel, len(pending)), thread_name_prefix="palette-image") as executor:
+		futures = {executor.submit(backend.generate, prompt, seeds[index]): index for index in pending}
+		for future in as_completed(futures):
+			index = futures[future]
+			try:
+				image = future.result()
+			except Exception as e:
+				logger.warning(f"Image {index} of '{prompt}' failed. [Detailed Error Message]: {str(e)}")
+				yield index, seeds[index], None, e
+				continue
+			if keys[index] is not None:
+				image_cache.put(keys[index], image)
+			yield index, seeds[index], image, None
+
+
+#************************************************************************************************************
+# Intent routing for default_agent
+# Categories follow the letters used in the routing prompt of default_agent: (A) images, (B) 24 game, (D) others.
+
+ROUTE_IMAGES = "a"
+ROUTE_MAKE_24 = "b"
+ROUTE_OTHERS = "d"
+
+NUMBER_WORDS = {
+	"一": 1, "两": 2, "二": 2, "三": 3, "四": 4, "五": 5, "六": 6, "七": 7, "八": 8, "九": 9, "十": 10,
+	"one": 1, "two": 2, "three": 3, "four": 4, "five": 5, "six": 6, "seven": 7, "eight": 8, "nine": 9, "ten": 10,
+	"a": 1, "an": 1,
+}
+
+def parse_make_24_numbers(question):
+	"""
+	Extract the four numbers of a 'Make 24' question.
+
+	Args:
+		question: The user question, e.g. '用 3 3 8 8 算24点' or 'Can 4, 7, 8, 8 make 24?'.
+
+	Returns:
+		A list of four integers, or None if the question does not contain exactly four operands or has a negative
+		or fractional one (e.g. '-3 3 8 8', '2.5 3 8 8'), which the local solver doesn't handle.
+	"""
+	# A minus sign right before a number which doesn't follow a word ('-3', not the hyphens of '3-3-8-8'), or a decimal
+	if re.search(r"(?<![\w.])[-−－]\d|\d\.\d", question):
+		return None
+	numbers = [int(n) for n in re.findall(r"(?<![\d.])\d+(?![\d.])", question)]
+	if len(numbers) == 5 and 24 in numbers:
+		# The target itself is usually mentioned in the question, e.g. "use 1 2 3 4 to make 24"
+		numbers.remove(24)
+	return numbers if len(numbers) == 4 else None
+
+
+@lru_cache(maxsize=4096)
+def solve_make_24(numbers, target=24):
+	"""
+	Solve the 'Make 24' game exactly with rational arithmetic.
+
+	Any two remaining values are combined with +, -, *, / until one value is left, which covers every order and
+	parenthesization. Multisets of values already known to fail are skipped, and results are memoized per input
+	tuple; pass the numbers sorted (as solve_make_24_locally does) so permutations of them are solved once.
+
+	Args:
+		numbers: Tuple of integers, e.g. (3, 3, 8, 8).
+		target: The number to reach.
+
+	Returns:
+		An expression string such as '8 / (3 - (8 / 3))', or None if there is no solution.
+	"""
+	target = Fraction(target)
+	failed = set()
+
+	def search(items):
+		# items: list of (value, expression, is_atomic)
+		if len(items) == 1:
+			return items[0][1] if items[0][0] == target else None
+
+		state = tuple(sorted(value for value, _, _ in items))
+		if state in failed:
+			return None
+
+		for i in range(len(items)):
+			for j in range(i + 1, len(items)):
+				rest = [items[k] for k in range(len(items)) if k != i and k != j]
+				(a, expr_a, atomic_a), (b, expr_b, atomic_b) = items[i], items[j]
+				expr_a = expr_a if atomic_a else f"({expr_a})"
+				expr_b = expr_b if atomic_b else f"({expr_b})"
+
+				candidates = [
+					(a + b, f"{expr_a} + {expr_b}"),
+					(a * b, f"{expr_a} * {expr_b}"),
+					(a - b, f"{expr_a} - {expr_b}"),
+					(b - a, f"{expr_b} - {expr_a}"),
+				]
+				if b != 0:
+					candidates.append((a / b, f"{expr_a} / {expr_b}"))
+				if a != 0:
+					candidates.append((b / a, f"{expr_b} / {expr_a}"))
+
+				for value, expression in candidates:
+					solution = search(rest + [(value, expression, False)])
+					if solution is not None:
+						return solution
+
+		failed.add(state)
+		return None
+
+	numbers = tuple(sorted(numbers))
+	return search([(Fraction(n), str(n), True) for n in numbers])
+
+
+
+class IntentRouter:
+	"""
+	Cheap local router which runs before the routing LLM call of default_agent.
+
+	Keyword rules and regexes are checked first. If none of them fires, the question is embedded and compared with
+	the centroids of a few exemplar questions per category. The centroids are computed once per process and embedding
+	model. route() returns None when the router is not confident, and the caller falls back to the LLM.
+	"""
+	# Only unambiguous image requests are decided by rules: the question starts with a generation verb whose object
+	# is an image noun (or a counted image classifier in Chinese), and the description follows. Everything else,
+	# e.g. "create an AMI image" or "分析一下这张架构图", is left to the LLM, which also extracts the description.
+	IMAGE_REQUEST_PATTERNS = [
+		re.compile(
+			r"^\s*(?:(?:please|can you|could you|would you|kindly)\s+)*(?:generate|create|render|paint|draw|sketch|illustrate)\s+"
+			r"(?:(?P<count>\d+|one|two|three|four|five|six|seven|eight|nine|ten|an?)\s+)?"
+			r"(?:images?|pictures?|photos?|drawings?|illustrations?|paintings?|wallpapers?)\s+"
+			r"(?:of|featuring|showing|depicting|about)\s+(?P<content>.+)$",
+			re.IGNORECASE,
+		),
+		re.compile(r"^\s*(?:请|帮我|给我|麻烦你?)*\s*(?:生成|画|绘制|创作)(?:一下)?\s*(?P<count>\d+|[一两二三四五六七八九十])\s*(?:张|幅|副)\s*(?P<content>.+)$"),
+		re.compile(r"^\s*(?:请|帮我|给我|麻烦你?)*\s*(?:画|绘制)\s*(?P<content>(?:[一两二三四五六七八九十]|\d+)\s*(?:只|个|位|条|座|棵|朵|匹|头|辆|艘).+)$"),
+		re.compile(r"^\s*(?:请|帮我|给我|麻烦你?)*\s*(?:生成|创作)\s*(?:一下)?\s*(?P<content>.+?)的?(?:图片|图像|照片|插画|壁纸|头像)$"),
+	]
+	# Technical senses of "image" (machine, container and disk images) are never image generation
+	TECHNICAL_IMAGE_PATTERN = re.compile(r"\b(ami|ec2|instances?|volumes?|ebs|docker|containers?|ecr|vm|disk|snapshots?|lambda|kubernetes|k8s)\b", re.IGNORECASE)
+	IMAGE_NOUN_SUFFIX_PATTERN = re.compile(r"的?(?:图片|图像|照片|插画|壁纸|头像)$")
+	MAKE_24_PATTERN = re.compile(r"24\s*点|算出?\s*24|得到\s*24|等于\s*24|\bmake\s*24\b|\b24[\s-]*game\b|\b(get|reach|equals?|achieve)\s+24\b", re.IGNORECASE)
+	ONLY_NUMBERS_PATTERN = re.compile(r"^[\s\d,，、;；.。?？!！]+$")
+
+	EXEMPLARS = {
+		ROUTE_IMAGES: [
+			"Please generate 2 images featuring Optimus Prime from Transformers",
+			"Generate 3 images of a puppy running on the beach",
+			"Three boys in a high jump competition",
+			"Draw a cat sitting on a windowsill at sunset",
+			"帮我画一只在草地上奔跑的小狗",
+			"生成两张赛博朋克风格的城市夜景图片",
+			"一幅中国山水画，远处有瀑布",
+		],
+		ROUTE_MAKE_24: [
+			"Can 3, 3, 8, 8 make 24?",
+			"Use 4 7 8 8 to get 24 with + - * /",
+			"How to reach 24 with 1, 5, 5, 5",
+			"用 2 3 4 5 算24点",
+			"3 8 8 3 怎么算出24",
+			"24点游戏：1 2 3 4",
+		],
+		ROUTE_OTHERS: [
+			"What is CEI (Customer Engagement Incentive)?",
+			"How do I transfer data from S3 in the US region to China with DTH?",
+			"What was the temperature two days ago?",
+			"What day of the week is it today?",
+			"Summarize the document I uploaded",
+			"Find a YouTube video about AWS Lambda",
+			"List my EC2 instances",
+			"周三的气温是多少？",
+			"介绍一下 Data Transfer Hub",
+			"帮我总结一下上传的文件",
+		],
+	}
+
+	_centroids = {}
+	_centroids_lock = threading.Lock()
+
+	stats = {
+		"requests": 0,
+		"rules": 0,
+		"embedding": 0,
+		"llm": 0,
+		"latency_ms_total": 0.0,
+		"shadow_checked": 0,
+		"shadow_agreed": 0,
+	}
+	_stats_lock = threading.Lock()
+
+	def __init__(self, embeddings_factory=None, embedding_model="CSDC", confidence_threshold=0.05):
+		"""
+		Args:
+			embeddings_factory: Callable returning a langchain Embeddings instance. It is only called when the
+				keyword rules can't decide and the centroids of embedding_model are not cached yet.
+			embedding_model: Name of the embedding model, used as the cache key of the centroids.
+			confidence_threshold: Minimum cosine-similarity margin between the best and the second best category.
+		"""
+		self.embeddings_factory = embeddings_factory
+		self.embedding_model = embedding_model
+		self.confidence_threshold = confidence_threshold
+		self._embeddings = None
+
+	@classmethod
+	def parse_image_request(cls, question):
+		"""
+		Return (content_of_images, number) when the question is an unambiguous image request, otherwise None. The
+		request phrasing (verb, count, image noun) is stripped from content_of_images. The number defaults to 1.
+		"""
+		question = question.strip().rstrip(".。!！?？")
+		for pattern in cls.IMAGE_REQUEST_PATTERNS:
+			match = pattern.match(question)
+			if match is None:
+				continue
+			content_of_images = cls.IMAGE_NOUN_SUFFIX_PATTERN.sub("", match.group("content")).strip()
+			if not content_of_images or cls.TECHNICAL_IMAGE_PATTERN.search(content_of_images):
+				return None
+			count = match.groupdict().get("count")
+			number = 1
+			if count:
+				number = int(count) if count.isdigit() else NUMBER_WORDS.get(count.lower(), 1)
+			return content_of_images, max(number, 1)
+		return None
+
+	@classmethod
+	def route_by_rules(cls, question):
+		"""Apply keyword rules and regexes. Returns a route decision or None."""
+		numbers = parse_make_24_numbers(question)
+		if numbers and (cls.MAKE_24_PATTERN.search(question) or cls.ONLY_NUMBERS_PATTERN.match(question)):
+			return {"category": ROUTE_MAKE_24, "source": "rules", "confidence": 1.0}
+
+		image_request = cls.parse_image_request(question)
+		if image_request is not None:
+			content_of_images, number = image_request
+			return {
+				"category": ROUTE_IMAGES,
+				"content_of_images": content_of_images,
+				"number": number,
+				"source": "rules",
+				"confidence": 1.0,
+			}
+		return None
+
+	def get_centroids(self):
+		"""Embed the exemplars once per process and embedding model, and return {category: unit centroid vector}."""
+		centroids = self._centroids.get(self.embedding_model)
+		if centroids is not None:
+			return centroids
+
+		with self._centroids_lock:
+			centroids = self._centroids.get(self.embedding_model)
+			if centroids is None:
+				centroids = {}
+				for category, exemplars in self.EXEMPLARS.items():
+					vectors = np.array(self.get_embeddings().embed_documents(exemplars), dtype=np.float32)
+					vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+					centroid = vectors.mean(axis=0)
+					centroids[category] = centroid / np.linalg.norm(centroid)
+				self._centroids[self.embedding_model] = centroids
+		return centroids
+
+	def get_embeddings(self):
+		if self._embeddings is None:
+			self._embeddings = self.embeddings_factory()
+		return self._embeddings
+
+	def route_by_embedding(self, question):
+		"""Nearest-centroid classification. Returns a route decision, or None when the margin is too small."""
+		centroids = self.get_centroids()
+		vector = np.array(self.get_embeddings().embed_query(question), dtype=np.float32)
+		vector /= np.linalg.norm(vector)
+		scores = sorted(((float(np.dot(vector, centroid)), category) for category, centroid in centroids.items()), reverse=True)
+		(best_score, best_category), (second_score, _) = scores[0], scores[1]
+		confidence = best_score - second_score
+		logger.info(f"IntentRouter embedding scores: {scores}, confidence: {confidence:.4f}")
+		if confidence < self.confidence_threshold:
+			return None
+
+		decision = {"category": best_category, "source": "embedding", "confidence": confidence}
+		if best_category == ROUTE_IMAGES:
+			# Image requests the rules couldn't parse need the LLM to extract the description and the number
+			return None
+		elif best_category == ROUTE_MAKE_24 and parse_make_24_numbers(question) is None:
+			# The 24 game needs four numbers. Let the LLM decide what the user meant.
+			return None
+		return decision
+
+	def route(self, question):
+		"""
+		Route a question locally.
+
+		Returns:
+			A route decision dict with the keys 'category', 'source' and 'confidence' (plus 'content_of_images' and
+			'number' for images), or None if the caller should fall back to the LLM.
+		"""
+		start = time.perf_counter()
+		decision = self.route_by_rules(question)
+		if decision is None and self.embeddings_factory is not None:
+			try:
+				decision = self.route_by_embedding(question)
+			except Exception as e:
+				logger.warning(f"IntentRouter embedding classifier failed, falling back to the LLM. [Detailed Error Message]: {str(e)}")
+		latency_ms = (time.perf_counter() - start) * 1000
+
+		with self._stats_lock:
+			self.stats["requests"] += 1
+			self.stats["latency_ms_total"] += latency_ms
+			self.stats[decision["source"] if decision else "llm"] += 1
+
+		if decision is not None:
+			decision["router_latency_ms"] = round(latency_ms, 2)
+		logger.info(f"IntentRouter decision: {decision}, latency: {latency_ms:.2f} ms")
+		return decision
+
+	@classmethod
+	def record_shadow(cls, local_decision, llm_decision):
+		"""Compare a local decision with the LLM decision for the same question (shadow mode) to track accuracy."""
+		with cls._stats_lock:
+			cls.stats["shadow_checked"] += 1
+			if local_decision["category"] == llm_decision["category"]:
+				cls.stats["shadow_agreed"] += 1
+		logger.info(f"IntentRouter shadow check: local={local_decision['category']}, llm={llm_decision['category']}, report={cls.report()}")
+
+	@classmethod
+	def report(cls):
+		"""Return router latency and accuracy statistics of this process."""
+		stats = dict(cls.stats)
+		stats["avg_latency_ms"] = stats["latency_ms_total"] / stats["requests"] if stats["requests"] else 0.0
+		stats["local_hit_rate"] = (stats["rules"] + stats["embedding"]) / stats["requests"] if stats["requests"] else 0.0
+		stats["accuracy"] = stats["shadow_agreed"] / stats["shadow_checked"] if stats["shadow_checked"] else None
+		return stats
+
+	def evaluate(self, labelled_questions):
+		"""
+		Evaluate the local router on labelled questions.
+
+		Args:
+			labelled_questions: Iterable of (question, expected_category) tuples, e.g. ("画一只猫", "a").
+
+		Returns:
+			A dict with accuracy (over the questions routed locally), coverage and average latency in milliseconds.
+		"""
+		total, routed, correct, latency_ms = 0, 0, 0, 0.0
+		for question, expected in labelled_questions:
+			start = time.perf_counter()
+			decision = self.route(question)
+			latency_ms += (time.perf_counter() - start) * 1000
+			total += 1
+			if decision is not None:
+				routed += 1
+				correct += decision["category"] == expected
+		return {
+			"accuracy": correct / routed if routed else None,
+			"coverage": routed / total if total else 0.0,
+			"avg_latency_ms": latency_ms / total if total else 0.0,
+		}
+
+#************************************************************************************************************
+
+class PreparedAgent:
+	"""The tool agent built by PaletteUsecase.prepare_agent_with_tools(), with the per-request state it was built with."""
+	def __init__(self, agent, llm, memory, k, embedding_model, retrieval_cache, speculative_documents):
+		self.agent = agent
+		self.llm = llm
+		self.memory = memory
+		self.k = k
+		self.embedding_model = embedding_model
+		self.retrieval_cache = retrieval_cache
+		self.speculative_documents = speculative_documents
+
 #************************************************************************************************************
 
 class PaletteUsecase(BaseUsecase):
@@ -52,36 +2232,108 @@ class PaletteUsecase(BaseUsecase):
 		# Ref: return self.buffer_as_messages if self.return_messages else self.buffer_as_str
 		# Key point: set 'return_messages'=False to get a good format (string) of chat history. The format is the same
 		# as the result of get_chat_history(chat_history.messages)
+		#
+		# With env 'memory_mode' = 'token_budget', the window is additionally limited to 'memory_max_tokens' tokens
+		# (see TokenBudgetWindowMemory), and with 'memory_summary' the older messages are rolled up into a summary.
+		# Only the last k turns are read from the session store (see WindowedChatMessageHistory).
 		if k is None:
 			k = self.chat_history_window
-  
-		memory = ConversationBufferWindowMemory(
+
+		# The running summary also needs the messages which aged out of the window since the last turn
+		token_budget = self.env.get("memory_mode", "window") == "token_budget"
+		summarize = token_budget and self.env.get("memory_summary", False)
+		summary_lookback = 2
+		window = k * 2 + (summary_lookback if summarize else 0)
+		if not self.env.get("history_window_reads", True):
+			window = None
+
+		memory_kwargs = dict(
 			memory_key = "chat_history",
 			input_key = "input", 	# Change the input_key back to "input", otherwise, KeyError: 'question'
 			output_key = "output", 	# Added for Agent use case, otherwise, you will encounter the error of got dict_keys(['output', 'intermediate_steps'])
-			chat_memory = self.chat_history,
+			chat_memory = self.get_session_history(window=window),
 			return_messages = return_messages,
 			k = k,
 			human_prefix = "Human",				# the default value
 			ai_prefix = "Assistant",			# the default value is "AI", Claude expect it's Assistant instead of AI
 		)  # By default, k=10
+
+		if token_budget:
+			memory = TokenBudgetWindowMemory(
+				**memory_kwargs,
+				max_token_limit = int(self.env.get("memory_max_tokens", 2000)),
+				summary_llm = self.get_llm(streaming=False) if summarize else None,
+				session_id = self.session_id,
+			)
+		else:
+			memory = ConversationBufferWindowMemory(**memory_kwargs)
 		return memory
 
 	# +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
-	def chatbot(self):
-		self.llm = self.get_llm()
+	def get_session_history(self, window=None):
+		"""
+		Wrap self.chat_history in a WindowedChatMessageHistory for this request. Writes are batched into one write per
+		turn unless env 'batch_history_writes' is false; env 'compress_reasoning_steps_over' (bytes) enables compression
+		of large reasoning steps.
+		"""
+		compress_threshold = self.env.get("compress_reasoning_steps_over")
+		return WindowedChatMessageHistory(
+			self.chat_history,
+			window = window,
+			batch_writes = self.env.get("batch_history_writes", True),
+			compress_threshold = int(compress_threshold) if compress_threshold is not None else None,
+		)
+
+	# +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+	def save_chat_history(self, metadata):
+		"""
+		Attach the metadata to the AI message of this turn and persist the turn (a single write when batching). The
+		turn is the one recorded in the history of self.memory.
+		"""
+		history = getattr(getattr(self, "memory", None), "chat_memory", None)
+		if not isinstance(history, WindowedChatMessageHistory):
+			history = self.get_session_history()
+		history.add_metadata(metadata)
+		history.flush(write_behind=self.env.get("history_write_behind", False))
+
+	# +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+	def get_llm(self, *args, **kwargs):
+		"""
+		BaseUsecase.get_llm() with a per-call deadline from env 'llm_deadline' (seconds): the request timeout of the
+		OpenAI models, the read timeout of the Bedrock runtime client. LLM calls are not hedged, since a duplicate
+		generation doubles the cost and the streamed tokens.
+
+		Streaming LLMs (streaming=True, or callbacks such as CustomFinalOutputCallbackHandler) bypass the LLM cache:
+		a cache hit returns the stored generations without calling on_llm_new_token, so nothing would be streamed.
+		"""
+		llm = super().get_llm(*args, **kwargs)
+		fields = getattr(llm, "__fields__", {})
+		if "cache" in fields and (kwargs.get("streaming") or kwargs.get("callbacks") or getattr(llm, "streaming", False)):
+			llm.cache = False
+		deadline = self.env.get("llm_deadline")
+		if deadline:
+			if "request_timeout" in fields:
+				llm.request_timeout = float(deadline)
+			elif "client" in fields and "region_name" in fields:
+				llm.client = get_bedrock_runtime_client(llm.region_name or os.environ.get("AWS_REGION"), int(deadline))
+		return llm
+
+	# +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+	def get_chatbot_chain(self, streaming=None):
+		self.llm = self.get_llm() if streaming is None else self.get_llm(streaming=streaming)
 		self.memory = self.get_memory()
 		
 		chain = LLMChain(
 			llm = self.llm, 
 			prompt = self.get_chatbot_prompt(doc_reader_type="langchain"), 
-			verbose = True, 
+			verbose = debug_enabled(), 
 			memory = self.memory
 			)
+		return chain
 
-		response_from_chain = chain({"question": self.question})
-		print(f"'+++++++++++ response_from_chain is: {response_from_chain}")
-		
+	# +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+	def finish_chatbot(self, text):
+		"""Save the metadata of a chatbot turn and return the final response."""
 		metadata = {
 			"text2text_model": self.env["text2text_model"],
 			"temperature": self.env["temperature"],
@@ -91,20 +2343,67 @@ class PaletteUsecase(BaseUsecase):
 		if self.env["files"]:
 			metadata["files"] = self.env["files"]
 			
-		self.chat_history.add_metadata(metadata)
+		self.save_chat_history(metadata)
 
 		final_response_with_metadata = {
 			"sessionId": self.session_id,
 			"type": "text",
-			"content": response_from_chain["text"],
+			"content": text,
 			"metadata": metadata,
 		}
 		
 		return final_response_with_metadata
 
+	# +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+	def chatbot(self):
+		chain = self.get_chatbot_chain()
+
+		response_from_chain = chain({"question": self.question})
+		log_debug(lambda: f"'+++++++++++ response_from_chain is: {response_from_chain}")
+		
+		return self.finish_chatbot(response_from_chain["text"])
+
+	# +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+	def chatbot_stream(self):
+		"""
+		Streaming variant of chatbot().
+
+		Yields:
+			{"sessionId", "type": "token", "content": <chunk>} for every token as soon as the LLM emits it, and finally
+			the same response as chatbot() (type "text"). The chat history and metadata are saved after the stream ends.
+		"""
+		chain = self.get_chatbot_chain(streaming=True)
+		event_queue = queue.Queue()
+		handler = QueueCallbackHandler(event_queue)
+
+		stream = iterate_in_background(lambda: chain({"question": self.question}, callbacks=[handler]), event_queue)
+		while True:
+			try:
+				_, token = next(stream)
+			except StopIteration as stop:
+				response_from_chain = stop.value
+				break
+			yield {"sessionId": self.session_id, "type": "token", "content": token}
+
+		log_debug(lambda: f"'+++++++++++ response_from_chain is: {response_from_chain}")
+		yield self.finish_chatbot(response_from_chain["text"])
+
+	# +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+	def get_reasoning_step_serializer(self):
+		"""The StepSerializer of the 'reasoning_acting_steps' metadata, or None with env 'compact_reasoning_steps' false."""
+		if not self.env.get("compact_reasoning_steps", True):
+			return None
+		max_content_chars = self.env.get("reasoning_steps_max_doc_chars", 1000)
+		return get_step_serializer(int(max_content_chars) if max_content_chars else None)
+
 	# +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
 	def serialize_agent_action(self, step):
 		"""Convert a step into a serializable dictionary format. The step might be a tuple of (AgentAction, str)."""
+		# Compact serializer (see StepSerializer). Set env 'compact_reasoning_steps' to false for full Document dicts.
+		serializer = self.get_reasoning_step_serializer()
+		if serializer is not None:
+			return serializer.serialize(step)
+
 		if isinstance(step, tuple) and len(step) == 2 and isinstance(step[0], AgentAction):
 			 # 检查 result 是否是单个 Document 实例或包含 Document 实例的列表
 			if isinstance(step[1], Document):
@@ -157,13 +2456,108 @@ class PaletteUsecase(BaseUsecase):
 		"""
 		return [cls.serialize_base_model(step) for step in steps]
 
+	# +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+	def get_embeddings(self, embedding_model):
+		"""
+		Return the embeddings of the provided model (e.g., 'OpenAI', 'Bedrock', 'Local' for a BGE model run on CPU with
+		ONNX Runtime, otherwise the SageMaker BGE endpoint), wrapped in a DeadlineEmbeddings of this request.
+
+		Calls are bounded by env 'embedding_deadline' (seconds, default 10) and, with env 'embedding_hedge', hedged
+		after the p95 latency of the model (see call_with_deadline). With env 'embedding_batching', concurrent queries
+		are sent in batches of up to 'embedding_batch_size' texts collected for 'embedding_batch_wait_ms' (see
+		EmbeddingBatcher). The model clients and batchers are shared by the requests of the process with the same
+		configuration (see get_model_embeddings); the deadline and hedging settings belong to the returned instance.
+		"""
+		key, embeddings = self.get_model_embeddings(embedding_model)
+		name = f"embeddings:{embedding_model}"
+		deadline = float(self.env.get("embedding_deadline", 10)) or None
+
+		batcher = None
+		# Titan embeds a single text per Bedrock request, so there is nothing to gain from batching its queries
+		if self.env.get("embedding_batching", False) and embedding_model != "Bedrock":
+			max_batch_size = int(self.env.get("embedding_batch_size", 32))
+			max_wait = float(self.env.get("embedding_batch_wait_ms", 5)) / 1000
+			batcher_key = (key, max_batch_size, max_wait, deadline)
+			with _embedding_batchers_lock:
+				batcher = embedding_batchers.get(batcher_key)
+				if batcher is None:
+					# A batch serves several requests, so it is bounded by the deadline of its configuration, unhedged
+					batch_embeddings = DeadlineEmbeddings(embeddings, name=name, deadline=deadline)
+					batcher = embedding_batchers[batcher_key] = EmbeddingBatcher(batch_embeddings.embed_queries, max_batch_size=max_batch_size, max_wait=max_wait)
+
+		return DeadlineEmbeddings(
+			embeddings,
+			name = name,
+			deadline = deadline,
+			hedge = self.env.get("embedding_hedge", False),
+			batcher = batcher,
+		)
+
+	# +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+	def get_model_embeddings(self, embedding_model):
+		"""
+		Return (key, embeddings client) of embedding_model. The client holds no per-request state, so it is created
+		once per process for each configuration: the key is the model and, for 'Local', its env settings.
+		"""
+		if embedding_model == "Local":
+			config = (
+				self.env.get("local_embedding_model_dir", os.environ.get("LOCAL_EMBEDDING_MODEL_DIR", "/opt/models/bge")),
+				int(self.env.get("local_embedding_batch_size", 16)),
+				int(self.env.get("local_embedding_threads", 1)),
+				self.env.get("local_embedding_query_instruction", ""),
+			)
+		else:
+			config = ()
+		key = (embedding_model, *config)
+
+		embeddings = embeddings_cache.get(key)
+		if embeddings is not None:
+			return key, embeddings
+		if embedding_model == "OpenAI":
+			embeddings = OpenAIEmbeddings()
+		elif embedding_model == "Bedrock":
+			embeddings = BedrockEmbeddings(model_id="amazon.titan-embed-text-v1")
+		elif embedding_model == "Local":
+			model_dir, batch_size, intra_op_threads, query_instruction = config
+			embeddings = LocalBGEEmbeddings(
+				model_dir = model_dir,
+				batch_size = batch_size,
+				intra_op_threads = intra_op_threads,
+				query_instruction = query_instruction,
+			)
+		else:
+			embeddings = create_sagemaker_embeddings_from_js_model(
+				embeddings_model_endpoint_name="buffer-embedding-bge-endpoint",
+				aws_region=os.environ['AWS_REGION'],
+			)
+		embeddings_cache.put(key, embeddings)
+		return key, embeddings
+
+	# +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+	def select_embedding_model(self, embedding_model):
+		"""
+		Return embedding_model, or the first of env 'embedding_fallback_models' (comma separated, e.g. 'Bedrock,OpenAI')
+		whose circuit breaker is closed when the breaker of embedding_model is open. A fallback model is only usable
+		when the knowledge bases are also indexed with it, since vectors of different models can't be compared.
+		"""
+		fallbacks = [model.strip() for model in self.env.get("embedding_fallback_models", "").split(",") if model.strip()]
+		max_failures = int(self.env.get("embedding_breaker_failures", 3))
+		cooldown = float(self.env.get("embedding_breaker_cooldown", 30))
+		for model in [embedding_model] + [model for model in fallbacks if model != embedding_model]:
+			_, breaker = get_endpoint_state(f"embeddings:{model}")
+			if not breaker.is_open(max_failures=max_failures, cooldown=cooldown):
+				if model != embedding_model:
+					logger.warning(f"Embedding model {embedding_model} is failing, failing over to {model}")
+				return model
+		return embedding_model
+
 	# +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
 	def get_embeddings_and_index_name_multi(self, embedding_model, *knowledge_bases):
 		"""
 		Get embeddings and index names for multiple knowledge bases using variable arguments.
 
 		Args:
-			embedding_model: Model used for embeddings (e.g., 'OpenAI', 'Bedrock').
+			embedding_model: Model used for embeddings (e.g., 'OpenAI', 'Bedrock', 'Local').
 			*knowledge_bases: Variable number of knowledge base names.
 
 		Returns:
@@ -173,21 +2567,17 @@ class PaletteUsecase(BaseUsecase):
 			Exception: If an unknown embedding model is provided.
 		"""
 		try:
-			# Create embeddings instance based on the provided model
-			if embedding_model == "OpenAI":
-				embeddings = OpenAIEmbeddings()
-			elif embedding_model == "Bedrock":
-				embeddings = BedrockEmbeddings(model_id="amazon.titan-embed-text-v1")
-			else:
-				embeddings = create_sagemaker_embeddings_from_js_model(
-					embeddings_model_endpoint_name="buffer-embedding-bge-endpoint",
-					aws_region=os.environ['AWS_REGION'],
-				)
+			# Create embeddings instance based on the provided model, or a fallback model when its endpoint is failing
+			embedding_model = self.select_embedding_model(embedding_model)
+			embeddings = self.get_embeddings(embedding_model)
 
-			# Generate index names for each knowledge base
+			# Generate index names for each knowledge base. The local backend can search the indices of another model
+			# producing the same vectors, e.g. env 'local_embedding_index_model'='CSDC' for the ONNX export of the BGE
+			# model behind the SageMaker endpoint.
+			index_model = self.env.get("local_embedding_index_model", embedding_model) if embedding_model == "Local" else embedding_model
 			index_names = []
 			for knowledge_base in knowledge_bases:
-				index_name = f"{knowledge_base.lower()}_{embedding_model.lower()}_{hashlib.md5(knowledge_base.encode()).hexdigest()}"
+				index_name = f"{knowledge_base.lower()}_{index_model.lower()}_{hashlib.md5(knowledge_base.encode()).hexdigest()}"
 				index_names.append(index_name)
 
 		except Exception as e:
@@ -206,10 +2596,24 @@ class PaletteUsecase(BaseUsecase):
 			*index_names: Variable number of index names.
 
 		Returns:
-			A list of OpenSearchVectorSearch instances, one for each index name.
+			A list of OpenSearchVectorSearch instances, one for each index name. Their OpenSearch connection pools are
+			reused by the requests of this process as long as the model, endpoint and credentials match; each request
+			gets its own shallow copy, which embeds with its own embeddings (see get_embeddings). Searches time out
+			after env 'opensearch_timeout' seconds (default 30).
 		"""
 		vector_stores = []
+		timeout = int(self.env.get("opensearch_timeout", 30))
+		master_user_username = os.environ["OPENSEARCH_MASTER_USER_USERNAME"]
+		master_user_password = os.environ["OPENSEARCH_MASTER_USER_PASSWORD"]
 		for index_name in index_names:
+			cache_key = hashlib.md5(f"{id(getattr(embeddings, 'embeddings', embeddings))}\x00{index_name}\x00{os.environ.get('OPEN_SEARCH_ENDPOINT')}\x00{master_user_username}\x00{master_user_password}\x00{timeout}".encode()).hexdigest()
+			vector_store = vector_store_cache.get(cache_key)
+			if vector_store is not None:
+				vector_store = copy.copy(vector_store)
+				vector_store.embedding_function = embeddings
+				vector_stores.append(vector_store)
+				continue
+
 			vector_store = OpenSearchVectorSearch(
 				embedding_function=embeddings,
 				index_name=index_name,
@@ -219,17 +2623,190 @@ class PaletteUsecase(BaseUsecase):
 						"port": 443,
 					}
 				],
-				http_auth=(self.master_user_username, self.master_user_password),
-				timeout=300,
+				http_auth=(master_user_username, master_user_password),
+				timeout=timeout,
 				use_ssl=True,
 				verify_certs=True,
 				connection_class=RequestsHttpConnection,
 			)
-			vector_stores.append(vector_store)
+			vector_store_cache.put(cache_key, vector_store)
+			vector_stores.append(copy.copy(vector_store))
 
 		return vector_stores
 
 
+	# +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+	def ingest_knowledge_base(self, knowledge_base, sources, allowed_sources=None):
+		"""
+		Admin entry point, not reachable from run(): ingest the sources (local paths or s3:// URIs, within the
+		allow-list env INGESTION_ALLOWED_SOURCES of the process unless allowed_sources is given) into the index of
+		knowledge_base for env 'embedding_model' (see ingestion.ingest_knowledge_base).
+
+		Env: 'ingestion_chunk_size' (default 1000 characters), 'ingestion_chunk_overlap' (100), 'ingestion_batch_size'
+		(64), 'ingestion_concurrency' (4), 'ingestion_prune' (delete the chunks of the sources not seen in this run).
+
+		Returns:
+			The counts of chunks, indexed, unchanged and failed chunks.
+		"""
+		# Only needed by admin jobs, so the chat requests don't load it
+		import ingestion
+
+		embedding_model = self.env.get("embedding_model", "CSDC")
+		embeddings, index_name = self.get_embeddings_and_index_name_multi(embedding_model, knowledge_base)
+		vector_store, = self.get_vector_stores_from_indices(embeddings, index_name)
+		return ingestion.ingest_knowledge_base(
+			vector_store.client,
+			index_name,
+			getattr(embeddings, "embeddings", embeddings), 	# Batches are larger than the per-query deadline allows for
+			knowledge_base,
+			sources,
+			allowed_sources = allowed_sources,
+			chunk_size = int(self.env.get("ingestion_chunk_size", 1000)),
+			chunk_overlap = int(self.env.get("ingestion_chunk_overlap", 100)),
+			batch_size = int(self.env.get("ingestion_batch_size", 64)),
+			max_concurrency = int(self.env.get("ingestion_concurrency", 4)),
+			prune = self.env.get("ingestion_prune", False),
+		)
+
+	# +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+	def get_retriever(self, vector_store, index_name, embeddings, k, cache):
+		"""
+		Return the retriever (top k) of index_name for env 'retrieval_mode':
+			'similarity' (default): k-NN search. With env 'vector_snapshots', indices of at most
+				'vector_snapshot_max_docs' documents (default 20000) are searched in process on a local snapshot (see
+				VectorIndexSnapshot), refreshed every 'vector_snapshot_max_age' seconds (default 300). Larger indices,
+				or a snapshot that can't be built or is dropped by a refresh, use OpenSearch.
+			'hybrid': BM25 and k-NN search in one OpenSearch request (see HybridRetriever), weighted by env
+				'retrieval_lexical_weight' and 'retrieval_vector_weight'.
+		With env 'retrieval_mmr', the OpenSearch results are diversified with maximal marginal relevance among
+		'retrieval_fetch_k' candidates (default 20). Unless env 'retrieval_cache' is false, identical lookups are
+		answered from cache (a dict), which lives as long as the agent (see prepare_agent_with_tools).
+		"""
+		mmr = self.env.get("retrieval_mmr", False)
+		fetch_k = int(self.env.get("retrieval_fetch_k", 20))
+		if mmr:
+			retriever = vector_store.as_retriever(search_type="mmr", search_kwargs={"k": k, "fetch_k": fetch_k})
+		else:
+			retriever = vector_store.as_retriever(search_type="similarity", search_kwargs={"k": k})
+
+		if self.env.get("retrieval_mode", "similarity") == "hybrid":
+			retriever = HybridRetriever(
+				client = vector_store.client,
+				index_name = index_name,
+				embeddings = embeddings,
+				k = k,
+				fetch_k = fetch_k,
+				lexical_weight = float(self.env.get("retrieval_lexical_weight", 1.0)),
+				vector_weight = float(self.env.get("retrieval_vector_weight", 1.0)),
+				mmr = mmr,
+			)
+		elif self.env.get("vector_snapshots", False):
+			snapshot = get_vector_snapshot(
+				index_name,
+				vector_store.client,
+				directory = self.env.get("vector_snapshot_dir", "/tmp/palette_snapshots"),
+				max_docs = int(self.env.get("vector_snapshot_max_docs", 20000)),
+				max_age = float(self.env.get("vector_snapshot_max_age", 300)),
+			)
+			if snapshot is not None:
+				retriever = SnapshotRetriever(snapshot=snapshot, embeddings=embeddings, fallback=retriever, k=k)
+
+		if self.env.get("retrieval_cache", True):
+			retriever = CachedRetriever(retriever=retriever, index_name=index_name, cache=cache)
+		return retriever
+
+	# +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+	def get_agent_budget(self):
+		"""
+		Execution budget of the agents, from env 'agent_max_iterations' (default 12 for Bedrock, 6 otherwise),
+		'agent_max_execution_time' (seconds) and 'agent_max_tokens'. When a limit is hit, the agent stops with
+		env 'agent_early_stopping_method' ('generate' by default: one last LLM call answers from the steps so far).
+		"""
+		max_execution_time = self.env.get("agent_max_execution_time")
+		max_tokens = self.env.get("agent_max_tokens")
+		return {
+			"max_iterations": int(self.env.get("agent_max_iterations", 12 if self.text2text_model == "Bedrock" else 6)),
+			"max_execution_time": float(max_execution_time) if max_execution_time else None,
+			"early_stopping_method": self.env.get("agent_early_stopping_method", "generate"),
+			"max_tokens": int(max_tokens) if max_tokens else None,
+		}
+
+	# +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+	def run_agent(self, agent, inputs, callbacks=None, run_name="agent"):
+		"""Run an AgentExecutor within the token budget, logging a structured trace record per step."""
+		trace = AgentTraceCallbackHandler(executor=agent, max_tokens=self.get_agent_budget()["max_tokens"], run_name=run_name)
+		self.last_agent_trace = trace
+		max_iterations = agent.max_iterations
+		try:
+			return agent(inputs, callbacks=[trace] + list(callbacks or []))
+		finally:
+			agent.max_iterations = max_iterations		# lowered by the trace handler when the token budget is used up
+			logger.info("agent_run", extra={"agent_run": trace.summary()})
+
+	# +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+	def build_structured_chat_agent(self, tools, agent_kwargs=None, executor_kwargs=None, output_parser=None, executor_class=AgentExecutor, is_admin=False, llm=None):
+		"""
+		Build a STRUCTURED_CHAT_ZERO_SHOT_REACT_DESCRIPTION agent executor, like initialize_agent does.
+
+		The prompt (PREFIX/SUFFIX/FORMAT_INSTRUCTIONS plus every tool's name, description and schema) is the expensive
+		part and doesn't depend on the request, so it is cached per process, keyed by agent type, model, tool set,
+		admin flag and agent_kwargs. Only the per-request pieces (LLM with its callbacks, output parser, tools bound to
+		the session, memory) are bound on each call. Set env 'agent_template_cache' to false to always rebuild. llm
+		defaults to self.llm.
+		"""
+		agent_kwargs = agent_kwargs or {}
+		llm = llm or self.llm
+		cache_key = hashlib.md5(json.dumps([
+			AgentType.STRUCTURED_CHAT_ZERO_SHOT_REACT_DESCRIPTION.value,
+			self.text2text_model,
+			is_admin,
+			[(tool.name, tool.description) for tool in tools],
+			{key: str(value) for key, value in agent_kwargs.items()},
+		], sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+
+		use_cache = self.env.get("agent_template_cache", True)
+		prompt = agent_prompt_cache.get(cache_key) if use_cache else None
+		if prompt is None:
+			StructuredChatAgent._validate_tools(tools)
+			prompt = StructuredChatAgent.create_prompt(tools, **agent_kwargs)
+			if use_cache:
+				agent_prompt_cache.put(cache_key, prompt)
+
+		structured_chat_agent = StructuredChatAgent(
+			llm_chain = LLMChain(llm=llm, prompt=prompt),
+			allowed_tools = [tool.name for tool in tools],
+			output_parser = output_parser or StructuredChatAgent._get_default_output_parser(llm=llm),
+		)
+		return executor_class.from_agent_and_tools(agent=structured_chat_agent, tools=tools, **(executor_kwargs or {}))
+
+	# +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+	TEMPERATURE_QUESTIONS = [
+		"What was the temperature two days ago?",
+		"What will the temperature be next Monday?",
+		"How warm is it today?",
+		"What was the temperature last Friday?",
+		"昨天的气温是多少？",
+		"前天多少度？",
+		"下周三的气温是多少？",
+	]
+
+	def measure_agent_iterations(self, questions=None):
+		"""
+		Run the tool agent on a fixed question set (TEMPERATURE_QUESTIONS by default) and return the number of agent
+		steps per question plus the average. Compare the result with env 'temperature_on_date_tool' set to true and
+		false to measure the effect of the composite tool. With batched history writes (the default) the turns are
+		never flushed, so the session history is left untouched.
+		"""
+		results = []
+		for question in questions or self.TEMPERATURE_QUESTIONS:
+			self.question = question
+			agent = self.adopt_prepared_agent(self.prepare_agent_with_tools())
+			self.run_agent(agent, {'input': question}, run_name="measure_agent_iterations")
+			results.append({"question": question, "steps": len(self.last_agent_trace.records), **self.last_agent_trace.summary()})
+		average_steps = sum(result["steps"] for result in results) / len(results) if results else 0.0
+		logger.info("agent_iterations", extra={"agent_iterations": {"average_steps": average_steps, "results": results}})
+		return {"average_steps": average_steps, "results": results}
+
 	# +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
 	def get_temperature_agent(self):
 		is_admin_str = os.environ.get("is_admin", "False")  # get the string from environment
@@ -250,17 +2827,19 @@ class PaletteUsecase(BaseUsecase):
 
 		# Step2: Agent
 		# initialize_agent -> class AgentExecutor(Chain)
-		max_iterations = 12 if self.text2text_model == "Bedrock"  else 6
-		agent = initialize_agent(
+		# ai_prefix, human_prefix and prefix used to be passed here as executor kwargs of initialize_agent, which
+		# AgentExecutor ignores, so the agent keeps the default structured chat prompt.
+		budget = self.get_agent_budget()
+		agent = self.build_structured_chat_agent(
 			tools = tools, 
-   			llm = self.llm, 
-	  		agent = AgentType.STRUCTURED_CHAT_ZERO_SHOT_REACT_DESCRIPTION, 
-			verbose = True,
-		 	ai_prefix = "Assistant",
-			human_prefix = "Human",
-			prefix = PREFIX,
-			max_iterations = max_iterations,
-			return_intermediate_steps = True,
+			executor_kwargs = dict(
+				verbose = debug_enabled(),
+				max_iterations = budget["max_iterations"],
+				max_execution_time = budget["max_execution_time"],
+				early_stopping_method = budget["early_stopping_method"],
+				return_intermediate_steps = True,
+			),
+			is_admin = is_admin,
 		)
   
 		# Step3: Run the agent
@@ -271,8 +2850,8 @@ class PaletteUsecase(BaseUsecase):
 		inputs = {'input': self.question}
 
 		# use __call__ to execute. __call__ will invoke _call
-		response = agent(inputs)
-		logger.info(f"++++++ response: {response}")
+		response = self.run_agent(agent, inputs, run_name="get_temperature_agent")
+		log_debug(lambda: f"++++++ response: {response}")
 		# ++++++ response: {
 		# 	'input': '周三的气温是多少？', 
 		# 	'output': ' 周三的气温是13摄氏度。', 
@@ -282,11 +2861,8 @@ class PaletteUsecase(BaseUsecase):
 		# 	}
   
 		# serialize intermediate_steps
-		# The following two approaches bring the same result. You can use either of them. I prefer the latter one.
-		intermediate_steps_serializable_fn = [self.serialize_agent_action(step) for step in response.get("intermediate_steps", [])]
-		logger.info(f"++++++ intermediate_steps_serializable_fn: {intermediate_steps_serializable_fn}")
-		intermediate_steps_serializable = [{"action": step[0].dict(), "result": step[1]} for step in response.get("intermediate_steps", [])]
-		logger.info(f"++++++ intermediate_steps_serializable: {intermediate_steps_serializable}")
+		intermediate_steps_serializable = [self.serialize_agent_action(step) for step in response.get("intermediate_steps", [])]
+		log_debug(lambda: f"++++++ intermediate_steps_serializable: {intermediate_steps_serializable}")
   
 		metadata = {
 			"text2text_model": self.env["text2text_model"],
@@ -298,7 +2874,7 @@ class PaletteUsecase(BaseUsecase):
 		if self.env["files"]:
 			metadata["files"] = self.env["files"]
    
-		self.chat_history.add_metadata(metadata)
+		self.save_chat_history(metadata)
 
 		final_response_with_metadata = {
 			"sessionId": self.session_id,
@@ -310,7 +2886,8 @@ class PaletteUsecase(BaseUsecase):
 		return final_response_with_metadata
 	
 	# +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
-	def default_agent(self):
+	def route_question_with_llm(self):
+		"""Classify self.question with the routing LLM and return a route decision (see parse_route_text)."""
 		# Router
 		# Ref: https://python.langchain.com/docs/expression_language/how_to/routing
 		# Ref: https://python.langchain.com/docs/modules/chains/foundational/router
@@ -334,104 +2911,201 @@ class PaletteUsecase(BaseUsecase):
 		chain = LLMChain(
 			llm = routing_llm, 
 			prompt = template,
-			verbose = True, 
+			verbose = debug_enabled(), 
 			# memory = memory
 			)
 
+		start = time.perf_counter()
 		response_from_chain = chain({"question": self.question})
-		print(f"'+++++++++++ response_from_chain is: {response_from_chain}")
+		log_debug(lambda: f"'+++++++++++ response_from_chain is: {response_from_chain}")
 
-		cleaned_text = response_from_chain["text"].strip().lower()
-    
+		decision = self.parse_route_text(response_from_chain["text"])
+		decision["router_latency_ms"] = round((time.perf_counter() - start) * 1000, 2)
+		return decision
+
+	# +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+	@staticmethod
+	def parse_route_text(text):
+		"""
+		Parse the reply of the routing LLM, e.g. '(A),a puppy running on the beach,3' or '(D)'.
+
+		Returns:
+			A route decision dict. For images it also contains 'content_of_images' and 'number' (default 1).
+		"""
+		cleaned_text = text.strip().lower()
 		if cleaned_text.startswith("(a)"):
-			from genai_core.csdc.usecase import ImageUsecase
-			image = ImageUsecase(self.message)
 			values = cleaned_text.split(",")
-			content_of_images = ""
-			number = 1  
-   
+			content_of_images = values[1].strip() if len(values) > 1 else ""
+			number = 1
 			if len(values) > 2:
 				try:
-					content_of_images = values[1].strip()
 					number = int(values[2])
 				except Exception:
-					content_of_images = values[1].strip()
-			elif len(values) == 2:
-				content_of_images = values[1].strip()
-			else:
-				content_of_images = values[1].strip()
-			print(f"++++++ content of images: {content_of_images}, number of images: {number}")
-			final_response_with_metadata = image.run(content_of_images, number)
-			return final_response_with_metadata
-
+					pass
+			return {"category": ROUTE_IMAGES, "content_of_images": content_of_images, "number": number, "source": "llm"}
 		elif cleaned_text.startswith("(b)"):
-			try:
-				payload = {
-					"question": self.question,
-					"api_key": os.environ['OPENAI_API_KEY'],
-					"base_url": os.environ['OPENAI_API_BASE'],
-					"text2text_model": self.text2text_model,
-				}
-				lambda_client = boto3.client('lambda')
-				res = lambda_client.invoke(
-					FunctionName = "sagemind-autogen-code",
-					InvocationType = 'RequestResponse',
-					Payload = json.dumps(payload)
-				)
-  	
-				# 确保安全地读取和关闭Payload
-				with res['Payload'] as payload_stream:
-					res_json = json.loads(payload_stream.read().decode("utf-8"))
-				print(f"++++++ res_json: {res_json}")
-		
-				metadata = {
-					"text2text_model": self.env["text2text_model"],
-					"temperature": self.temperature,
-					"chat_history_window": self.chat_history_window,
-					"autogen_chat_messages": res_json["chat_messages"],
-				}
-		
-				if self.env["files"]:
-					metadata["files"] = self.env["files"]
-	
-				human_message = BaseMessage(
-					content=self.question,
-					type="human",
-				)
-				ai_message = BaseMessage(
-					content=res_json["last_message"],
-					type="ai",
-					additional_kwargs=metadata
-				)
+			return {"category": ROUTE_MAKE_24, "source": "llm"}
+		else:
+			return {"category": ROUTE_OTHERS, "source": "llm"}
 
-				self.chat_history.add_message(message=human_message)
-				self.chat_history.add_message(message=ai_message)
+	# +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+	def route_question(self):
+		"""
+		Route self.question. The local IntentRouter runs first (env 'intent_router', default 'local'), and the
+		routing LLM is only called when the local router is not confident or when env 'intent_router' is 'llm'.
+		With env 'intent_router_shadow' set, the LLM also runs after a local decision to track router accuracy.
 
-				final_response_with_metadata = {
-					"sessionId": self.session_id,
-					"type": "text",
-					"content": res_json["last_message"],
-					"metadata": metadata,
-				}
-				return final_response_with_metadata
+		Decisions are memoized per normalized question and text2text model in a bounded LRU (env 'route_cache',
+		'route_cache_size' and 'route_cache_path' for optional persistence), so repeated questions skip routing.
+		"""
+		route_cache = None
+		if self.env.get("route_cache", True):
+			route_cache = get_route_cache(
+				maxsize = int(self.env.get("route_cache_size", 1024)),
+				persist_path = self.env.get("route_cache_path"),
+			)
+			cache_key = hashlib.md5(f"{self.text2text_model}\x00{normalize_question(self.question)}".encode()).hexdigest()
+			cached_decision = route_cache.get(cache_key)
+			if cached_decision is not None:
+				decision = dict(cached_decision, cached=True)
+				logger.info(f"Route decision (cached): {decision}")
+				return decision
 
-			except Exception as e:
-				metadata = {
-					"text2text_model": self.env["text2text_model"],
-					"temperature": self.temperature,
-					"chat_history_window": self.chat_history_window,
-				}
-		
-				if self.env["files"]:
-					metadata["files"] = self.env["files"]
-	
-				final_response_with_metadata = {
-					"sessionId": self.session_id,
-					"type": "text",
-					"content": f"对不起，我执行过程中出现异常，这条对话将不会保存在聊天记录里，错误信息为：{str(e)}",
-					"metadata": metadata,
-				}
-				return final_response_with_metadata
+		decision = None
+		if self.env.get("intent_router", "local") == "local":
+			embedding_model = self.env.get("embedding_model", "CSDC")
+			router = IntentRouter(
+				embeddings_factory = lambda: self.get_embeddings(embedding_model),
+				embedding_model = embedding_model,
+				confidence_threshold = float(self.env.get("intent_router_confidence_threshold", 0.05)),
+			)
+			decision = router.route(self.question)
+
+		if decision is None:
+			decision = self.route_question_with_llm()
+		elif self.env.get("intent_router_shadow", False):
+			IntentRouter.record_shadow(decision, self.route_question_with_llm())
+
+		if route_cache is not None:
+			route_cache.put(cache_key, decision)
+		logger.info(f"Route decision: {decision}")
+		return decision
+
+	# +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+	def get_image_backend(self):
+		"""The backend of image_agent_stream(): self.image_backend when set (injectable, e.g. in tests), else ImageUsecase."""
+		backend = getattr(self, "image_backend", None)
+		if backend is not None:
+			return backend
+		return ImageUsecaseBackend(self.message)
+
+	# +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+	def image_agent_stream(self, content_of_images, number):
+		"""
+		Generate number images of content_of_images concurrently (at most env 'image_max_parallel' at a time, default
+		4). With env 'image_seed' and a backend which honours seeds, image i uses seed image_seed + i, and images of a
+		prompt and seed generated before are served from image_cache; otherwise every image is a fresh one.
+
+		Yields:
+			{"sessionId", "type": "image_partial", "content": <image>, "metadata": {"index", "seed"}} as soon as each
+			image is ready ("content" None and "error" in the metadata when it failed), and finally the response of
+			all of them: the envelope of the first image response (e.g. of ImageUsecase) with the contents of the
+			generated images, in order, as its "content", and the failed ones under "errors" in its metadata.
+		"""
+		start = time.perf_counter()
+		backend = self.get_image_backend()
+		image_seed = self.env.get("image_seed")
+		seeds = [int(image_seed) + i if image_seed is not None and backend.supports_seed else None for i in range(number)]
+
+		responses = [None] * number
+		errors = []
+		for index, seed, response, error in generate_images(backend, content_of_images, seeds, max_parallel=int(self.env.get("image_max_parallel", 4))):
+			metadata = {"index": index, "seed": seed}
+			if error is not None:
+				errors.append({**metadata, "error": str(error)})
+				yield {"sessionId": self.session_id, "type": "image_partial", "content": None, "metadata": {**metadata, "error": str(error)}}
+				continue
+			responses[index] = response
+			yield {"sessionId": self.session_id, "type": "image_partial", "content": response["content"], "metadata": {**response.get("metadata", {}), **metadata}}
+
+		generated = [response for response in responses if response is not None]
+		contents = []
+		for response in generated:
+			content = response["content"]
+			contents.extend(content if isinstance(content, list) else [content])
+		envelope = generated[0] if generated else {"type": "text"}
+		yield {
+			**envelope,
+			"sessionId": self.session_id,
+			"content": contents if generated else f"Failed to generate the images of '{content_of_images}'.",
+			"metadata": {
+				**envelope.get("metadata", {}),
+				"content_of_images": content_of_images,
+				"number": number,
+				"seeds": seeds,
+				"errors": sorted(errors, key=lambda error: error["index"]),
+				"image_backend": backend.name,
+				"elapsed_seconds": round(time.perf_counter() - start, 3),
+			},
+		}
+
+	# +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+	def image_agent(self, content_of_images, number, streaming=False):
+		"""
+		The (A) route of default_agent. With env 'parallel_images' (or an injected self.image_backend), the images are
+		generated concurrently by image_agent_stream(), which is returned as is with streaming. Otherwise ImageUsecase
+		generates all of them in one run, as before.
+		"""
+		if not (self.env.get("parallel_images", False) or getattr(self, "image_backend", None) is not None):
+			from genai_core.csdc.usecase import ImageUsecase
+			response = ImageUsecase(self.message).run(content_of_images, number)
+			return iter([response]) if streaming else response
+
+		if streaming:
+			return self.image_agent_stream(content_of_images, number)
+		final_response_with_metadata = None
+		for final_response_with_metadata in self.image_agent_stream(content_of_images, number):
+			pass
+		return final_response_with_metadata
+
+	# +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+	def default_agent(self, streaming=False):
+		# With streaming, a generator of events is returned instead (see default_agent_with_tools_stream). The routes
+		# without a streaming variant yield their final response only.
+		#
+		# Speculative mode: build the tool agent (and optionally run the first retrieval) while the question is
+		# being routed. Most questions end up in default_agent_with_tools, so this hides most of the setup latency.
+		speculative_future = None
+		if self.env.get("speculative_agent_preparation", False):
+			cancel_event = threading.Event()
+			speculative_future = background_executor.submit(
+				self.prepare_agent_with_tools,
+				cancel_event = cancel_event,
+				prefetch_retrieval = self.env.get("speculative_retrieval", False),
+			)
+
+		try:
+			decision = self.route_question()
+		except Exception:
+			if speculative_future is not None:
+				cancel_event.set()
+				speculative_future.cancel()
+			raise
+
+		if speculative_future is not None and decision["category"] in (ROUTE_IMAGES, ROUTE_MAKE_24):
+			cancel_event.set()
+			speculative_future.cancel()
+			speculative_future = None
+    
+		if decision["category"] == ROUTE_IMAGES:
+			content_of_images = decision["content_of_images"]
+			number = decision["number"]
+			print(f"++++++ content of images: {content_of_images}, number of images: {number}")
+			return self.image_agent(content_of_images, number, streaming=streaming)
+
+		elif decision["category"] == ROUTE_MAKE_24:
+			response = self.make_24_agent()
+			return iter([response]) if streaming else response
    
 		
 		# elif cleaned_text.startswith("(c)"):
@@ -467,29 +3141,189 @@ class PaletteUsecase(BaseUsecase):
 		# 	return final_response_with_metadata
 
 		else:
-			return self.default_agent_with_tools()
+			prepared = None
+			if speculative_future is not None:
+				try:
+					prepared = speculative_future.result()
+				except Exception as e:
+					logger.warning(f"Speculative agent preparation failed, preparing again. [Detailed Error Message]: {str(e)}")
+			if streaming:
+				return self.default_agent_with_tools_stream(prepared=prepared)
+			return self.default_agent_with_tools(prepared=prepared)
+
+	# +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+	def make_24_agent(self, lambda_client=None):
+		"""
+		Solve a 'Make 24' question with the sagemind-autogen-code Lambda.
+
+		The invocation is bounded by env 'autogen_timeout' (seconds, default 300), which is the read timeout of the
+		Lambda client, so no thread outlives the deadline. With env 'autogen_async', the invocation runs on
+		background_executor and a job handle is returned right away in metadata['autogen_job_id']; the result is saved
+		to the chat history when the job finishes and can be awaited with get_autogen_job_result(). This only helps
+		in a long-running process: Lambda freezes the execution environment once the handler has returned, so the job
+		is suspended until the next invocation of the same environment, which may never come.
+
+		Args:
+			lambda_client: Optional stand-in for the boto3 Lambda client (see invoke_lambda_json).
+		"""
+		try:
+			# Fast path: solve locally when the four numbers can be parsed. autogen is only used otherwise.
+			numbers = parse_make_24_numbers(self.question) if self.env.get("make_24_local_solver", True) else None
+			if numbers is not None:
+				return self.build_autogen_response(self.solve_make_24_locally(numbers))
+
+			payload = {
+				"question": self.question,
+				"api_key": os.environ['OPENAI_API_KEY'],
+				"base_url": os.environ['OPENAI_API_BASE'],
+				"text2text_model": self.text2text_model,
+			}
+			function_name = self.env.get("autogen_function_name", "sagemind-autogen-code")
+
+			lambda_client = lambda_client or get_lambda_client(read_timeout=int(self.env.get("autogen_timeout", 300)))
+			if self.env.get("autogen_async", False):
+				if os.environ.get("AWS_LAMBDA_FUNCTION_NAME"):
+					logger.warning("autogen_async in AWS Lambda: the job is frozen with the environment after this response")
+				job_id = uuid.uuid4().hex
+				future = background_executor.submit(
+					lambda: self.build_autogen_response(invoke_lambda_json(function_name, payload, lambda_client))
+				)
+				future.add_done_callback(
+					lambda f: f.exception() and logger.error(f"Autogen job {job_id} failed. [Detailed Error Message]: {str(f.exception())}")
+				)
+				autogen_jobs.put(job_id, future)
+				return {
+					"sessionId": self.session_id,
+					"type": "text",
+					"content": "正在计算中，结果稍后会保存在聊天记录里。",
+					"metadata": dict(self.get_base_metadata(), autogen_job_id=job_id, autogen_job_status="running"),
+				}
+
+			return self.build_autogen_response(invoke_lambda_json(function_name, payload, lambda_client))
+
+		except Exception as e:
+			final_response_with_metadata = {
+				"sessionId": self.session_id,
+				"type": "text",
+				"content": f"对不起，我执行过程中出现异常，这条对话将不会保存在聊天记录里，错误信息为：{str(e) or type(e).__name__}",
+				"metadata": self.get_base_metadata(),
+			}
+			return final_response_with_metadata
+
+	# +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+	def solve_make_24_locally(self, numbers):
+		"""Solve the 24 game in-process and return a result in the format of the autogen Lambda response."""
+		start = time.perf_counter()
+		expression = solve_make_24(tuple(sorted(numbers)))
+		latency_ms = (time.perf_counter() - start) * 1000
+		numbers_str = ", ".join(str(n) for n in numbers)
+
+		is_chinese = re.search(r"[\u4e00-\u9fff]", self.question) is not None
+		if expression is not None:
+			last_message = f"{numbers_str} 可以算出 24：{expression} = 24" if is_chinese else f"{numbers_str} can make 24: {expression} = 24"
+		else:
+			last_message = f"{numbers_str} 无法通过加减乘除算出 24。" if is_chinese else f"There is no way to make 24 from {numbers_str} with +, -, * and /."
+		log_debug(lambda: f"++++++ local 24 solver: numbers={numbers}, expression={expression}, latency={latency_ms:.2f} ms")
+
+		return {
+			"last_message": last_message,
+			"chat_messages": [
+				{"role": "user", "content": self.question},
+				{"role": "assistant", "name": "local_24_solver", "content": last_message},
+			],
+		}
+
+	# +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+	def get_base_metadata(self):
+		metadata = {
+			"text2text_model": self.env["text2text_model"],
+			"temperature": self.temperature,
+			"chat_history_window": self.chat_history_window,
+		}
+
+		if self.env["files"]:
+			metadata["files"] = self.env["files"]
+		return metadata
+
+	# +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+	def build_autogen_response(self, res_json):
+		"""Save the question and the autogen answer to the chat history, and return the final response."""
+		log_debug(lambda: f"++++++ res_json: {res_json}")
+		metadata = self.get_base_metadata()
+		metadata["autogen_chat_messages"] = res_json["chat_messages"]
+
+		human_message = BaseMessage(
+			content=self.question,
+			type="human",
+		)
+		ai_message = BaseMessage(
+			content=res_json["last_message"],
+			type="ai",
+			additional_kwargs=metadata
+		)
+
+		history = self.get_session_history()
+		history.add_message(message=human_message)
+		history.add_message(message=ai_message)
+		history.flush(write_behind=self.env.get("history_write_behind", False))
+
+		final_response_with_metadata = {
+			"sessionId": self.session_id,
+			"type": "text",
+			"content": res_json["last_message"],
+			"metadata": metadata,
+		}
+		return final_response_with_metadata
 
 	# +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
-	def default_agent_with_tools(self):
+	def prepare_agent_with_tools(self, cancel_event=None, prefetch_retrieval=False):
+		"""
+		Build the tool agent of default_agent_with_tools (LLM, embeddings, OpenSearch stores, tools, memory, agent).
+
+		Args:
+			cancel_event: Optional threading.Event. When it is set, preparation stops at the next checkpoint by
+				raising SpeculationCancelled. Used by the speculative mode of default_agent.
+			prefetch_retrieval: If True, run the question against the CEI and DTH retrievers once. This warms up the
+				embedding endpoint and the OpenSearch connections, and keeps the documents in speculative_documents
+				(and in the retrieval cache, so the agent's lookups of the same question don't search again).
+
+		Returns:
+			A PreparedAgent. Nothing is assigned to self here, so this can run on a background thread; the caller
+			attaches the prepared state with adopt_prepared_agent() once it decides to use the agent.
+		"""
+		def check_cancelled(step):
+			if cancel_event is not None and cancel_event.is_set():
+				raise SpeculationCancelled(f"prepare_agent_with_tools() cancelled before {step}")
 
 		is_admin_str = os.environ.get("is_admin", "False")  # get the string from environment
 		is_admin = is_admin_str.lower() == "true"  # Convert a string to a boolean value, case-insensitive.
 		print(f"++++++ is_admin: {is_admin}")
   
-		self.llm = self.get_llm(is_admin=is_admin) if self.show_reasoning_acting_steps else self.get_llm(callbacks=CustomFinalOutputCallbackHandler, is_admin=is_admin)
+		check_cancelled("LLM construction")
+		llm = self.get_llm(is_admin=is_admin) if self.show_reasoning_acting_steps else self.get_llm(callbacks=CustomFinalOutputCallbackHandler, is_admin=is_admin)
 		
-		self.master_user_username = os.environ["OPENSEARCH_MASTER_USER_USERNAME"]
-		self.master_user_password = os.environ["OPENSEARCH_MASTER_USER_PASSWORD"]
 		os.environ["OPEN_SEARCH_ENDPOINT"] = "vpc-sagemind-dkzcnxsleqgjosbijmq24brggq.us-east-1.es.amazonaws.com"
   
-		self.k = self.env.get("k", 3)
-		self.embedding_model = self.env.get("embedding_model", "CSDC")
+		k = self.env.get("k", 3)
+		embedding_model = self.env.get("embedding_model", "CSDC")
 		
-		embeddings, index_name_cei, index_name_dth = self.get_embeddings_and_index_name_multi(self.embedding_model, "cei", "dth")
+		check_cancelled("vector stores")
+		embeddings, index_name_cei, index_name_dth = self.get_embeddings_and_index_name_multi(embedding_model, "cei", "dth")
 		vector_store_cei, vector_store_dth = self.get_vector_stores_from_indices(embeddings, index_name_cei, index_name_dth)
-		retriever_cei = vector_store_cei.as_retriever(search_type="similarity", search_kwargs={"k": self.k})
-		retriever_dth = vector_store_dth.as_retriever(search_type="similarity", search_kwargs={"k": self.k})
+		# Results of the retriever tools for this agent, also filled by the retrieval prefetch below
+		retrieval_cache = {}
+		check_cancelled("retrievers")
+		retriever_cei = self.get_retriever(vector_store_cei, index_name_cei, embeddings, k, retrieval_cache)
+		retriever_dth = self.get_retriever(vector_store_dth, index_name_dth, embeddings, k, retrieval_cache)
 
+		speculative_documents = {}
+		if prefetch_retrieval:
+			for index_name, retriever in ((index_name_cei, retriever_cei), (index_name_dth, retriever_dth)):
+				check_cancelled(f"retrieval prefetch of {index_name}")
+				try:
+					speculative_documents[index_name] = retriever.get_relevant_documents(self.question)
+				except Exception as e:
+					logger.warning(f"Retrieval prefetch of {index_name} failed. [Detailed Error Message]: {str(e)}")
   
 		# Step 1: Tools
 		tool_cei = create_retriever_tool(
@@ -530,6 +3364,12 @@ class PaletteUsecase(BaseUsecase):
 			description = "Useful for determining the weekday of today. This tool is used to check the weekday of today. It doesn't care what action input is. It always return the date of today in the YYYY-MM-DD format.",
 		)
   
+		tool_get_temperature_on_date = Tool.from_function(
+			name = "Temperature on Date Tool",
+			func = get_temperature_on_date,
+			description = "Preferred tool for questions about the temperature on a day. It returns the date, the weekday and the temperature (in Celsius) in one step, so you don't need the date, weekday and weather tools for that. The action input is the day in question, either a date in the YYYY-MM-DD format or a relative expression such as 'today', 'yesterday', 'two days ago', 'next Monday', 'last Friday', '前天' or '下周一'.",
+		)
+
 		# tool_arxiv = load_tools(["arxiv"])[0]
 		tool_youtube_search = YouTubeSearchTool()
 		tool_doc_reader = AwsDocReader(
@@ -550,16 +3390,16 @@ class PaletteUsecase(BaseUsecase):
 			tool_doc_reader,
 		]
   
-		tool_from_langchain_tools = load_tools(
-	  		["arxiv"], 
-			llm = self.llm,
-		)
-		tools.extend(tool_from_langchain_tools)
+		# The arxiv tool doesn't use the LLM, so it is loaded once per process
+		tools.extend(get_langchain_tools("arxiv"))
 
 		tool_list_ec2_instances = AwsListEc2Instances()
 		tool_shutdown_ec2_instances = AwsShutdownAnEc2Instance()
 		tool_start_ec2_instances = AwsStartAnEc2Instance()
   
+		if self.env.get("temperature_on_date_tool", True):
+			tools.insert(2, tool_get_temperature_on_date)
+
 		tools_admin = [
 			tool_list_ec2_instances, 
 			tool_shutdown_ec2_instances, 
@@ -568,7 +3408,26 @@ class PaletteUsecase(BaseUsecase):
   
 		if is_admin:
 			tools.extend(tools_admin)
+
+		# Expose only the tools relevant to the question (env 'tool_selection_top_k'), which shortens the prompt of
+		# every agent iteration. The DocReader is kept whenever files are attached.
+		tool_selection_top_k = self.env.get("tool_selection_top_k")
+		if tool_selection_top_k:
+			check_cancelled("tool selection")
+			try:
+				tools, _ = select_tools(
+					self.question,
+					tools,
+					embeddings,
+					embedding_model,
+					top_k = int(tool_selection_top_k),
+					always_include = [tool_doc_reader] if self.env["files"] else [],
+				)
+			except Exception as e:
+				logger.warning(f"Tool selection failed, using all tools. [Detailed Error Message]: {str(e)}")
 		
+		check_cancelled("agent construction")
+
 		# Step 2: Agent
 		# initialize_agent -> class AgentExecutor(Chain)
 		# https://github.com/langchain-ai/langchain/issues/4000
@@ -576,39 +3435,113 @@ class PaletteUsecase(BaseUsecase):
 		# https://github.com/langchain-ai/langchain/blob/afd96b24606e06f15bec4ee94d0ddfde121d894f/docs/snippets/modules/agents/agent_types/structured_chat.mdx#L203
   
 		chat_history_for_memory_prompts = MessagesPlaceholder(variable_name="chat_history")
-		self.memory = self.get_memory() 
-		print(f"++++++ chat_history_for_memory_prompts: {chat_history_for_memory_prompts}")
-		print(f"++++++ chat_history_for_memory_prompts.dict(): {chat_history_for_memory_prompts.dict()}")
-		print(f"++++++ chat_history_for_memory_prompts.json(): {chat_history_for_memory_prompts.json()}")
+		check_cancelled("chat history")
+		memory = self.get_memory()
+		log_debug(lambda: f"++++++ chat_history_for_memory_prompts: {chat_history_for_memory_prompts}")
+		log_debug(lambda: f"++++++ chat_history_for_memory_prompts.dict(): {chat_history_for_memory_prompts.dict()}")
+		log_debug(lambda: f"++++++ chat_history_for_memory_prompts.json(): {chat_history_for_memory_prompts.json()}")
   
-		max_iterations = 12 if self.text2text_model == "Bedrock"  else 6
-		agent = initialize_agent(
-			tools=tools, 
-			llm=self.llm, 
-			agent=AgentType.STRUCTURED_CHAT_ZERO_SHOT_REACT_DESCRIPTION, 
-			agent_kwargs={
-				"prefix": PREFIX,
-				"suffix": SUFFIX,
-				"format_instructions": FORMAT_INSTRUCTIONS,
-				"input_variables": ["input", "chat_history", "agent_scratchpad"],
-				"memory_prompts": [chat_history_for_memory_prompts],
-			},
-			# The following **kwargs are additional keyword arguments passed to the agent executor (Chain)
-			verbose=True,
-			memory = self.memory,
-			max_iterations=max_iterations,
+		budget = self.get_agent_budget()
+		agent_kwargs = {
+			"prefix": PREFIX,
+			"suffix": SUFFIX,
+			"format_instructions": FORMAT_INSTRUCTIONS,
+			"input_variables": ["input", "chat_history", "agent_scratchpad"],
+			"memory_prompts": [chat_history_for_memory_prompts],
+		}
+		# The following **kwargs are additional keyword arguments passed to the agent executor (Chain)
+		executor_kwargs = dict(
+			verbose=debug_enabled(),
+			memory = memory,
+			max_iterations=budget["max_iterations"],
+			max_execution_time=budget["max_execution_time"],
+			early_stopping_method=budget["early_stopping_method"],
 			return_intermediate_steps=True,
 		)
-  
+
+		if self.env.get("parallel_tools", False):
+			# The model may return several independent actions per step, which ParallelToolAgentExecutor runs concurrently.
+			agent_kwargs["format_instructions"] = FORMAT_INSTRUCTIONS + MULTI_ACTION_INSTRUCTIONS
+			agent = self.build_structured_chat_agent(
+				tools,
+				agent_kwargs = agent_kwargs,
+				executor_kwargs = executor_kwargs,
+				output_parser = StructuredChatOutputParserWithRetries.from_llm(llm=llm, base_parser=MultiActionStructuredChatOutputParser()),
+				executor_class = ParallelToolAgentExecutor,
+				is_admin = is_admin,
+				llm = llm,
+			)
+		else:
+			agent = self.build_structured_chat_agent(tools, agent_kwargs=agent_kwargs, executor_kwargs=executor_kwargs, is_admin=is_admin, llm=llm)
+
+		return PreparedAgent(
+			agent = agent,
+			llm = llm,
+			memory = memory,
+			k = k,
+			embedding_model = embedding_model,
+			retrieval_cache = retrieval_cache,
+			speculative_documents = speculative_documents,
+		)
+
+	# +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+	def adopt_prepared_agent(self, prepared):
+		"""Attach the state of a PreparedAgent to this request (on the request thread) and return its agent."""
+		self.llm = prepared.llm
+		self.memory = prepared.memory
+		self.k = prepared.k
+		self.embedding_model = prepared.embedding_model
+		self.retrieval_cache = prepared.retrieval_cache
+		self.speculative_documents = prepared.speculative_documents
+		return prepared.agent
+
+	# +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+	def default_agent_with_tools(self, prepared=None):
+		"""Run the tool agent. It is built by prepare_agent_with_tools() unless a PreparedAgent is passed in."""
+		agent = self.adopt_prepared_agent(prepared or self.prepare_agent_with_tools())
+
 		# Step 3: Run the agent
 		inputs = {'input': self.question} # the input_key is "input" in get_memory()
-		response = agent(inputs)
-		print(f"++++++ response: {response}")
+		response = self.run_agent(agent, inputs, run_name="default_agent_with_tools")
+		return self.finish_agent_with_tools(response)
+
+	# +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+	def default_agent_with_tools_stream(self, prepared=None):
+		"""
+		Streaming variant of default_agent_with_tools().
+
+		Yields:
+			{"sessionId", "type": "agent_action" | "agent_observation", "content": <step dict>} for every tool call
+			and tool result as soon as it happens (see QueueCallbackHandler), and finally the same response as
+			default_agent_with_tools() (type "text"), whose 'reasoning_acting_steps' are serialized from the raw
+			intermediate steps the same way.
+		"""
+		agent = self.adopt_prepared_agent(prepared or self.prepare_agent_with_tools())
+
+		event_queue = queue.Queue()
+		handler = QueueCallbackHandler(event_queue, stream_tokens=False)
+		inputs = {'input': self.question} # the input_key is "input" in get_memory()
+
+		stream = iterate_in_background(lambda: self.run_agent(agent, inputs, callbacks=[handler], run_name="default_agent_with_tools"), event_queue)
+		while True:
+			try:
+				event_type, content = next(stream)
+			except StopIteration as stop:
+				response = stop.value
+				break
+			yield {"sessionId": self.session_id, "type": event_type, "content": content}
+
+		yield self.finish_agent_with_tools(response)
+
+	# +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+	def finish_agent_with_tools(self, response):
+		"""Save the metadata of an agent response and return the final response."""
+		log_debug(lambda: f"++++++ response: {response}")
   
 		# serialize intermediate_steps
 		# intermediate_steps_serializable = self.serialize_intermediate_steps(response.get("intermediate_steps", []))
 		intermediate_steps_serializable = [self.serialize_agent_action(step) for step in response.get("intermediate_steps", [])]
-		print(f"++++++ intermediate_steps_serializable: {intermediate_steps_serializable}")
+		log_debug(lambda: f"++++++ intermediate_steps_serializable: {intermediate_steps_serializable}")
   
 	
 		metadata = {
@@ -621,7 +3554,7 @@ class PaletteUsecase(BaseUsecase):
 		if self.env["files"]:
 			metadata["files"] = self.env["files"]
    
-		self.chat_history.add_metadata(metadata)
+		self.save_chat_history(metadata)
 
 		final_response_with_metadata = {
 			"sessionId": self.session_id,
@@ -636,6 +3569,14 @@ class PaletteUsecase(BaseUsecase):
 	def run(self, agent_id="awsOps"):
 		self.agent_id = agent_id
 		self.show_reasoning_acting_steps = self.env.get("show_reasoning_acting_steps", True)
+
+		# Exact-match cache of temperature-0 LLM calls (router, chatbot, agent steps) which don't stream (see
+		# get_llm). 'llm_cache_path' adds a SQLite tier under /tmp, which outlives the requests of the container.
+		configure_llm_cache(
+			enabled = self.env.get("llm_cache", True),
+			maxsize = int(self.env.get("llm_cache_size", 1024)),
+			path = self.env.get("llm_cache_path"),
+		)
   
 		# self.text2text_model = "Bedrock"
   
@@ -643,12 +3584,16 @@ class PaletteUsecase(BaseUsecase):
 		# self.files = self.env.get("files", [])
 		# os.environ["files"] = json.dumps(self.files)
   
+		# env 'streaming' returns a generator of events (see chatbot_stream and default_agent_with_tools_stream)
+		# instead of the final response.
+		streaming = self.env.get("streaming", False)
+
 		if agent_id == "default_agent":
-			return self.default_agent()
+			return self.default_agent(streaming=streaming)
 		elif agent_id == "default_agent_without_routing":
-			return self.default_agent_with_tools() 
+			return self.default_agent_with_tools_stream() if streaming else self.default_agent_with_tools() 
 		elif agent_id == "Chatbot":
-			return self.chatbot() # for debug's purpose
+			return self.chatbot_stream() if streaming else self.chatbot() # for debug's purpose
 		else:
-			return self.default_agent()
+			return self.default_agent(streaming=streaming)
 		
\ No newline at end of file
@@ -0,0 +1,29 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def make_usecase():
+	"""Build a PaletteUsecase for a question, with an in-memory chat history instead of the DynamoDB one."""
+	pytest.importorskip("genai_core")
+	from langchain.memory import ChatMessageHistory
+	import palette
+
+	def make(question, **env):
+		usecase = palette.PaletteUsecase.__new__(palette.PaletteUsecase)
+		usecase.env = {"text2text_model": "OpenAI", "temperature": 0, "chat_history_window": 10, "files": [], **env}
+		usecase.question = question
+		usecase.session_id = "test-session"
+		usecase.user_id = "test-user"
+		usecase.message = {}
+		usecase.text2text_model = usecase.env["text2text_model"]
+		usecase.temperature = usecase.env["temperature"]
+		usecase.chat_history_window = usecase.env["chat_history_window"]
+		usecase.chat_history = ChatMessageHistory()
+		usecase.show_reasoning_acting_steps = True
+		return usecase
+	return make
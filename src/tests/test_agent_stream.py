@@ -0,0 +1,176 @@
+import json
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("genai_core")
+
+from langchain.agents import Tool
+from langchain.llms.fake import FakeListLLM
+from langchain.memory import ConversationBufferWindowMemory
+from langchain.schema import Document
+
+import palette
+
+
+def action(tool, tool_input):
+	return f"Action:\n```json\n{json.dumps({'action': tool, 'action_input': tool_input})}\n```"
+
+
+def parallel_actions(*actions):
+	return "Action:\n```json\n" + json.dumps([{"action": tool, "action_input": tool_input} for tool, tool_input in actions]) + "\n```"
+
+
+FINAL_ANSWER = action("Final Answer", "It is 20 degrees on Monday.")
+
+
+def slow_tool(name, result, delay=0.0):
+	def run(tool_input):
+		time.sleep(delay)
+		return f"{result} ({tool_input})"
+	return Tool.from_function(name=name, func=run, description=f"Returns the {name.lower()}.")
+
+
+@pytest.fixture
+def agent_usecase(make_usecase, monkeypatch):
+	monkeypatch.setattr(palette, "debug_enabled", lambda: False)
+	usecase = make_usecase("What is the temperature on Monday?", agent_template_cache=False)
+	usecase.saved_metadata = []
+	usecase.save_chat_history = usecase.saved_metadata.append
+	return usecase
+
+
+def prepare(usecase, responses, tools, parallel=False):
+	llm = FakeListLLM(responses=responses)
+	memory = ConversationBufferWindowMemory(memory_key="chat_history", input_key="input", output_key="output", k=10)
+	agent_kwargs = {"input_variables": ["input", "agent_scratchpad"]}
+	executor_kwargs = {"memory": memory, "return_intermediate_steps": True, "max_iterations": 6}
+	if parallel:
+		agent = usecase.build_structured_chat_agent(
+			tools,
+			agent_kwargs = agent_kwargs,
+			executor_kwargs = executor_kwargs,
+			output_parser = palette.MultiActionStructuredChatOutputParser(),
+			executor_class = palette.ParallelToolAgentExecutor,
+			llm = llm,
+		)
+	else:
+		agent = usecase.build_structured_chat_agent(tools, agent_kwargs=agent_kwargs, executor_kwargs=executor_kwargs, llm=llm)
+	return palette.PreparedAgent(
+		agent = agent,
+		llm = llm,
+		memory = memory,
+		k = 10,
+		embedding_model = None,
+		retrieval_cache = None,
+		speculative_documents = None,
+	)
+
+
+def test_agent_stream_emits_each_step_as_it_happens(agent_usecase):
+	tools = [slow_tool("Date", "2024-01-01"), slow_tool("Weather", "20 degrees")]
+	responses = [action("Date", "today"), action("Weather", "Monday"), FINAL_ANSWER]
+
+	events = list(agent_usecase.default_agent_with_tools_stream(prepare(agent_usecase, responses, tools)))
+
+	assert [event["type"] for event in events] == ["agent_action", "agent_observation", "agent_action", "agent_observation", "text"]
+	assert events[1]["content"] == {"step": 1, "tool": "Date", "result": "2024-01-01 (today)"}
+	assert events[3]["content"] == {"step": 2, "tool": "Weather", "result": "20 degrees (Monday)"}
+	assert events[-1]["content"] == "It is 20 degrees on Monday."
+
+
+def test_agent_stream_metadata_matches_the_blocking_agent(agent_usecase):
+	tools = [slow_tool("Date", "2024-01-01"), slow_tool("Weather", "20 degrees")]
+	responses = [action("Date", "today"), action("Weather", "Monday"), FINAL_ANSWER]
+
+	streamed = list(agent_usecase.default_agent_with_tools_stream(prepare(agent_usecase, responses, tools)))[-1]
+	blocking = agent_usecase.default_agent_with_tools(prepare(agent_usecase, responses, tools))
+
+	assert streamed["metadata"]["reasoning_acting_steps"] == blocking["metadata"]["reasoning_acting_steps"]
+	assert len(streamed["metadata"]["reasoning_acting_steps"]) == 2
+
+
+def test_agent_stream_stores_retrieved_documents_like_the_blocking_agent(agent_usecase):
+	def retrieve(tool_input):
+		return [Document(page_content="CEI pays " + "x" * 5000, metadata={"source": "s3://kb/cei.md"})]
+
+	tools = [Tool.from_function(name="CEI", func=retrieve, description="Looks up CEI documents.")]
+	responses = [action("CEI", "incentive"), FINAL_ANSWER]
+
+	streamed = list(agent_usecase.default_agent_with_tools_stream(prepare(agent_usecase, responses, tools)))[-1]
+	blocking = agent_usecase.default_agent_with_tools(prepare(agent_usecase, responses, tools))
+
+	steps = streamed["metadata"]["reasoning_acting_steps"]
+	assert steps == blocking["metadata"]["reasoning_acting_steps"]
+	result, = steps[0]["result"]
+	assert (result["id"], result["truncated"]) == ("s3://kb/cei.md", True)
+
+
+def test_agent_stream_matches_parallel_tool_results_to_their_actions(agent_usecase):
+	tools = [slow_tool("Date", "2024-01-01", delay=0.05), slow_tool("Weather", "20 degrees")]
+	responses = [parallel_actions(("Date", "today"), ("Weather", "Monday")), FINAL_ANSWER]
+
+	events = list(agent_usecase.default_agent_with_tools_stream(prepare(agent_usecase, responses, tools, parallel=True)))
+
+	observations = {event["content"]["tool"]: event["content"] for event in events if event["type"] == "agent_observation"}
+	assert observations["Date"]["step"] == 1
+	assert observations["Weather"]["step"] == 2
+	steps = events[-1]["metadata"]["reasoning_acting_steps"]
+	assert [(step["action"]["tool"], step["result"]) for step in steps] == [
+		("Date", "2024-01-01 (today)"),
+		("Weather", "20 degrees (Monday)"),
+	]
+
+
+def test_run_selects_the_streaming_agent(agent_usecase, monkeypatch):
+	monkeypatch.setattr(palette, "configure_llm_cache", lambda **kwargs: None)
+	tools = [slow_tool("Date", "2024-01-01")]
+	prepared = prepare(agent_usecase, [action("Date", "today"), FINAL_ANSWER], tools)
+	agent_usecase.prepare_agent_with_tools = lambda **kwargs: prepared
+	agent_usecase.env["streaming"] = True
+
+	events = list(agent_usecase.run("default_agent_without_routing"))
+
+	assert [event["type"] for event in events] == ["agent_action", "agent_observation", "text"]
+
+
+def test_parallel_tools_run_on_the_tool_executor(agent_usecase):
+	threads = []
+
+	def record_thread(tool_input):
+		threads.append(threading.current_thread().name)
+		time.sleep(0.02)
+		return tool_input
+
+	tools = [Tool.from_function(name=name, func=record_thread, description=name) for name in ("Date", "Weather")]
+	responses = [parallel_actions(("Date", "today"), ("Weather", "Monday")), FINAL_ANSWER]
+
+	list(agent_usecase.default_agent_with_tools_stream(prepare(agent_usecase, responses, tools, parallel=True)))
+
+	# The stream runs the agent on background_executor, so its tools must not wait for tasks of that pool
+	assert len(threads) == 2
+	assert all(name.startswith("palette-tool") for name in threads)
+
+
+def test_trace_records_one_step_for_concurrent_tools(agent_usecase):
+	tools = [slow_tool(name, name, delay=0.02) for name in ("A", "B", "C", "D")]
+	responses = [parallel_actions(*[(name, name) for name in ("A", "B", "C", "D")]), FINAL_ANSWER]
+
+	agent_usecase.default_agent_with_tools(prepare(agent_usecase, responses, tools, parallel=True))
+
+	records = agent_usecase.last_agent_trace.records
+	assert [record.get("tools") for record in records] == [["A", "B", "C", "D"], None]
+	assert 20 <= records[0]["tool_latency_ms"] < 80
+
+
+def test_unparsable_parallel_actions_are_fixed_by_the_llm():
+	fixed = parallel_actions(("Date", "today"), ("Weather", "Monday"))
+	parser = palette.StructuredChatOutputParserWithRetries.from_llm(
+		llm = FakeListLLM(responses=[fixed]),
+		base_parser = palette.MultiActionStructuredChatOutputParser(),
+	)
+
+	actions = parser.parse("Action:\n```json\n[{\"action\": \"Date\", \"action_input\": \"today\"},\n```")
+
+	assert [(action.tool, action.tool_input) for action in actions] == [("Date", "today"), ("Weather", "Monday")]
@@ -0,0 +1,161 @@
+import re
+from decimal import Decimal
+
+import pytest
+
+pytest.importorskip("genai_core")
+
+from langchain.schema.messages import AIMessage, HumanMessage, messages_to_dict
+
+import palette
+
+
+class FakeTable:
+	"""Stand-in for the DynamoDB table of the chat history: one item per session with a "History" list."""
+	INDEX_PATTERN = re.compile(r"#history\[(\d+)\]")
+
+	def __init__(self):
+		self.items = {}
+		self.requests = []
+
+	def get_item(self, Key, ProjectionExpression, ExpressionAttributeNames):
+		self.requests.append(("get_item", ProjectionExpression))
+		item = self.items.get((Key["SessionId"], Key["UserId"]))
+		if item is None:
+			return {}
+		indices = [int(index) for index in self.INDEX_PATTERN.findall(ProjectionExpression)]
+		if not indices:
+			return {"Item": {"History": list(item["History"])}}
+		# Like DynamoDB, indices past the end of the list are left out
+		return {"Item": {"History": [item["History"][i] for i in indices if i < len(item["History"])]}}
+
+	def update_item(self, Key, UpdateExpression, ExpressionAttributeNames, ExpressionAttributeValues):
+		self.requests.append(("update_item", UpdateExpression))
+		assert "list_append(if_not_exists(#history, :empty), :messages)" in UpdateExpression
+		item = self.items.setdefault((Key["SessionId"], Key["UserId"]), {"History": []})
+		item["History"] = item["History"] + ExpressionAttributeValues[":messages"]
+		item["StartTime"] = ExpressionAttributeValues[":now"]
+
+
+class FakeDynamoDBHistory:
+	"""The parts of the DynamoDB chat history of genai_core used by WindowedChatMessageHistory."""
+	def __init__(self, table, session_id="session", user_id="user"):
+		self.table = table
+		self.session_id = session_id
+		self.user_id = user_id
+
+	def append(self, *messages):
+		"""Append messages directly, as another process would."""
+		item = self.table.items.setdefault((self.session_id, self.user_id), {"History": []})
+		item["History"].extend(messages_to_dict(list(messages)))
+
+
+def turns(start, count):
+	messages = []
+	for i in range(start, start + count):
+		messages += [HumanMessage(content=f"question {i}"), AIMessage(content=f"answer {i}")]
+	return messages
+
+
+@pytest.fixture
+def history(monkeypatch):
+	monkeypatch.setattr(palette, "session_history_lengths", palette.LRUCache(maxsize=16))
+	history = FakeDynamoDBHistory(FakeTable())
+	history.append(*turns(0, 5))
+	return history
+
+
+def read(history, window=4):
+	windowed = palette.WindowedChatMessageHistory(history, window=window)
+	return [message.content for message in windowed.messages], windowed.offset
+
+
+def test_first_read_loads_the_list_once_and_remembers_its_length(history):
+	contents, offset = read(history)
+
+	assert contents == ["question 3", "answer 3", "question 4", "answer 4"]
+	assert offset == 6
+	assert history.table.requests == [("get_item", "#history")]
+	assert palette.session_history_lengths.get("session\x00user") == 10
+
+
+def test_next_reads_project_the_tail_only(history):
+	read(history)
+	history.table.requests.clear()
+
+	contents, offset = read(history)
+
+	assert contents == ["question 3", "answer 3", "question 4", "answer 4"]
+	assert offset == 6
+	expected = ", ".join(f"#history[{i}]" for i in range(6, 10 + palette.WindowedChatMessageHistory.PREFETCH_SLACK))
+	assert history.table.requests == [("get_item", expected)]
+
+
+def test_messages_appended_by_another_process_are_detected(history):
+	read(history)
+	history.append(*turns(5, 1))
+	history.table.requests.clear()
+
+	contents, offset = read(history)
+
+	assert contents == ["question 4", "answer 4", "question 5", "answer 5"]
+	assert offset == 8
+	assert len(history.table.requests) == 1
+	assert palette.session_history_lengths.get("session\x00user") == 12
+
+
+def test_more_new_messages_than_the_slack_read_the_whole_list(history):
+	read(history)
+	history.append(*turns(5, 3))
+	history.table.requests.clear()
+
+	contents, offset = read(history)
+
+	assert contents == ["question 6", "answer 6", "question 7", "answer 7"]
+	assert offset == 12
+	assert history.table.requests[-1] == ("get_item", "#history")
+
+
+def test_a_cleared_session_is_read_again(history):
+	read(history)
+	history.table.items.clear()
+
+	assert read(history) == ([], 0)
+
+
+def test_a_turn_is_written_in_one_list_append(history):
+	read(history)
+	history.table.requests.clear()
+	windowed = palette.WindowedChatMessageHistory(history, window=4, batch_writes=True)
+	windowed.add_user_message("question 5")
+	windowed.add_ai_message("answer 5")
+	windowed.add_metadata({"temperature": 0.7, "text2text_model": "OpenAI"})
+
+	assert history.table.requests == []
+	windowed.flush()
+
+	assert [request for request, _ in history.table.requests] == ["update_item"]
+	stored = history.table.items[("session", "user")]["History"]
+	assert [message["data"]["content"] for message in stored[-2:]] == ["question 5", "answer 5"]
+	# DynamoDB rejects floats, so numbers in the metadata are stored as Decimal
+	assert stored[-1]["data"]["additional_kwargs"] == {"temperature": Decimal("0.7"), "text2text_model": "OpenAI"}
+	assert palette.session_history_lengths.get("session\x00user") == 12
+
+	history.table.requests.clear()
+	contents, offset = read(history)
+	assert contents == ["question 4", "answer 4", "question 5", "answer 5"]
+	assert offset == 8
+	assert history.table.requests[0][1] != "#history"
+
+
+def test_large_reasoning_steps_are_compressed():
+	steps = [{"action": {"tool": "CEI"}, "result": "x" * 2000}]
+	windowed = palette.WindowedChatMessageHistory(None, compress_threshold=1000)
+	large, = messages_to_dict([AIMessage(content="answer", additional_kwargs={"reasoning_acting_steps": steps, "temperature": 0})])
+	small, = messages_to_dict([AIMessage(content="answer", additional_kwargs={"reasoning_acting_steps": steps[:0]})])
+
+	compressed = windowed.compress_message_dict(large)["data"]["additional_kwargs"]
+
+	assert "reasoning_acting_steps" not in compressed and compressed["temperature"] == 0
+	assert palette.decompress_reasoning_steps(compressed) == steps
+	assert windowed.compress_message_dict(small) == small
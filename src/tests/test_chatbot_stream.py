@@ -0,0 +1,88 @@
+import time
+from typing import Any, List, Optional
+
+import pytest
+
+pytest.importorskip("genai_core")
+
+from langchain.callbacks.manager import CallbackManagerForLLMRun
+from langchain.chat_models.base import SimpleChatModel
+from langchain.memory import ConversationBufferWindowMemory
+from langchain.prompts import PromptTemplate
+from langchain.schema.messages import BaseMessage
+
+import palette
+
+ANSWER = "Streaming sends every token to the client as soon as the model emits it, instead of the whole answer at the end."
+TOKEN_DELAY = 0.01
+
+
+class FakeStreamingChatModel(SimpleChatModel):
+	"""Chat model which emits ANSWER word by word, TOKEN_DELAY seconds apart, like a streaming endpoint."""
+	streaming: bool = False
+
+	@property
+	def _llm_type(self) -> str:
+		return "fake-streaming-chat"
+
+	def _call(
+		self,
+		messages: List[BaseMessage],
+		stop: Optional[List[str]] = None,
+		run_manager: Optional[CallbackManagerForLLMRun] = None,
+		**kwargs: Any,
+	) -> str:
+		for token in ANSWER.split(" "):
+			time.sleep(TOKEN_DELAY)
+			if self.streaming and run_manager:
+				run_manager.on_llm_new_token(token + " ")
+		return ANSWER
+
+
+@pytest.fixture
+def chatbot_usecase(make_usecase, monkeypatch):
+	monkeypatch.setattr(palette, "debug_enabled", lambda: False)
+	usecase = make_usecase("How does streaming reduce latency?")
+	usecase.saved_metadata = []
+	usecase.get_llm = lambda streaming=False, **kwargs: FakeStreamingChatModel(streaming=streaming)
+	usecase.get_memory = lambda: ConversationBufferWindowMemory(memory_key="chat_history", input_key="question", k=10)
+	usecase.get_chatbot_prompt = lambda **kwargs: PromptTemplate.from_template("{chat_history}\nHuman: {question}\nAssistant:")
+	usecase.save_chat_history = usecase.saved_metadata.append
+	return usecase
+
+
+def test_chatbot_stream_yields_tokens_then_the_chatbot_response(chatbot_usecase):
+	events = list(chatbot_usecase.chatbot_stream())
+
+	tokens = [event["content"] for event in events if event["type"] == "token"]
+	assert len(tokens) == len(ANSWER.split(" "))
+	assert "".join(tokens).strip() == ANSWER
+	assert events[-1]["type"] == "text"
+	assert events[-1]["content"] == ANSWER
+	assert len(chatbot_usecase.saved_metadata) == 1
+
+
+def test_chatbot_stream_time_to_first_token(chatbot_usecase):
+	start = time.perf_counter()
+	chatbot_usecase.chatbot()
+	blocking_ms = (time.perf_counter() - start) * 1000
+
+	profile = palette.measure_time_to_first_token(chatbot_usecase.chatbot_stream())
+
+	# The blocking chatbot answers after the whole generation; the stream shows the first token after one delay.
+	assert profile["tokens"] == len(ANSWER.split(" "))
+	assert profile["response"]["content"] == ANSWER
+	assert profile["ttft_ms"] < blocking_ms / 4
+	assert profile["ttft_ms"] < profile["total_ms"] / 4
+
+
+def test_run_selects_the_streaming_chatbot(chatbot_usecase, monkeypatch):
+	monkeypatch.setattr(palette, "configure_llm_cache", lambda **kwargs: None)
+	chatbot_usecase.env["streaming"] = True
+
+	events = chatbot_usecase.run("Chatbot")
+
+	assert not isinstance(events, dict)
+	events = list(events)
+	assert events[0]["type"] == "token"
+	assert events[-1]["type"] == "text"
@@ -0,0 +1,142 @@
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("genai_core")
+
+import palette
+
+
+def fake_embed_batch(texts):
+	return [[float(len(text))] for text in texts]
+
+
+def test_concurrent_queries_are_embedded_in_one_batch():
+	batches = []
+
+	def embed_batch(texts):
+		batches.append((list(texts), threading.current_thread().name))
+		return fake_embed_batch(texts)
+
+	batcher = palette.EmbeddingBatcher(embed_batch, max_wait=0.05)
+	futures = [batcher.submit(text) for text in ("a", "bb", "a", "ccc")]
+
+	assert [future.result(timeout=1) for future in futures] == [[1.0], [2.0], [1.0], [3.0]]
+	assert [texts for texts, _ in batches] == [["a", "bb", "ccc"]]
+	# Not on background_executor, where the callers of embed_query may be waiting
+	assert batches[0][1].startswith("palette-embedding-batch")
+
+
+def test_every_caller_fails_when_the_batch_returns_too_few_vectors():
+	batcher = palette.EmbeddingBatcher(lambda texts: fake_embed_batch(texts)[:1], max_wait=0.05)
+	futures = [batcher.submit(text) for text in ("a", "bb")]
+
+	for future in futures:
+		with pytest.raises(ValueError):
+			future.result(timeout=1)
+
+
+def test_every_caller_fails_when_the_batch_fails():
+	def embed_batch(texts):
+		raise ConnectionError("endpoint unavailable")
+
+	batcher = palette.EmbeddingBatcher(embed_batch, max_wait=0.05)
+	futures = [batcher.submit(text) for text in ("a", "bb")]
+
+	for future in futures:
+		with pytest.raises(ConnectionError):
+			future.result(timeout=1)
+
+
+def test_batches_of_one_batcher_are_limited_to_max_in_flight():
+	in_flight, peak = [0], [0]
+	lock = threading.Lock()
+
+	def slow_embed_batch(texts):
+		with lock:
+			in_flight[0] += 1
+			peak[0] = max(peak[0], in_flight[0])
+		time.sleep(0.05)
+		with lock:
+			in_flight[0] -= 1
+		return fake_embed_batch(texts)
+
+	batcher = palette.EmbeddingBatcher(slow_embed_batch, max_batch_size=1, max_wait=0, max_in_flight=2)
+	futures = [batcher.submit(text) for text in ("a", "bb", "ccc", "dddd", "eeeee")]
+
+	assert [future.result(timeout=2) for future in futures] == [[1.0], [2.0], [3.0], [4.0], [5.0]]
+	assert peak[0] == 2
+
+
+def test_batched_query_waits_for_the_embedding_deadline_only():
+	def slow_embed_batch(texts):
+		time.sleep(0.5)
+		return fake_embed_batch(texts)
+
+	embeddings = palette.DeadlineEmbeddings(
+		None,
+		name = "embeddings:test-batcher",
+		deadline = 0.05,
+		batcher = palette.EmbeddingBatcher(slow_embed_batch, max_wait=0.005),
+	)
+
+	start = time.monotonic()
+	with pytest.raises(TimeoutError):
+		embeddings.embed_query("question")
+	assert time.monotonic() - start < 0.4
+
+
+class FakeLocalEmbeddings:
+	"""Stand-in for LocalBGEEmbeddings which records its configuration."""
+	def __init__(self, model_dir, batch_size, intra_op_threads, query_instruction):
+		self.model_dir = model_dir
+		self.batch_size = batch_size
+
+	def embed_documents(self, texts):
+		return fake_embed_batch(texts)
+
+
+@pytest.fixture
+def local_model(monkeypatch):
+	monkeypatch.setattr(palette, "LocalBGEEmbeddings", FakeLocalEmbeddings)
+	monkeypatch.setattr(palette, "embeddings_cache", palette.LRUCache(maxsize=8))
+	monkeypatch.setattr(palette, "embedding_batchers", {})
+
+
+def test_requests_keep_their_own_deadline_and_hedging(make_usecase, local_model):
+	first = make_usecase("q", embedding_deadline=1).get_embeddings("Local")
+	second = make_usecase("q", embedding_deadline=5, embedding_hedge=True).get_embeddings("Local")
+
+	assert (first.deadline, first.hedge) == (1.0, False)
+	assert (second.deadline, second.hedge) == (5.0, True)
+	assert first.embeddings is second.embeddings
+
+
+def test_embedding_config_is_part_of_the_cache_key(make_usecase, local_model):
+	plain = make_usecase("q").get_embeddings("Local")
+	batched = make_usecase("q", embedding_batching=True).get_embeddings("Local")
+	larger_batches = make_usecase("q", embedding_batching=True, embedding_batch_size=64).get_embeddings("Local")
+	other_model = make_usecase("q", local_embedding_model_dir="/opt/models/other").get_embeddings("Local")
+
+	assert plain.batcher is None
+	assert batched.batcher is not None and batched.batcher.max_batch_size == 32
+	assert larger_batches.batcher.max_batch_size == 64
+	assert other_model.embeddings.model_dir == "/opt/models/other"
+	assert other_model.embeddings is not plain.embeddings
+	assert make_usecase("q", embedding_batching=True).get_embeddings("Local").batcher is batched.batcher
+
+
+def test_breaker_thresholds_belong_to_each_check(monkeypatch):
+	monkeypatch.setattr(palette, "endpoint_breakers", {})
+	monkeypatch.setattr(palette, "endpoint_latencies", {})
+	_, breaker = palette.get_endpoint_state("embeddings:test-breaker")
+	for _ in range(3):
+		breaker.record_failure()
+
+	assert palette.get_endpoint_state("embeddings:test-breaker")[1] is breaker
+	assert breaker.is_open(max_failures=3, cooldown=30)
+	assert not breaker.is_open(max_failures=5, cooldown=30)
+	assert not breaker.is_open(max_failures=3, cooldown=0)
+	breaker.record_success()
+	assert not breaker.is_open(max_failures=1, cooldown=30)
@@ -0,0 +1,115 @@
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("genai_core")
+
+import palette
+
+
+class FakeImageBackend:
+	"""Local stand-in for an image model: answers with an ImageUsecase-like response after latency seconds."""
+	name = "fake"
+
+	def __init__(self, latency=0.0, supports_seed=True, failing_seeds=()):
+		self.latency = latency
+		self.supports_seed = supports_seed
+		self.failing_seeds = set(failing_seeds)
+		self.calls = []
+		self.lock = threading.Lock()
+
+	def generate(self, prompt, seed):
+		with self.lock:
+			self.calls.append(seed)
+		time.sleep(self.latency)
+		if seed in self.failing_seeds:
+			raise RuntimeError(f"model error for seed {seed}")
+		return {"type": "image", "content": [f"{prompt} (seed {seed})"], "metadata": {"model": "fake"}}
+
+
+@pytest.fixture
+def image_usecase(make_usecase, monkeypatch):
+	monkeypatch.setattr(palette, "image_cache", palette.LRUCache(maxsize=16))
+	usecase = make_usecase("Generate 4 images of a puppy", image_max_parallel=4)
+	usecase.image_backend = FakeImageBackend(latency=0.1)
+	return usecase
+
+
+def test_images_are_generated_concurrently(image_usecase):
+	start = time.perf_counter()
+	response = image_usecase.image_agent("a puppy", 4)
+	elapsed = time.perf_counter() - start
+
+	assert elapsed < 0.3
+	assert response["type"] == "image"
+	assert response["content"] == ["a puppy (seed None)"] * 4
+	assert response["metadata"]["model"] == "fake"
+
+
+def test_streaming_default_agent_yields_each_image_as_it_is_ready(image_usecase):
+	image_usecase.route_question = lambda: {"category": palette.ROUTE_IMAGES, "content_of_images": "a puppy", "number": 4}
+	image_usecase.image_backend.latency = 0.2
+	image_usecase.env["image_max_parallel"] = 2
+
+	start = time.perf_counter()
+	events = image_usecase.default_agent(streaming=True)
+	first = next(events)
+	first_elapsed = time.perf_counter() - start
+	rest = list(events)
+
+	assert first_elapsed < 0.3
+	assert [event["type"] for event in [first, *rest]] == ["image_partial"] * 4 + ["image"]
+	assert sorted(event["metadata"]["index"] for event in [first, *rest[:-1]]) == [0, 1, 2, 3]
+	assert len(rest[-1]["content"]) == 4
+
+
+def test_a_failed_image_is_reported_without_stopping_the_others(image_usecase):
+	image_usecase.env["image_seed"] = 1
+	image_usecase.image_backend = FakeImageBackend(failing_seeds={2})
+
+	events = list(image_usecase.image_agent_stream("a puppy", 3))
+
+	failed = [event for event in events[:-1] if event["content"] is None]
+	assert [event["metadata"]["index"] for event in failed] == [1]
+	assert events[-1]["content"] == ["a puppy (seed 1)", "a puppy (seed 3)"]
+	assert events[-1]["metadata"]["errors"] == [{"index": 1, "seed": 2, "error": "model error for seed 2"}]
+
+
+def test_all_images_failing_still_ends_the_stream(image_usecase):
+	image_usecase.env["image_seed"] = 1
+	image_usecase.image_backend = FakeImageBackend(failing_seeds={1, 2})
+
+	response = image_usecase.image_agent("a puppy", 2)
+
+	assert response["type"] == "text"
+	assert len(response["metadata"]["errors"]) == 2
+
+
+def test_images_are_cached_per_prompt_and_seed(image_usecase):
+	image_usecase.env["image_seed"] = 7
+	backend = image_usecase.image_backend
+
+	first = image_usecase.image_agent("a puppy", 2)
+	second = image_usecase.image_agent("a puppy", 3)
+
+	assert sorted(backend.calls) == [7, 8, 9]
+	assert second["content"][:2] == first["content"]
+	assert second["metadata"]["seeds"] == [7, 8, 9]
+
+
+def test_backends_without_seeds_are_never_cached(image_usecase):
+	image_usecase.env["image_seed"] = 7
+	image_usecase.image_backend = backend = FakeImageBackend(supports_seed=False)
+
+	image_usecase.image_agent("a puppy", 2)
+	response = image_usecase.image_agent("a puppy", 2)
+
+	assert backend.calls == [None] * 4
+	assert response["metadata"]["seeds"] == [None, None]
+
+
+def test_fake_backend_cannot_be_selected_by_a_request(make_usecase):
+	usecase = make_usecase("Generate an image of a puppy", image_backend="fake")
+
+	assert isinstance(usecase.get_image_backend(), palette.ImageUsecaseBackend)
@@ -0,0 +1,74 @@
+import os
+
+import pytest
+
+import ingestion
+
+
+@pytest.fixture
+def knowledge_base(tmp_path):
+	allowed = tmp_path / "kb"
+	allowed.mkdir()
+	(allowed / "a.md").write_text("allowed document", encoding="utf-8")
+	secret = tmp_path / "secret.txt"
+	secret.write_text("AWS_SECRET_ACCESS_KEY=...", encoding="utf-8")
+	return allowed, secret
+
+
+def test_allowed_directory_is_read(knowledge_base):
+	allowed, _ = knowledge_base
+
+	documents = list(ingestion.iter_source_documents([str(allowed)], [str(allowed)]))
+
+	assert documents == [(str(allowed / "a.md"), "allowed document")]
+
+
+@pytest.mark.parametrize("source", [
+	"{allowed}/../secret.txt",
+	"{secret}",
+	"/proc/self/environ",
+	"s3://kb-bucket/cei/doc.md",
+])
+def test_sources_outside_the_allow_list_are_denied(knowledge_base, source):
+	allowed, secret = knowledge_base
+
+	with pytest.raises(PermissionError):
+		list(ingestion.iter_source_documents([source.format(allowed=allowed, secret=secret)], [str(allowed)]))
+
+
+def test_symlinks_out_of_an_allowed_directory_are_skipped(knowledge_base):
+	allowed, secret = knowledge_base
+	os.symlink(secret, allowed / "link.md")
+
+	documents = list(ingestion.iter_source_documents([str(allowed)], [str(allowed)]))
+
+	assert [source for source, _ in documents] == [str(allowed / "a.md")]
+
+
+@pytest.mark.parametrize("source, expected", [
+	("s3://kb-bucket/cei/doc.md", True),
+	("s3://kb-bucket/cei", True),
+	("s3://kb-bucket/cei-private/doc.md", False),
+	("s3://kb-bucket-evil/cei/doc.md", False),
+	("s3://other/cei/doc.md", False),
+])
+def test_s3_sources_must_be_within_an_allowed_prefix(source, expected):
+	assert ingestion.is_allowed_source(source, ["s3://kb-bucket/cei"]) is expected
+
+
+def test_nothing_is_allowed_without_an_allow_list(knowledge_base, monkeypatch):
+	allowed, _ = knowledge_base
+	monkeypatch.delenv("INGESTION_ALLOWED_SOURCES", raising=False)
+
+	with pytest.raises(PermissionError):
+		ingestion.ingest_knowledge_base(None, "kb_index", None, "CEI", [str(allowed)])
+
+
+def test_run_does_not_ingest(make_usecase, monkeypatch):
+	import palette
+	usecase = make_usecase("hello", knowledge_base="CEI", sources=["/proc/self/environ"])
+	monkeypatch.setattr(palette, "configure_llm_cache", lambda **kwargs: None)
+	monkeypatch.setattr(usecase, "ingest_knowledge_base", lambda *args: pytest.fail("run() must not ingest"))
+	monkeypatch.setattr(usecase, "default_agent", lambda **kwargs: "default agent")
+
+	assert usecase.run("ingest_knowledge_base") == "default agent"
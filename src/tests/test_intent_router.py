@@ -0,0 +1,60 @@
+import pytest
+
+pytest.importorskip("genai_core")
+
+import palette
+
+IntentRouter = palette.IntentRouter
+
+
+@pytest.mark.parametrize("question", [
+	# Technical senses of "image" which the rules used to route to image generation with confidence 1.0
+	"create an AMI image",
+	"make a Docker image",
+	"create an image of my EC2 instance",
+	"Generate an image of the EBS volume",
+	"分析一下这张架构图",
+	# Not a request with the phrasing the rules can parse: left to the embedding router and the LLM
+	"Draw a cat sitting on a windowsill",
+	"What is CEI (Customer Engagement Incentive)?",
+])
+def test_ambiguous_questions_are_not_decided_by_rules(question):
+	assert IntentRouter.route_by_rules(question) is None
+
+
+@pytest.mark.parametrize("question, content_of_images, number", [
+	("Generate 3 images of a puppy running on the beach", "a puppy running on the beach", 3),
+	("Please generate 2 images featuring Optimus Prime from Transformers", "Optimus Prime from Transformers", 2),
+	("Could you draw two pictures of a red fox?", "a red fox", 2),
+	("Paint an image of a lighthouse in a storm", "a lighthouse in a storm", 1),
+	("帮我画一只在草地上奔跑的小狗", "一只在草地上奔跑的小狗", 1),
+	("生成两张赛博朋克风格的城市夜景图片", "赛博朋克风格的城市夜景", 2),
+	("请生成3幅水墨风格的山水画", "水墨风格的山水画", 3),
+])
+def test_image_requests_are_decided_by_rules(question, content_of_images, number):
+	decision = IntentRouter.route_by_rules(question)
+
+	assert decision["category"] == palette.ROUTE_IMAGES
+	assert (decision["content_of_images"], decision["number"]) == (content_of_images, number)
+	assert IntentRouter.parse_image_request(question) == (content_of_images, number)
+
+
+@pytest.mark.parametrize("question", [
+	"Can 3, 3, 8, 8 make 24?",
+	"用 2 3 4 5 算24点",
+	"24点游戏：1 2 3 4",
+	"3 8 8 3 怎么算出24",
+	"3 3 8 8",
+])
+def test_24_game_questions_are_decided_by_rules(question):
+	assert IntentRouter.route_by_rules(question)["category"] == palette.ROUTE_MAKE_24
+
+
+@pytest.mark.parametrize("question", [
+	"How many hours are in 24 days?",
+	"What is 24 * 3?",
+	"I have 1 2 3 apples",
+	"1 2 3 4 5 make 24",
+])
+def test_other_questions_with_numbers_are_not_the_24_game(question):
+	assert IntentRouter.route_by_rules(question) is None
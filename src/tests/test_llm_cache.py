@@ -0,0 +1,103 @@
+from typing import Any, List, Optional
+
+import pytest
+
+pytest.importorskip("genai_core")
+
+import langchain
+from langchain.callbacks.manager import CallbackManagerForLLMRun
+from langchain.chat_models.base import SimpleChatModel
+from langchain.memory import ConversationBufferWindowMemory
+from langchain.prompts import PromptTemplate
+from langchain.schema import Generation
+from langchain.schema.messages import BaseMessage
+
+import palette
+
+DETERMINISTIC = "[('_type', 'openai-chat'), ('model_name', 'gpt-4'), ('stop', None), ('temperature', 0.0)]"
+SAMPLED = "[('_type', 'openai-chat'), ('model_name', 'gpt-4'), ('stop', None), ('temperature', 0.7)]"
+ANSWER = "cached answers are not streamed"
+
+
+class FakeChatModel(SimpleChatModel):
+	"""Temperature-0 chat model which emits ANSWER word by word when streaming."""
+	streaming: bool = False
+	temperature: float = 0.0
+
+	@property
+	def _llm_type(self) -> str:
+		return "fake-chat"
+
+	@property
+	def _identifying_params(self):
+		return {"temperature": self.temperature}
+
+	def _call(
+		self,
+		messages: List[BaseMessage],
+		stop: Optional[List[str]] = None,
+		run_manager: Optional[CallbackManagerForLLMRun] = None,
+		**kwargs: Any,
+	) -> str:
+		for token in ANSWER.split(" "):
+			if self.streaming and run_manager:
+				run_manager.on_llm_new_token(token + " ")
+		return ANSWER
+
+
+@pytest.fixture(autouse=True)
+def no_global_cache(monkeypatch):
+	monkeypatch.setattr(langchain, "llm_cache", None)
+
+
+@pytest.mark.parametrize("llm_string, expected", [
+	(DETERMINISTIC, True),
+	('{"kwargs": {"model": "gpt-4", "temperature": 0}}', True),
+	(SAMPLED, False),
+	("[('_type', 'fake-list'), ('stop', None)]", False),
+])
+def test_is_deterministic(llm_string, expected):
+	assert palette.TieredLLMCache.is_deterministic(llm_string) is expected
+
+
+def test_sampled_calls_bypass_the_cache():
+	cache = palette.TieredLLMCache()
+	cache.update("prompt", SAMPLED, [Generation(text="answer")])
+
+	assert cache.lookup("prompt", SAMPLED) is None
+	assert cache.memory.get(cache.make_key("prompt", SAMPLED)) is None
+
+
+def test_sqlite_tier_round_trip(tmp_path):
+	path = str(tmp_path / "llm_cache.sqlite")
+	palette.TieredLLMCache(path=path).update("prompt", DETERMINISTIC, [Generation(text="answer", generation_info={"finish_reason": "stop"})])
+
+	generations = palette.TieredLLMCache(path=path).lookup("prompt", DETERMINISTIC)
+
+	assert generations == [Generation(text="answer", generation_info={"finish_reason": "stop"})]
+
+
+def test_sqlite_tier_is_only_used_on_the_local_temp_directory(tmp_path):
+	assert palette.configure_llm_cache(path="/mnt/efs/llm_cache.sqlite").path is None
+	assert palette.configure_llm_cache(path=str(tmp_path / "llm_cache.sqlite")).path == str(tmp_path / "llm_cache.sqlite")
+
+
+def test_streaming_llms_bypass_the_cache(make_usecase, monkeypatch):
+	monkeypatch.setattr(palette, "debug_enabled", lambda: False)
+	usecase = make_usecase("Are cached answers streamed?")
+	usecase.llm_factory = lambda streaming=False, **kwargs: FakeChatModel(streaming=streaming)
+	usecase.get_memory = lambda: ConversationBufferWindowMemory(memory_key="chat_history", input_key="question", k=10)
+	usecase.get_chatbot_prompt = lambda **kwargs: PromptTemplate.from_template("Human: {question}\nAssistant:")
+	usecase.save_chat_history = lambda metadata: None
+	cache = palette.configure_llm_cache()
+
+	usecase.chatbot()
+	assert len(cache.memory) == 1
+
+	assert usecase.get_llm(streaming=True).cache is False
+	assert usecase.get_llm(callbacks=[object()]).cache is False
+	assert usecase.get_llm(streaming=False).cache is None
+
+	for _ in range(2):
+		events = list(usecase.chatbot_stream())
+		assert "".join(event["content"] for event in events if event["type"] == "token").strip() == ANSWER
@@ -0,0 +1,47 @@
+import threading
+
+import pytest
+
+pytest.importorskip("genai_core")
+
+import palette
+
+
+@pytest.fixture
+def local_embeddings():
+	"""LocalBGEEmbeddings whose model is replaced by a recorder of the batches it gets."""
+	embeddings = palette.LocalBGEEmbeddings.__new__(palette.LocalBGEEmbeddings)
+	embeddings.batch_size = 2
+	embeddings.query_instruction = "Represent this sentence for searching relevant passages: "
+	embeddings.batches = []
+
+	def embed_batch(texts):
+		embeddings.batches.append((list(texts), threading.current_thread().name))
+		return [[float(len(text))] for text in texts]
+
+	embeddings.embed_batch = embed_batch
+	return embeddings
+
+
+def test_batched_queries_get_the_query_instruction(local_embeddings):
+	# As built by PaletteUsecase.get_embeddings() with env 'embedding_batching'
+	embeddings = palette.DeadlineEmbeddings(local_embeddings, name="embeddings:test-local", deadline=5)
+	embeddings.batcher = palette.EmbeddingBatcher(embeddings.embed_queries, max_wait=0.001)
+
+	assert embeddings.embed_query("question") == embeddings.embeddings.embed_query("question")
+	assert all(text.startswith(local_embeddings.query_instruction) for texts, _ in local_embeddings.batches for text in texts)
+
+
+def test_documents_have_no_query_instruction(local_embeddings):
+	local_embeddings.embed_documents(["a", "b"])
+
+	assert local_embeddings.batches[0][0] == ["a", "b"]
+
+
+def test_batches_run_outside_endpoint_executor(local_embeddings):
+	embeddings = palette.DeadlineEmbeddings(local_embeddings, name="embeddings:test-local", deadline=5)
+
+	vectors = embeddings.embed_documents(["a", "bb", "ccc", "dddd", "eeeee"])
+
+	assert vectors == [[1.0], [2.0], [3.0], [4.0], [5.0]]
+	assert all(name.startswith("palette-local-embedding") for _, name in local_embeddings.batches)
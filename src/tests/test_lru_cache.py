@@ -0,0 +1,67 @@
+import json
+import time
+
+import pytest
+
+pytest.importorskip("genai_core")
+
+import palette
+
+
+def test_least_recently_used_entries_are_evicted():
+	cache = palette.LRUCache(maxsize=2)
+	cache.put("a", 1)
+	cache.put("b", 2)
+	assert cache.get("a") == 1		# "b" is now the least recently used
+	cache.put("c", 3)
+
+	assert "b" not in cache
+	assert (cache.get("a"), cache.get("c"), len(cache)) == (1, 3, 2)
+	assert (cache.hits, cache.misses) == (3, 0)
+	assert cache.get("b", "missing") == "missing"
+	assert cache.misses == 1
+
+
+def test_puts_are_persisted_once_after_the_interval(tmp_path, monkeypatch):
+	path = tmp_path / "route_cache.json"
+	cache = palette.LRUCache(maxsize=10, persist_path=str(path), persist_interval=0.1)
+	saves = []
+	save = cache.save
+	monkeypatch.setattr(cache, "save", lambda: (saves.append(time.monotonic()), save()))
+
+	for i in range(5):
+		cache.put(f"question {i}", {"category": "d"})
+	assert not path.exists()
+
+	deadline = time.monotonic() + 2
+	while not saves and time.monotonic() < deadline:
+		time.sleep(0.01)
+	time.sleep(0.15)
+
+	assert len(saves) == 1
+	assert len(json.loads(path.read_text(encoding="utf-8"))) == 5
+
+
+def test_flush_writes_now_and_reloads_within_maxsize(tmp_path):
+	path = str(tmp_path / "route_cache.json")
+	cache = palette.LRUCache(maxsize=10, persist_path=path, persist_interval=60)
+	for i in range(4):
+		cache.put(f"question {i}", i)
+
+	cache.flush()
+	reloaded = palette.LRUCache(maxsize=2, persist_path=path)
+
+	assert cache._save_timer is None
+	assert (len(reloaded), reloaded.get("question 3")) == (2, 3)
+	assert "question 0" not in reloaded
+
+
+def test_flush_without_changes_does_not_write(tmp_path):
+	path = tmp_path / "route_cache.json"
+	palette.LRUCache(persist_path=str(path)).flush()
+
+	assert not path.exists()
+
+
+def test_route_cache_keys_ignore_width_case_and_spacing():
+	assert palette.normalize_question("  Ｃａｎ 3,3,8,8   make 24？") == palette.normalize_question("can 3,3,8,8 make 24")
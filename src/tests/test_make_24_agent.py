@@ -0,0 +1,137 @@
+import io
+import json
+
+import pytest
+
+# palette.py is a genai_core plugin; without genai_core (and the layer's other dependencies) there is nothing to test
+pytest.importorskip("genai_core")
+
+from botocore.exceptions import ReadTimeoutError
+
+import palette
+
+
+class LocalLambdaClient:
+	"""Stand-in for the boto3 Lambda client: returns (or raises) a canned response and records the invocations."""
+	def __init__(self, response=None, function_error=None, error=None):
+		self.response = response
+		self.function_error = function_error
+		self.error = error
+		self.invocations = []
+
+	def invoke(self, FunctionName, InvocationType, Payload):
+		self.invocations.append({"FunctionName": FunctionName, "InvocationType": InvocationType, "Payload": json.loads(Payload)})
+		if self.error is not None:
+			raise self.error
+		res = {"StatusCode": 200, "Payload": io.BytesIO(json.dumps(self.response).encode("utf-8"))}
+		if self.function_error:
+			res["FunctionError"] = self.function_error
+		return res
+
+
+AUTOGEN_RESPONSE = {
+	"last_message": "(8 / (3 - 8 / 3)) = 24",
+	"chat_messages": [{"role": "assistant", "content": "(8 / (3 - 8 / 3)) = 24"}],
+}
+
+
+@pytest.fixture(autouse=True)
+def openai_env(monkeypatch):
+	monkeypatch.setenv("OPENAI_API_KEY", "test-key")
+	monkeypatch.setenv("OPENAI_API_BASE", "https://example.invalid/v1")
+
+
+def test_autogen_success_is_returned_and_saved(make_usecase):
+	usecase = make_usecase("Can 3, 3, 8, 8 make 24?", make_24_local_solver=False)
+	client = LocalLambdaClient(response=AUTOGEN_RESPONSE)
+
+	response = usecase.make_24_agent(lambda_client=client)
+
+	assert response["content"] == AUTOGEN_RESPONSE["last_message"]
+	assert response["metadata"]["autogen_chat_messages"] == AUTOGEN_RESPONSE["chat_messages"]
+	assert client.invocations[0]["FunctionName"] == "sagemind-autogen-code"
+	assert client.invocations[0]["Payload"]["question"] == "Can 3, 3, 8, 8 make 24?"
+	assert [message.type for message in usecase.chat_history.messages] == ["human", "ai"]
+
+
+def test_autogen_function_error_is_reported_and_not_saved(make_usecase):
+	usecase = make_usecase("Can 3, 3, 8, 8 make 24?", make_24_local_solver=False)
+	client = LocalLambdaClient(response={"errorMessage": "boom"}, function_error="Unhandled")
+
+	response = usecase.make_24_agent(lambda_client=client)
+
+	assert response["content"].startswith("对不起")
+	assert "Unhandled" in response["content"]
+	assert usecase.chat_history.messages == []
+
+
+def test_autogen_timeout_is_reported_and_not_saved(make_usecase):
+	usecase = make_usecase("Can 3, 3, 8, 8 make 24?", make_24_local_solver=False)
+	client = LocalLambdaClient(error=ReadTimeoutError(endpoint_url="https://lambda.invalid"))
+
+	response = usecase.make_24_agent(lambda_client=client)
+
+	assert response["content"].startswith("对不起")
+	assert len(client.invocations) == 1
+	assert usecase.chat_history.messages == []
+
+
+def test_autogen_async_job_saves_the_result(make_usecase):
+	usecase = make_usecase("Can 3, 3, 8, 8 make 24?", make_24_local_solver=False, autogen_async=True)
+	client = LocalLambdaClient(response=AUTOGEN_RESPONSE)
+
+	response = usecase.make_24_agent(lambda_client=client)
+	job_id = response["metadata"]["autogen_job_id"]
+	result = palette.get_autogen_job_result(job_id, timeout=10)
+
+	assert response["metadata"]["autogen_job_status"] == "running"
+	assert result["content"] == AUTOGEN_RESPONSE["last_message"]
+	assert [message.type for message in usecase.chat_history.messages] == ["human", "ai"]
+
+
+def test_lambda_client_with_deadline_does_not_retry():
+	client = palette.get_lambda_client(read_timeout=5)
+
+	assert client.meta.config.read_timeout == 5
+	assert client.meta.config.retries["total_max_attempts"] == 1
+
+
+def test_local_solver_needs_neither_autogen_nor_openai(make_usecase, monkeypatch):
+	monkeypatch.delenv("OPENAI_API_KEY")
+	monkeypatch.delenv("OPENAI_API_BASE")
+	usecase = make_usecase("用 8 3 8 3 算24点")
+	client = LocalLambdaClient(error=AssertionError("autogen must not be invoked"))
+
+	response = usecase.make_24_agent(lambda_client=client)
+
+	assert "= 24" in response["content"]
+	assert client.invocations == []
+
+
+def test_solver_is_memoized_across_permutations(make_usecase):
+	palette.solve_make_24.cache_clear()
+	for numbers in ([3, 3, 8, 8], [8, 3, 8, 3], [3, 8, 3, 8]):
+		make_usecase("24 game").solve_make_24_locally(numbers)
+
+	assert palette.solve_make_24.cache_info().misses == 1
+
+
+@pytest.mark.parametrize("question, numbers", [
+	("Can 3, 3, 8, 8 make 24?", [3, 3, 8, 8]),
+	("用 3-3-8-8 算24点", [3, 3, 8, 8]),
+	("-3 3 8 8 make 24", None),
+	("Can 3, -3, 8, 8 make 24?", None),
+	("用 −3 3 8 8 算24点", None),
+	("2.5 3 8 8 make 24", None),
+])
+def test_parse_make_24_numbers(question, numbers):
+	assert palette.parse_make_24_numbers(question) == numbers
+
+
+def test_negative_operands_go_to_autogen(make_usecase):
+	usecase = make_usecase("-3 3 8 8 make 24")
+	client = LocalLambdaClient(response=AUTOGEN_RESPONSE)
+
+	usecase.make_24_agent(lambda_client=client)
+
+	assert len(client.invocations) == 1
@@ -0,0 +1,57 @@
+from datetime import date
+
+import pytest
+
+pytest.importorskip("genai_core")
+
+import palette
+
+TODAY = date(2024, 5, 15)	# a Wednesday
+
+
+@pytest.mark.parametrize("expression, expected", [
+	("2024-05-01", date(2024, 5, 1)),
+	("2024年5月1日", date(2024, 5, 1)),
+	("today", TODAY),
+	("yesterday", date(2024, 5, 14)),
+	("the day before yesterday", date(2024, 5, 13)),
+	("3 days ago", date(2024, 5, 12)),
+	("a day ago", date(2024, 5, 14)),
+	("2 days before today", date(2024, 5, 13)),
+	("in 3 days", date(2024, 5, 18)),
+	("two days from now", date(2024, 5, 17)),
+	("前天", date(2024, 5, 13)),
+	("三天前", date(2024, 5, 12)),
+	("十天前", date(2024, 5, 5)),
+	("十一天前", date(2024, 5, 4)),
+	("二十天后", date(2024, 6, 4)),
+	("next Monday", date(2024, 5, 20)),
+	("上周五", date(2024, 5, 10)),
+	("上上周一", date(2024, 4, 29)),
+	("下周一", date(2024, 5, 20)),
+	("下下周一", date(2024, 5, 27)),
+	("Wednesday next week", date(2024, 5, 22)),
+	("next week's Friday", date(2024, 5, 24)),
+	("Friday of last week", date(2024, 5, 10)),
+	("this Friday", date(2024, 5, 17)),
+])
+def test_resolve_relative_date(expression, expected):
+	assert palette.resolve_relative_date(expression, TODAY) == expected
+
+
+@pytest.mark.parametrize("expression", [
+	"2024-13-01",
+	"2024-02-30",
+	"data days ago",
+	"2 days after tomorrow",
+	"十十天前",
+	"someday",
+])
+def test_resolve_relative_date_not_understood(expression):
+	assert palette.resolve_relative_date(expression, TODAY) is None
+
+
+def test_invalid_date_is_reported_to_the_agent(monkeypatch):
+	monkeypatch.setattr(palette, "get_today", lambda: TODAY)
+
+	assert palette.get_temperature_on_date("2024-13-01").startswith("Could not understand the date '2024-13-01'")
@@ -0,0 +1,70 @@
+import json
+import time
+
+import pytest
+
+pytest.importorskip("genai_core")
+
+from langchain.schema import AgentAction, Document
+
+import palette
+
+
+def make_steps(steps=12, documents_per_step=3, document_chars=20000):
+	"""Intermediate steps of a retrieval agent: every step retrieves a few large documents."""
+	return [
+		(
+			AgentAction("CEI Customer Engagement Incentive", f"question {step}", f"Thought: look up part {step}"),
+			[
+				Document(page_content=f"{step}-{index} " + "x" * document_chars, metadata={"source": f"s3://kb/doc-{step}-{index}.md", "page": index})
+				for index in range(documents_per_step)
+			],
+		)
+		for step in range(steps)
+	]
+
+
+def benchmark(usecase, steps, compact, repeat=5):
+	"""
+	Return (best time in ms, JSON size in bytes) of serializing the steps into 'reasoning_acting_steps' and encoding
+	them as JSON, as they are stored with the chat history.
+	"""
+	usecase.env["compact_reasoning_steps"] = compact
+	best = None
+	for _ in range(repeat):
+		start = time.perf_counter()
+		encoded = json.dumps([usecase.serialize_agent_action(step) for step in steps], ensure_ascii=False).encode("utf-8")
+		elapsed = (time.perf_counter() - start) * 1000
+		best = elapsed if best is None else min(best, elapsed)
+	return best, len(encoded)
+
+
+def test_documents_with_the_same_content_keep_their_own_source():
+	serializer = palette.StepSerializer(max_content_chars=100)
+	first = serializer.serialize(Document(page_content="same text", metadata={"source": "a.md"}))
+	second = serializer.serialize(Document(page_content="same text", metadata={"source": "b.md"}))
+
+	assert (first["id"], first["metadata"]) == ("a.md", {"source": "a.md"})
+	assert (second["id"], second["metadata"]) == ("b.md", {"source": "b.md"})
+	assert first["hash"] == second["hash"]
+
+
+def test_long_documents_are_truncated():
+	serialized = palette.StepSerializer(max_content_chars=10).serialize(Document(page_content="y" * 50))
+
+	assert serialized["page_content"] == "y" * 10
+	assert (serialized["length"], serialized["truncated"]) == (50, True)
+
+
+def test_compact_steps_benchmark(make_usecase):
+	# 12 steps x 3 retrieved documents of 20k chars. Run with -s to see the figures; only the size is asserted, since
+	# the timings depend on the machine.
+	usecase = make_usecase("benchmark")
+	steps = make_steps()
+
+	compact_ms, compact_bytes = benchmark(usecase, steps, compact=True)
+	full_ms, full_bytes = benchmark(usecase, steps, compact=False)
+	print(f"\ncompact: {compact_ms:.1f} ms, {compact_bytes / 1024:.0f} KB; Document.dict(): {full_ms:.1f} ms, {full_bytes / 1024:.0f} KB")
+
+	assert compact_bytes < full_bytes / 10
+
@@ -0,0 +1,88 @@
+from typing import Any, List, Optional
+
+import pytest
+
+pytest.importorskip("genai_core")
+
+from langchain.llms.base import LLM
+from langchain.memory import ChatMessageHistory
+
+import palette
+
+
+class RecordingSummaryLLM(LLM):
+	"""LLM which records the prompts it gets and answers with the number of summary calls so far."""
+	prompts: List[str] = []
+
+	@property
+	def _llm_type(self) -> str:
+		return "recording-summary"
+
+	def _call(self, prompt: str, stop: Optional[List[str]] = None, run_manager: Any = None, **kwargs: Any) -> str:
+		self.prompts.append(prompt)
+		return f"summary {len(self.prompts)}"
+
+
+@pytest.fixture
+def session(request):
+	history = ChatMessageHistory()
+	llm = RecordingSummaryLLM(prompts=[])
+	session_id = request.node.name
+
+	def turn(human, ai, k=1, max_token_limit=2000):
+		"""Add a turn to the session and return (summary, kept messages) of the memory of the next request."""
+		history.add_user_message(human)
+		history.add_ai_message(ai)
+		memory = palette.TokenBudgetWindowMemory(
+			memory_key = "chat_history",
+			chat_memory = palette.WindowedChatMessageHistory(history, window=k * 2 + 2),
+			k = k,
+			max_token_limit = max_token_limit,
+			summary_llm = llm,
+			session_id = session_id,
+		)
+		return memory.select_messages()
+
+	yield turn, llm
+	palette.running_summaries.put(session_id, None)
+
+
+def test_messages_aging_out_of_the_window_are_summarized(session):
+	turn, llm = session
+
+	summary, kept = turn("first question", "first answer")
+	assert summary == ""
+	assert [message.content for message in kept] == ["first question", "first answer"]
+
+	summary, kept = turn("second question", "second answer")
+	assert summary == "summary 1"
+	assert [message.content for message in kept] == ["second question", "second answer"]
+	assert "first question" in llm.prompts[0] and "first answer" in llm.prompts[0]
+
+	summary, _ = turn("third question", "third answer")
+	assert summary == "summary 2"
+	assert "second question" in llm.prompts[1] and "first question" not in llm.prompts[1]
+
+
+def test_repeated_messages_are_summarized_again(session):
+	turn, llm = session
+
+	turn("ok", "ok")
+	turn("ok", "ok")
+	summary, _ = turn("ok", "ok")
+
+	assert summary == "summary 2"
+	assert all("Human: ok" in prompt for prompt in llm.prompts)
+
+
+def test_messages_over_the_budget_are_summarized_once(session):
+	turn, llm = session
+
+	summary, kept = turn("x " * 400, "short answer", k=2, max_token_limit=50)
+	assert [message.content for message in kept] == ["short answer"]
+	assert summary == "summary 1"
+
+	# Nothing new to summarize while the long message is the only one dropped
+	summary, kept = turn("next", "answer", k=2, max_token_limit=50)
+	assert summary == "summary 1"
+	assert len(llm.prompts) == 1
@@ -0,0 +1,106 @@
+import threading
+import time
+from typing import List
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("genai_core")
+
+from langchain.schema import BaseRetriever, Document
+
+import palette
+
+
+class FakeEmbeddings:
+	def embed_query(self, text):
+		return [1.0, 0.0] if "first" in text else [0.0, 1.0]
+
+
+class FixedRetriever(BaseRetriever):
+	"""Stand-in for the OpenSearch retriever."""
+	documents: List[Document]
+
+	def _get_relevant_documents(self, query, *, run_manager):
+		return self.documents
+
+
+OPENSEARCH_DOCUMENT = Document(page_content="from OpenSearch")
+
+
+@pytest.fixture
+def snapshot(tmp_path, monkeypatch):
+	monkeypatch.setattr(palette, "vector_snapshots", {})
+	snapshot = palette.VectorIndexSnapshot("kb_test", str(tmp_path))
+	snapshot.save(
+		["doc-1", "doc-2"],
+		[{"page_content": "first document", "metadata": {"source": "a.md"}}, {"page_content": "second document", "metadata": {"source": "b.md"}}],
+		np.array([[1.0, 0.0], [0.0, 1.0]], dtype=np.float32),
+	)
+	palette.vector_snapshots[snapshot.index_name] = snapshot
+	return snapshot
+
+
+def make_retriever(snapshot):
+	return palette.SnapshotRetriever(
+		snapshot = snapshot,
+		embeddings = FakeEmbeddings(),
+		fallback = FixedRetriever(documents=[OPENSEARCH_DOCUMENT]),
+		k = 1,
+	)
+
+
+def test_snapshot_answers_nearest_first(snapshot):
+	assert [document.page_content for document in make_retriever(snapshot).get_relevant_documents("the first one")] == ["first document"]
+	assert [document.page_content for document, _ in snapshot.search([0.0, 1.0], 2)] == ["second document", "first document"]
+
+
+def test_retriever_falls_back_to_opensearch_when_the_snapshot_is_dropped(snapshot):
+	retriever = make_retriever(snapshot)
+	snapshot.state = None
+
+	assert snapshot.search([1.0, 0.0], 1) is None
+	assert retriever.get_relevant_documents("the first one") == [OPENSEARCH_DOCUMENT]
+
+
+def test_refresh_finding_a_too_large_index_switches_retrievers_to_opensearch(snapshot, monkeypatch):
+	retriever = make_retriever(snapshot)
+	monkeypatch.setattr(snapshot, "refresh", lambda client, max_docs: False)
+	snapshot.refreshed_at = 0
+
+	assert palette.get_vector_snapshot(snapshot.index_name, None, directory=None, max_docs=1, max_age=60) is snapshot
+	deadline = time.monotonic() + 2
+	while snapshot.refreshing and time.monotonic() < deadline:
+		time.sleep(0.01)
+
+	assert snapshot.state is None
+	assert retriever.get_relevant_documents("the first one") == [OPENSEARCH_DOCUMENT]
+
+
+def test_concurrent_requests_start_one_background_refresh(snapshot, monkeypatch):
+	refreshes = []
+
+	def refresh(client, max_docs):
+		refreshes.append(threading.current_thread().name)
+		time.sleep(0.1)
+		snapshot.refreshed_at = time.time()
+		return True
+
+	monkeypatch.setattr(snapshot, "refresh", refresh)
+	snapshot.refreshed_at = 0
+	start = threading.Barrier(8)
+
+	def request():
+		start.wait()
+		palette.get_vector_snapshot(snapshot.index_name, None, directory=None, max_docs=100, max_age=60)
+
+	threads = [threading.Thread(target=request) for _ in range(8)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	deadline = time.monotonic() + 2
+	while snapshot.refreshing and time.monotonic() < deadline:
+		time.sleep(0.01)
+
+	assert len(refreshes) == 1